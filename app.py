@@ -1,36 +1,91 @@
 # https://discord.com/api/oauth2/authorize?client_id=1190002809685430437&permissions=139586776128&scope=bot
 import os
+import sys
 import asyncio
-import random
 import math
+import time
 import datetime
 from copy import deepcopy
+from functools import partial
+from contextlib import asynccontextmanager
 import json
 import discord
 from discord.ext import commands, tasks
+from state import StateStore
+from storage import open_storage
+from journal import open_journal
+from registry import ConfigRegistry
+from tick import TickEngine, TickContext
+from notifications import Outbox, Deferred
+from user_cache import DmChannelCache
+from rng import open_rng
+from relations import RelationGraph
+from land_index import LandIndex
+from leaderboard import Leaderboards, BOARDS
+from siege import SiegeCache
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from battle import Company, Fortifications, army_stats, resolve_seeded, simulate, merge_simulations
+from battle_report import BattleArchive, render_summary
 
 client = commands.Bot(command_prefix="/",
                       intents=discord.Intents.all())
 
+# DM channels are looked up once per player instead of fetching the user for every message
+dm_channels = DmChannelCache(client)
 
-@tasks.loop(time=[datetime.time(hour=12, minute=0, tzinfo=datetime.timezone.utc)])
-#@tasks.loop(hours=1)
-async def dailyReset():
-    print('Daily reset occurring')
-    with open("./data/bot_status.txt", "r") as file:
-        randomresponses = file.readlines()
-        response = random.choice(randomresponses)
-    await client.change_presence(activity=discord.CustomActivity(name=response, emoji='🦆'))
-    # Requires that you do the following for this to work: pip install discord.py>=2.3.2
+# World state is loaded once at startup, journaled as commands commit and snapshotted in the background
+state = StateStore(open_storage(), open_journal())
+
+# Lieges, vassals and allies, kept up to date as transactions commit so friendliness checks don't scan every user
+relations = RelationGraph()
+state.listen(relations.update)
+
+# Land ids by name, and every player's units on the map for /myarmy and oath breaking
+land_index = LandIndex()
+state.listen(land_index.update)
+
+# Users ranked by quacks, quackerinos, lands and renown for /quackery
+leaderboards = Leaderboards()
+state.listen(leaderboards.update)
+
+# Troop, building and species definitions, merged once and reloaded only when their files change
+registry = ConfigRegistry()
+
+# Who is winning the siege of each land, worked out again only after a change to the land has committed
+sieges = SiegeCache(registry)
+state.listen(sieges.update)
+
+# Where all the game's dice come from, see rng.py
+rng = open_rng()
+
+# The phases of the daily reset, run in the order they are registered below
+tick = TickEngine()
+
+# The latest battles, so /battlereport can show every round of them
+battle_reports = BattleArchive()
 
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+# Worker processes, started the first time they are needed. The daily tick's battles and /simulate each get
+# their own pool, so the tick never waits behind simulations while it holds the world lock.
+POOL_WORKERS = {"battles": os.cpu_count() or 1, "simulations": max(1, (os.cpu_count() or 1) // 2)}
+pools = {}
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+# Limits for /simulate, so one request can't tie up a battle worker or run it out of memory
+SIMULATE_MAX_AMOUNT = 100000
+SIMULATE_MAX_ATK = 1000000
+# Trials times the troops on both sides
+SIMULATE_MAX_WORK = 50000000
+# Simulations running or waiting for a worker; more requests than this are turned away
+SIMULATE_MAX_PENDING = 4
+simulations_pending = 0
 
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+
+@tick.phase("income")
+async def collect_income(ctx):
+    # Collect income, roll land quality, pay taxes and reset the daily counters of every user
+    user_info = ctx.user_info
+    global_info = ctx.global_info
+    lands = ctx.lands
 
     for userId, user in user_info.items():
         if userId == "default":
@@ -60,7 +115,7 @@ async def dailyReset():
                 income = max(0, int(income))
 
             # Adjust income if the land is being sieged by a superior foe
-            if await is_surrounded(land):
+            if await is_surrounded(land_id, land):
                 income -= income * species["incomePenaltyPercentInSiege"]
                 income = max(0, int(income))
 
@@ -76,16 +131,16 @@ async def dailyReset():
                         building = await get_building(building_id)
                         qualityImprovementProbability += building["qualityIncreaseChanceBonus"]
 
-                    if random.random() < qualityImprovementProbability:
+                    if rng.random("quality") < qualityImprovementProbability:
                         land["quality"] += 1
-                    
+
                     land["quality"] += species["landQualityIncreasePerTurn"]
-                
+
                 land["quality"] = min(land["maxQuality"], land["quality"])
 
             else:
                 # Roll for decrease land quality of the user didn't quack
-                if land["quality"] > 0 and random.random() < global_info["qualityDecayProbability"]:
+                if land["quality"] > 0 and rng.random("quality") < global_info["qualityDecayProbability"]:
                     land["quality"] -= 1
 
         # Pay liege lord according to the tax rate set by them
@@ -122,6 +177,12 @@ async def dailyReset():
         if user["safety_count"] > 0 and user["homeland_id"] > 0:
             user["safety_count"] -= 1
 
+
+@tick.phase("upkeep")
+async def pay_upkeep(ctx):
+    user_info = ctx.user_info
+    lands = ctx.lands
+
     # Attempt to pay all the soldiers in each land
     for land_id, land in lands.items():
         if land_id == "default":
@@ -145,7 +206,7 @@ async def dailyReset():
                 garrison_disband_list.append(unit)
 
                 # DM user that units have been disbanded
-                await dm(unit["user_id"], f'{unit["amount"]} {unit["troop_name"]} have been disbanded at {land["name"]} because you didn\'t have enough money to pay them.')
+                await ctx.dm(unit["user_id"], f'{unit["amount"]} {unit["troop_name"]} have been disbanded at {land["name"]} because you didn\'t have enough money to pay them.')
             else:
                 user["quackerinos"] -= cost
 
@@ -169,7 +230,7 @@ async def dailyReset():
                 siege_camp_disband_list.append(unit)
 
                 # DM user that units have been disbanded
-                await dm(unit["user_id"], f'{unit["amount"]} {unit["troop_name"]} have been disbanded at {land["name"]} because you didn\' have enough money to pay them.')
+                await ctx.dm(unit["user_id"], f'{unit["amount"]} {unit["troop_name"]} have been disbanded at {land["name"]} because you didn\' have enough money to pay them.')
             else:
                 user["quackerinos"] -= cost
 
@@ -177,635 +238,619 @@ async def dailyReset():
         for unit in siege_camp_disband_list:
             land["siegeCamp"].remove(unit)
 
-    # Execute the task queue
-    index = 0
+
+@tick.phase("sieges")
+async def execute_sieges(ctx):
+    lands = ctx.lands
+    task_queue = ctx.task_queue
 
     # Execute all the siege commands first
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
+    for task_id, task in task_queue.of_type("siege"):
+        land = lands.get(str(task["location_id"]), "")
+        target_land = lands.get(str(task["target_land_id"]), "")
+        unit = await get_unit(land["siegeCamp"], task["item"], task["user_id"])
+        army = land["siegeCamp"]
+
+        # The task is done one way or another
+        task_queue.remove(task_id)
+
+        # Fail if that troop isn't in that land or if there aren't as many as specified
+        if unit == "" or unit["amount"] < task["amount"]:
+            unit = await get_unit(land["garrison"], task["item"], task["user_id"])
+            army = land["garrison"]
+            if unit == "" or unit["amount"] < task["amount"]:
+                await ctx.dm(task["user_id"], f'You don\'t have enough of {task["item"]} from {land["name"]} to send to the siege camp of {target_land["name"]}.')
+                continue
 
-        if task["task"] == "siege":
-            user = user_info[str(task["user_id"])]
-            land = lands.get(str(task["location_id"]), "")
-            target_land = lands.get(str(task["target_land_id"]), "")
-            unit = await get_unit(land["siegeCamp"], task["item"], task["user_id"])
-            army = land["siegeCamp"]
+        # Fail if the target land is yours
+        if target_land["owner_id"] == task["user_id"]:
+            await ctx.dm(task["user_id"], 'You can\'t siege yourself.')
+            continue
 
-            # Fail if that troop isn't in that land or if there aren't as many as specified
-            if unit == "" or unit["amount"] < task["amount"]:
-                unit = await get_unit(land["garrison"], task["item"], task["user_id"])
-                army = land["garrison"]
-                if unit == "" or unit["amount"] < task["amount"]:
-                    await dm(task["user_id"], f'You don\'t have enough of {task["item"]} from {land["name"]} to send to the siege camp of {target_land["name"]}.')
-                    global_info["task_queue"].pop(index)  # Remove this task
-                    continue
+        allies = await get_allies(task["user_id"])
 
-            # Fail if the target land is yours
-            if target_land["owner_id"] == task["user_id"]:
-                await dm(task["user_id"], 'You can\'t siege yourself.')
-                global_info["task_queue"].pop(index)  # Remove this task
-                continue
+        # Fail if the target is the liege or vassal of your liege or your vassal
+        if str(target_land["owner_id"]) in allies:
+            await ctx.dm(task["user_id"], f'You can\'t siege {client.get_user(int(target_land["owner_id"]))}\'s settlement {target_land["name"]} for one of the following reasons: they are your liege, fellow vassal, your vassal, your ally, or a vassal of your ally.')
+            continue
+
+        # Fail if the your land is already surrounded
+        if await is_surrounded(task["location_id"], land):
+            await ctx.dm(task["user_id"], f'You cannot move {task["item"]} out of {land["name"]} because it is fully surrounded.')
+            continue
 
-            allies = await get_allies(task["user_id"])
+        # Remove the troops from the original land
+        moved_unit = await remove_unit(army, unit, task["amount"])
 
-            # Fail if the target is the liege or vassal of your liege or your vassal
-            if str(target_land["owner_id"]) in allies:
-                await dm(task["user_id"], f'You can\'t siege {client.get_user(int(target_land["owner_id"]))}\'s settlement {target_land["name"]} for one of the following reasons: they are your liege, fellow vassal, your vassal, your ally, or a vassal of your ally.')
-                global_info["task_queue"].pop(index)  # Remove this task
+        # Add them to the siege camp on the target land
+        await add_unit(target_land["siegeCamp"], moved_unit)
+
+        await ctx.dm(task["user_id"],
+                 f'{task["amount"]} {task["item"]}s were sent to siege {target_land["name"]}.')
+
+
+@tick.phase("siege_battles")
+async def execute_siege_battles(ctx):
+    task_queue = ctx.task_queue
+
+    # Battles at different lands don't share any troops, so they are gathered into waves that are fought
+    # at the same time. A battle that touches a land of the current wave has to wait for the next one.
+    wave = []
+    wave_lands = set()
+
+    # Execute each siege battle, including attack commands and garrison. Then also include the siege camp if there are any defend commands.
+    for task_id, task in task_queue.of_type("attack"):
+        # Skip attacks that already took part in an earlier battle at the same land
+        if task_id not in task_queue:
+            continue
+
+        battle_lands = await get_battle_lands(task_queue, task["target_land_id"], ["defend", "attack"])
+        if battle_lands & wave_lands:
+            await conclude_siege_battles(ctx, wave)
+            wave = []
+            wave_lands = set()
+
+        wave.append(await gather_siege_battle(ctx, task))
+        wave_lands |= battle_lands
+
+    await conclude_siege_battles(ctx, wave)
+
+
+async def gather_siege_battle(ctx, task):
+    lands = ctx.lands
+    task_queue = ctx.task_queue
+
+    include_siege_camp = False
+    user_ids = []
+    attacker_army = []
+    defender_army = []
+
+    target_land = lands.get(str(task["target_land_id"]), "")
+
+    # Check for all other defend commands done to this target place and put them into an array
+    for action_id, action in task_queue.targeting("defend", task["target_land_id"]):
+        land = lands.get(str(action["location_id"]), "")
+
+        # Every defend command for this land is used up by this battle
+        task_queue.remove(action_id)
+
+        unit = await get_unit(land["siegeCamp"], action["item"], action["user_id"])
+
+        # Fail if that troop isn't in that land or if there aren't as many as specified
+        if unit == "" or unit["amount"] < action["amount"]:
+            unit = await get_unit(land["garrison"], action["item"], action["user_id"])
+            if unit == "" or unit["amount"] < action["amount"]:
+                await ctx.dm(action["user_id"], f'You don\'t have enough {action["item"]} from {land["name"]} to send on an attack against {target_land["name"]}.')
                 continue
 
-            # Fail if the your land is already surrounded
-            if await is_surrounded(land):
-                await dm(task["user_id"], f'You cannot move {task["item"]} out of {land["name"]} because it is fully surrounded.')
-                global_info["task_queue"].pop(index)  # Remove this task
+        # Fail if they are both the same land
+        if target_land["owner_id"] == action["user_id"]:
+            await ctx.dm(action["user_id"], 'You don\'t need to use the defend command for troops in the garrison of a land being attacked.')
+            continue
+
+        # Fail if the your land is already surrounded
+        if await is_surrounded(action["location_id"], land):
+            await ctx.dm(task["user_id"], f'You cannot move {action["item"]} out of {land["name"]} because it is fully surrounded.')
+            continue
+
+        # Add the troops to the defender army
+        defender_army.append(
+            {"unit": unit, "amount": action["amount"]})
+
+        # user_ids.append(action["user_id"])
+
+        include_siege_camp = True
+
+    # Add all garrison to the defend army
+    for unit in target_land["garrison"]:
+        defender_army.append({"unit": unit, "amount": unit["amount"]})
+
+    if include_siege_camp:
+        # Add all siege camp to the attack army
+        for unit in target_land["siegeCamp"]:
+            attacker_army.append(
+                {"unit": unit, "amount": unit["amount"]})
+
+    # Check for all other attack commands done to this target place and put them into an array
+    for action_id, action in task_queue.targeting("attack", task["target_land_id"]):
+        land = lands.get(str(action["location_id"]), "")
+        # target_land = lands.get(str(action["target_land_id"]), "")
+
+        # Every attack command for this land is used up by this battle
+        task_queue.remove(action_id)
+
+        unit = await get_unit(land["siegeCamp"], action["item"], action["user_id"])
+
+        # Fail if that troop isn't in that land or if there aren't as many as specified
+        if unit == "" or unit["amount"] < action["amount"]:
+            unit = await get_unit(land["garrison"], action["item"], action["user_id"])
+            if unit == "" or unit["amount"] < action["amount"]:
+                await ctx.dm(action["user_id"], f'You don\'t have enough {action["item"]} from {land["name"]} to send on an attack against {target_land["name"]}.')
                 continue
+        # Fail if the siege camp has already been included in the battle
+        elif include_siege_camp and action["location_id"] == action["target_land_id"]:
+            continue
 
-            # Remove the troops from the original land
-            moved_unit = await remove_unit(army, unit, task["amount"])
+        # Fail if the target land is yours
+        if target_land["owner_id"] == action["user_id"]:
+            await ctx.dm(action["user_id"], 'You can\'t attack yourself.')
+            continue
 
-            # Add them to the siege camp on the target land
-            await add_unit(target_land["siegeCamp"], moved_unit)
+        allies = await get_allies(action["user_id"])
 
-            await dm(task["user_id"],
-                     f'{task["amount"]} {task["item"]}s were sent to siege {target_land["name"]}.')
-            global_info["task_queue"].pop(index)  # Remove this task
-        else:
-            index += 1
+        # Fail if the target is the liege or vassal of your liege or your vassal
+        if str(target_land["owner_id"]) in allies:
+            await ctx.dm(action["user_id"], f'You can\'t attack {client.get_user(int(target_land["owner_id"]))} for one of the following reasons: they are your liege, fellow vassal, your vassal, your ally, or a vassal of your ally.')
+            continue
 
-    index = 0
+        # Fail if the your land is already surrounded
+        if await is_surrounded(action["location_id"], land) and land != target_land:
+            await ctx.dm(task["user_id"], f'You cannot move {task["item"]} out of {land["name"]} because it is fully surrounded.')
+            continue
 
-    # Execute each siege battle, including attack commands and garrison. Then also include the siege camp if there are any defend commands.
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
-
-        if task["task"] == "attack":
-            include_siege_camp = False
-            user_ids = []
-            attacker_army = []
-            defender_army = []
-
-            defend_index = 0
-            target_land = lands.get(str(task["target_land_id"]), "")
-
-            # Check for all other defend commands done to this target place and put them into an array
-            while defend_index < len(global_info["task_queue"]):
-                action = global_info["task_queue"][defend_index]
-                if action["target_land_id"] == task["target_land_id"] and action["task"] == "defend":
-                    user = user_info[str(action["user_id"])]
-                    land = lands.get(str(action["location_id"]), "")
-
-                    unit = await get_unit(land["siegeCamp"], action["item"], action["user_id"])
-
-                    # Fail if that troop isn't in that land or if there aren't as many as specified
-                    if unit == "" or unit["amount"] < action["amount"]:
-                        unit = await get_unit(land["garrison"], action["item"], action["user_id"])
-                        if unit == "" or unit["amount"] < action["amount"]:
-                            await dm(action["user_id"], f'You don\'t have enough {action["item"]} from {land["name"]} to send on an attack against {target_land["name"]}.')
-                            global_info["task_queue"].pop(
-                                defend_index)  # Remove this task
-                            continue
-
-                    # Fail if they are both the same land
-                    if target_land["owner_id"] == action["user_id"]:
-                        await dm(action["user_id"], 'You don\'t need to use the defend command for troops in the garrison of a land being attacked.')
-                        global_info["task_queue"].pop(
-                            defend_index)  # Remove this task
-                        continue
-
-                    # Fail if the your land is already surrounded
-                    if await is_surrounded(land):
-                        await dm(task["user_id"], f'You cannot move {action["item"]} out of {land["name"]} because it is fully surrounded.')
-                        global_info["task_queue"].pop(
-                            defend_index)  # Remove this task
-                        continue
-
-                    # Add the troops to the defender army
-                    defender_army.append(
-                        {"unit": unit, "amount": action["amount"]})
-
-                    # user_ids.append(action["user_id"])
-
-                    global_info["task_queue"].pop(
-                        defend_index)  # Remove this task
-
-                    include_siege_camp = True
-                else:
-                    defend_index += 1
-
-            # Add all garrison to the defend army
-            for unit in target_land["garrison"]:
-                defender_army.append({"unit": unit, "amount": unit["amount"]})
-
-            if include_siege_camp:
-                # Add all siege camp to the attack army
-                for unit in target_land["siegeCamp"]:
-                    attacker_army.append(
-                        {"unit": unit, "amount": unit["amount"]})
-
-            attack_index = 0
-
-            # Check for all other attack commands done to this target place and put them into an array
-            while attack_index < len(global_info["task_queue"]):
-                action = global_info["task_queue"][attack_index]
-
-                if action["target_land_id"] == task["target_land_id"] and action["task"] == "attack":
-                    user = user_info[str(action["user_id"])]
-                    land = lands.get(str(action["location_id"]), "")
-                    # target_land = lands.get(str(action["target_land_id"]), "")
-
-                    unit = await get_unit(land["siegeCamp"], action["item"], action["user_id"])
-
-                    # Fail if that troop isn't in that land or if there aren't as many as specified
-                    if unit == "" or unit["amount"] < action["amount"]:
-                        unit = await get_unit(land["garrison"], action["item"], action["user_id"])
-                        if unit == "" or unit["amount"] < action["amount"]:
-                            await dm(action["user_id"], f'You don\'t have enough {action["item"]} from {land["name"]} to send on an attack against {target_land["name"]}.')
-                            global_info["task_queue"].pop(
-                                attack_index)  # Remove this task
-                            continue
-                    # Fail if the siege camp has already been included in the battle
-                    elif include_siege_camp and action["location_id"] == action["target_land_id"]:
-                        global_info["task_queue"].pop(
-                            attack_index)  # Remove this task
-                        continue
-
-                    # Fail if the target land is yours
-                    if target_land["owner_id"] == action["user_id"]:
-                        await dm(action["user_id"], 'You can\'t attack yourself.')
-                        global_info["task_queue"].pop(
-                            attack_index)  # Remove this task
-                        continue
-
-                    allies = await get_allies(action["user_id"])
-
-                    # Fail if the target is the liege or vassal of your liege or your vassal
-                    if str(target_land["owner_id"]) in allies:
-                        await dm(action["user_id"], f'You can\'t attack {client.get_user(int(target_land["owner_id"]))} for one of the following reasons: they are your liege, fellow vassal, your vassal, your ally, or a vassal of your ally.')
-                        global_info["task_queue"].pop(
-                            attack_index)  # Remove this task
-                        continue
-
-                    # Fail if the your land is already surrounded
-                    if await is_surrounded(land) and land != target_land:
-                        await dm(task["user_id"], f'You cannot move {task["item"]} out of {land["name"]} because it is fully surrounded.')
-                        global_info["task_queue"].pop(
-                            attack_index)  # Remove this task
-                        continue
-
-                    # Add the troops to the attacker army
-                    attacker_army.append(
-                        {"unit": unit, "amount": action["amount"]})
-
-                    # user_ids.append(action["user_id"])
-
-                    global_info["task_queue"].pop(
-                        attack_index)  # Remove this task
+        # Add the troops to the attacker army
+        attacker_army.append(
+            {"unit": unit, "amount": action["amount"]})
 
-                else:
-                    attack_index += 1
+        # user_ids.append(action["user_id"])
 
-            # Get the list of people to alert
-            for unit in attacker_army:
-                user_ids.append(unit["unit"]["user_id"])
-            for unit in defender_army:
-                user_ids.append(unit["unit"]["user_id"])
-
-            total_defenders = await get_total_troops(defender_army)
-            total_attackers = await get_total_troops(attacker_army)
-            # Only resolve combat if there are defenders and attackers
-            if total_defenders > 0 and total_attackers > 0:
-                # Resolve the combat
-                message = await resolve_battle(attacker_army, defender_army, target_land)
-            else:
-                message = f'There were not enough troops for a battle at {target_land["name"]}.'
+    # Get the list of people to alert
+    for unit in attacker_army:
+        user_ids.append(unit["unit"]["user_id"])
+    for unit in defender_army:
+        user_ids.append(unit["unit"]["user_id"])
 
-            # If the defender army is empty then transfer the land to the attacking side (and add this to the message)
-            total_defenders = await get_total_troops(defender_army)
-            total_attackers = await get_total_troops(attacker_army)
+    return {"task": task, "user_ids": user_ids, "attacker_army": attacker_army, "defender_army": defender_army,
+            "target_land": target_land, "fortified": True}
 
-            if total_defenders <= 0 and total_attackers > 0:
-                troops_by_user = {}
-                highest_user_id = 0
 
-                # Find the person with the most troops currently left in the attacking army
-                for unit in attacker_army:
-                    troops_by_user[unit["unit"]["user_id"]] = troops_by_user.get(
-                        unit["unit"]["user_id"], 0) + unit["unit"]["amount"]
+async def conclude_siege_battles(ctx, battles):
+    user_info = ctx.user_info
 
-                for user_id, number in troops_by_user.items():
-                    if troops_by_user.get(highest_user_id, 0) < number:
-                        highest_user_id = user_id
+    await fight_battles(battles)
 
-                # Destroy buildings accordingly
-                total_destroy_percent = 0
-                total_troops = 0
+    for battle in battles:
+        task = battle["task"]
+        user_ids = battle["user_ids"]
+        attacker_army = battle["attacker_army"]
+        defender_army = battle["defender_army"]
+        target_land = battle["target_land"]
+        message = battle["message"]
 
-                # Get the average percent building destruction
-                for company in attacker_army:
-                    troop = await get_troop(company["unit"]["troop_name"])
-                    species = await get_species(troop["species"])
+        # If the defender army is empty then transfer the land to the attacking side (and add this to the message)
+        total_defenders = await get_total_troops(defender_army)
+        total_attackers = await get_total_troops(attacker_army)
 
-                    total_destroy_percent += species["percentBuildingsDestroyedOnConquest"] * company["amount"]
-                    total_troops += company["amount"]
+        if total_defenders <= 0 and total_attackers > 0:
+            troops_by_user = {}
+            highest_user_id = 0
 
-                total_buildings_destroyed = int(
-                    round(len(target_land["buildings"]) * (total_destroy_percent/total_troops)))
+            # Find the person with the most troops currently left in the attacking army
+            for unit in attacker_army:
+                troops_by_user[unit["unit"]["user_id"]] = troops_by_user.get(
+                    unit["unit"]["user_id"], 0) + unit["unit"]["amount"]
 
-                for x in range(total_buildings_destroyed):
+            for user_id, number in troops_by_user.items():
+                if troops_by_user.get(highest_user_id, 0) < number:
+                    highest_user_id = user_id
 
-                    building_name = target_land["buildings"].pop(random.randint(
-                        0, len(target_land["buildings"])-1))
+            # Destroy buildings accordingly
+            total_destroy_percent = 0
+            total_troops = 0
 
-                    building = await get_building(building_name)
+            # Get the average percent building destruction
+            for company in attacker_army:
+                troop = await get_troop(company["unit"]["troop_name"])
+                species = await get_species(troop["species"])
 
-                    # Add the lower tier building if necessary
-                    if building["demolishedTo"] != "":
-                        target_land["buildings"].append(
-                            building["demolishedTo"])
+                total_destroy_percent += species["percentBuildingsDestroyedOnConquest"] * company["amount"]
+                total_troops += company["amount"]
 
-                # Change the land owner
-                if highest_user_id != 0:
-                    user_info[str(target_land["owner_id"])]["land_ids"].remove(
-                        task["target_land_id"])
-                    target_land["owner_id"] = int(highest_user_id)
-                    user_info[str(target_land["owner_id"])]["land_ids"].append(
-                        task["target_land_id"])
-                    message += f'\n\n{target_land["name"]} has been taken by {client.get_user(int(target_land["owner_id"]))}.'
+            total_buildings_destroyed = int(
+                round(len(target_land["buildings"]) * (total_destroy_percent/total_troops)))
 
-                message += f'\n{total_buildings_destroyed} buildings were burned.'
+            for x in range(total_buildings_destroyed):
 
-                # Move the siege camp troops into the garrison
-                target_land["garrison"] = deepcopy(target_land["siegeCamp"])
-                target_land["siegeCamp"] = []
+                building_name = target_land["buildings"].pop(rng.randint("conquest",
+                    0, len(target_land["buildings"])-1))
 
-            # DM the results to all the combatants
-            for user_id in user_ids:
-                await dm(user_id, message)
-        else:
-            index += 1
+                building = await get_building(building_name)
 
-    index = 0
+                # Add the lower tier building if necessary
+                if building["demolishedTo"] != "":
+                    target_land["buildings"].append(
+                        building["demolishedTo"])
 
-    # Execute each field battle, including sallyout commands and siege camp.
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
+            # Change the land owner
+            if highest_user_id != 0:
+                user_info[str(target_land["owner_id"])]["land_ids"].remove(
+                    task["target_land_id"])
+                target_land["owner_id"] = int(highest_user_id)
+                user_info[str(target_land["owner_id"])]["land_ids"].append(
+                    task["target_land_id"])
+                message += f'\n\n{target_land["name"]} has been taken by {client.get_user(int(target_land["owner_id"]))}.'
 
-        if task["task"] == "sallyout":
-            user_ids = []
-            attacker_army = []
-            defender_army = []
+            message += f'\n{total_buildings_destroyed} buildings were burned.'
 
-            attack_index = 0
-            
-            target_land = lands.get(str(task["target_land_id"]), "")
-
-            while attack_index < len(global_info["task_queue"]):
-                action = global_info["task_queue"][attack_index]
-                if action["target_land_id"] == task["target_land_id"] and action["task"] == "sallyout":
-                    land = lands.get(str(action["location_id"]), "")
-
-                    unit = await get_unit(land["siegeCamp"], action["item"], action["user_id"])
-
-                    # Fail if that troop isn't in that land or if there aren't as many as specified
-                    if unit == "" or unit["amount"] < action["amount"]:
-                        unit = await get_unit(land["garrison"], action["item"], action["user_id"])
-                        if unit == "" or unit["amount"] < action["amount"]:
-                            await dm(action["user_id"], f'You don\'t have enough {action["item"]} from {land["name"]} to send on an attack at {target_land["name"]}.')
-                            global_info["task_queue"].pop(
-                                attack_index)  # Remove this task
-                            continue
-
-                    # Fail if the your land is already surrounded
-                    if await is_surrounded(land) and action["location_id"] != action["target_land_id"]:
-                        await dm(task["user_id"], f'You cannot move {action["item"]} out of {land["name"]} because it is fully surrounded.')
-                        global_info["task_queue"].pop(
-                            attack_index)  # Remove this task
-                        continue
-
-                    # Add the troops to the defender army
-                    attacker_army.append(
-                        {"unit": unit, "amount": action["amount"]})
-
-                    user_ids.append(action["user_id"])
-
-                    global_info["task_queue"].pop(
-                        attack_index)  # Remove this task
-                else:
-                    attack_index += 1
+            # Move the siege camp troops into the garrison
+            target_land["garrison"] = deepcopy(target_land["siegeCamp"])
+            target_land["siegeCamp"] = []
 
-            # Add all siege camp to the attack army
-            for unit in target_land["siegeCamp"]:
-                defender_army.append(
-                    {"unit": unit, "amount": unit["amount"]})
+        # DM the results to all the combatants
+        for user_id in user_ids:
+            await ctx.dm(user_id, message)
 
-            total_defenders = await get_total_troops(defender_army)
-            total_attackers = await get_total_troops(attacker_army)
 
-            # Only resolve combat if there are defenders and attackers
-            if total_defenders > 0 and total_attackers > 0:
-                # Resolve the combat
-                message = await resolve_battle(attacker_army, defender_army)
-            else:
-                message = f'There were not enough troops for a battle at {target_land["name"]}.'
+@tick.phase("field_battles")
+async def execute_field_battles(ctx):
+    task_queue = ctx.task_queue
 
-            # DM the results to all the combatants
-            for user_id in user_ids:
-                await dm(user_id, message)
-        else:
-            index += 1
+    # Fought in waves of battles that don't share any lands, like the siege battles
+    wave = []
+    wave_lands = set()
 
-    index = 0
+    # Execute each field battle, including sallyout commands and siege camp.
+    for task_id, task in task_queue.of_type("sallyout"):
+        # Skip sallyouts that already took part in an earlier battle at the same land
+        if task_id not in task_queue:
+            continue
 
-    # Execute all move commands.
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
+        battle_lands = await get_battle_lands(task_queue, task["target_land_id"], ["sallyout"])
+        if battle_lands & wave_lands:
+            await conclude_field_battles(ctx, wave)
+            wave = []
+            wave_lands = set()
 
-        if task["task"] == "move":
-            user = user_info[str(task["user_id"])]
-            land = lands.get(str(task["location_id"]), "")
-            target_land = lands.get(str(task["target_land_id"]), "")
-            unit = await get_unit(land["siegeCamp"], task["item"], task["user_id"])
-            army = land["siegeCamp"]
+        wave.append(await gather_field_battle(ctx, task))
+        wave_lands |= battle_lands
 
-            # Fail if that troop isn't in that land or if there aren't as many as specified
-            if unit == "" or unit["amount"] < task["amount"]:
-                unit = await get_unit(land["garrison"], task["item"], task["user_id"])
-                army = land["garrison"]
-                if unit == "" or unit["amount"] < task["amount"]:
-                    await dm(task["user_id"], f'You don\'t have enough {task["item"]} from {land["name"]} to send to the garrison of {target_land["name"]}.')
-                    global_info["task_queue"].pop(index)  # Remove this task
-                    continue
-                # Fail if they are both the same land
-                elif task["location_id"] == task["target_land_id"]:
-                    await dm(task["user_id"], 'The developers stopped you from taking a useless action.')
-                    global_info["task_queue"].pop(index)  # Remove this task
-                    continue
+    await conclude_field_battles(ctx, wave)
 
-            allies = await get_allies(task["user_id"])
 
-            # Fail if the target land isn't yours or one of your allies
-            if target_land["owner_id"] != task["user_id"] and str(target_land["owner_id"]) not in allies:
-                await dm(task["user_id"], f'You can\'t move {task["item"]} into {client.get_user(int(target_land["owner_id"]))}\'s settlement {target_land["name"]} for one of the following reasons: they are not your liege, fellow vassal, your vassal, your ally, or a vassal of your ally.')
-                global_info["task_queue"].pop(index)  # Remove this task
-                continue
+async def gather_field_battle(ctx, task):
+    lands = ctx.lands
+    task_queue = ctx.task_queue
 
-            # Fail if the your land is already surrounded
-            if await is_surrounded(land):
-                await dm(task["user_id"], f'You cannot move {task["item"]} out of {land["name"]} because it is fully surrounded.')
-                global_info["task_queue"].pop(index)  # Remove this task
-                continue
+    user_ids = []
+    attacker_army = []
+    defender_army = []
+
+    target_land = lands.get(str(task["target_land_id"]), "")
+
+    for action_id, action in task_queue.targeting("sallyout", task["target_land_id"]):
+        land = lands.get(str(action["location_id"]), "")
 
-            # Fail if the target land is already surrounded unless taking troops out of the siege camp
-            if await is_surrounded(target_land) and army != land["siegeCamp"]:
-                await dm(task["user_id"], f'You cannot move {task["item"]} into the garrison of {target_land["name"]} because it is fully surrounded.')
-                global_info["task_queue"].pop(index)  # Remove this task
+        # Every sallyout command for this land is used up by this battle
+        task_queue.remove(action_id)
+
+        unit = await get_unit(land["siegeCamp"], action["item"], action["user_id"])
+
+        # Fail if that troop isn't in that land or if there aren't as many as specified
+        if unit == "" or unit["amount"] < action["amount"]:
+            unit = await get_unit(land["garrison"], action["item"], action["user_id"])
+            if unit == "" or unit["amount"] < action["amount"]:
+                await ctx.dm(action["user_id"], f'You don\'t have enough {action["item"]} from {land["name"]} to send on an attack at {target_land["name"]}.')
                 continue
 
-            # Remove the troops from the original land
-            moved_unit = await remove_unit(army, unit, task["amount"])
+        # Fail if the your land is already surrounded
+        if await is_surrounded(action["location_id"], land) and action["location_id"] != action["target_land_id"]:
+            await ctx.dm(task["user_id"], f'You cannot move {action["item"]} out of {land["name"]} because it is fully surrounded.')
+            continue
 
-            # Add them to the garrison on the target land
-            await add_unit(target_land["garrison"], moved_unit)
+        # Add the troops to the defender army
+        attacker_army.append(
+            {"unit": unit, "amount": action["amount"]})
 
-            # DM the results to the player
-            await dm(task["user_id"], f'{task["amount"]} {task["item"]}s were sent to {target_land["name"]}\'s garrison.')
+        user_ids.append(action["user_id"])
 
-            global_info["task_queue"].pop(index)  # Remove this task
-        else:
-            index += 1
+    # Add all siege camp to the attack army
+    for unit in target_land["siegeCamp"]:
+        defender_army.append(
+            {"unit": unit, "amount": unit["amount"]})
 
-    index = 0
+    # Field battles are fought outside the walls, so the land's buildings don't help
+    return {"task": task, "user_ids": user_ids, "attacker_army": attacker_army, "defender_army": defender_army,
+            "target_land": target_land, "fortified": False}
 
-    # Execute all upgrade commands in the following order: Tier 4 upgrades → Tier 3 upgrades → Tier 2 upgrades → Hire upgrades
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
-
-        if task["task"] == "upgrade":
-            top_tier = 1
-
-            # Get the top tier upgrade troop
-            for action in global_info["task_queue"]:
-                if action["task"] == "upgrade":
-                    troop = await get_troop(action["item"])
-
-                    if troop["tier"] > top_tier:
-                        top_tier = troop["tier"]
-
-            # Execute all the upgrade commands going from top to bottom tiers
-            while top_tier > 0:
-                troop_index = 0
-                while troop_index < len(global_info["task_queue"]):
-                    action = global_info["task_queue"][troop_index]
-                    troop = await get_troop(action["item"])
-
-                    if action["task"] == "upgrade" and troop["tier"] == top_tier:
-                        user = user_info[str(action["user_id"])]
-                        land = lands.get(str(action["location_id"]), "")
-                        # Fail if the specified land doesn't belong to that player
-                        if action["location_id"] not in user["land_ids"]:
-                            await dm(action["user_id"], f'You cannot upgrade {action["item"]} at {land["name"]} because that land doesn\'t belong to you.')
-                            global_info["task_queue"].pop(
-                                troop_index)  # Remove this task
-                            continue
-
-                        unit = await get_unit(land["garrison"], action["item"], action["user_id"])
-
-                        # Fail if that troop isn't in that land or if there aren't as many as specified
-                        if unit == "" or unit["amount"] < action["amount"]:
-                            await dm(action["user_id"], f'You don\'t have enough {action["item"]} to upgrade {action["amount"]} of them.')
-                            global_info["task_queue"].pop(
-                                troop_index)  # Remove this task
-                            continue
-
-                        new_troop = await get_troop(troop["upgradesTo"])
-                        cost = new_troop["cost"] * action["amount"]
-
-                        # Fail if not enough money
-                        if int(user["quackerinos"]) < cost:
-                            await dm(action["user_id"], f'You don\'t have enough quackerinos to upgrade {action["amount"]} {action["item"]}s.')
-                            global_info["task_queue"].pop(
-                                troop_index)  # Remove this task
-                            continue
-
-                        # Remove the money
-                        user["quackerinos"] -= cost
-
-                        # Remove the troops from the garrison
-                        await remove_unit(land["garrison"], unit, action["amount"])
-
-                        # Add the upgraded troop to the garrison
-                        new_unit = {"troop_name": troop["upgradesTo"], "amount": action["amount"], "user_id": action["user_id"]}
-                        await add_unit(land["garrison"], new_unit)
-
-                        # DM the results to the player
-                        await dm(action["user_id"], f'{action["amount"]} {action["item"]}s were upgraded to {troop["upgradesTo"]}s at {land["name"]}\'s garrison.')
-
-                        global_info["task_queue"].pop(
-                            troop_index)  # Remove this task
 
-                    else:
-                        troop_index += 1
-                top_tier -= 1
-        else:
-            index += 1
+async def conclude_field_battles(ctx, battles):
+    await fight_battles(battles)
 
-    index = 0
+    # DM the results to all the combatants
+    for battle in battles:
+        for user_id in battle["user_ids"]:
+            await ctx.dm(user_id, battle["message"])
 
-    # Execute all hire commands
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
 
-        if task["task"] == "hire":
-            user = user_info[str(task["user_id"])]
-            troop = await get_troop(task["item"])
-            land = lands.get(str(task["location_id"]), "")
-            species = await get_species(troop["species"])
+@tick.phase("moves")
+async def execute_moves(ctx):
+    lands = ctx.lands
+    task_queue = ctx.task_queue
 
-            # Fail if the specified land doesn't belong to that player
-            if task["location_id"] not in user["land_ids"]:
-                await dm(task["user_id"], f'You cannot hire {action["item"]} at {land["name"]} because that land doesn\'t belong to you.')
-                global_info["task_queue"].pop(index)  # Remove this task
+    # Execute all move commands.
+    for task_id, task in task_queue.of_type("move"):
+        land = lands.get(str(task["location_id"]), "")
+        target_land = lands.get(str(task["target_land_id"]), "")
+        unit = await get_unit(land["siegeCamp"], task["item"], task["user_id"])
+        army = land["siegeCamp"]
+
+        # The task is done one way or another
+        task_queue.remove(task_id)
+
+        # Fail if that troop isn't in that land or if there aren't as many as specified
+        if unit == "" or unit["amount"] < task["amount"]:
+            unit = await get_unit(land["garrison"], task["item"], task["user_id"])
+            army = land["garrison"]
+            if unit == "" or unit["amount"] < task["amount"]:
+                await ctx.dm(task["user_id"], f'You don\'t have enough {task["item"]} from {land["name"]} to send to the garrison of {target_land["name"]}.')
+                continue
+            # Fail if they are both the same land
+            elif task["location_id"] == task["target_land_id"]:
+                await ctx.dm(task["user_id"], 'The developers stopped you from taking a useless action.')
                 continue
 
-            # Get the amount that the land quality decreases by
-            troop_counter = 0
-            land_quality_penalty = 0
-            quality_penalty_probability = species["qualityPenaltyProbabilityPerTroop"]
+        allies = await get_allies(task["user_id"])
 
-            while troop_counter < task["amount"] and quality_penalty_probability > 0:
-                if not bool(troop["requiresSpeciesMatch"]):
-                    break
+        # Fail if the target land isn't yours or one of your allies
+        if target_land["owner_id"] != task["user_id"] and str(target_land["owner_id"]) not in allies:
+            await ctx.dm(task["user_id"], f'You can\'t move {task["item"]} into {client.get_user(int(target_land["owner_id"]))}\'s settlement {target_land["name"]} for one of the following reasons: they are not your liege, fellow vassal, your vassal, your ally, or a vassal of your ally.')
+            continue
 
-                if random.random() < quality_penalty_probability:
-                    land_quality_penalty += 1
+        # Fail if the your land is already surrounded
+        if await is_surrounded(task["location_id"], land):
+            await ctx.dm(task["user_id"], f'You cannot move {task["item"]} out of {land["name"]} because it is fully surrounded.')
+            continue
 
-                if land_quality_penalty >= land["quality"]:
-                    task["amount"] = troop_counter
-                    break
+        # Fail if the target land is already surrounded unless taking troops out of the siege camp
+        if await is_surrounded(task["target_land_id"], target_land) and army != land["siegeCamp"]:
+            await ctx.dm(task["user_id"], f'You cannot move {task["item"]} into the garrison of {target_land["name"]} because it is fully surrounded.')
+            continue
 
-                troop_counter += 1
+        # Remove the troops from the original land
+        moved_unit = await remove_unit(army, unit, task["amount"])
+
+        # Add them to the garrison on the target land
+        await add_unit(target_land["garrison"], moved_unit)
+
+        # DM the results to the player
+        await ctx.dm(task["user_id"], f'{task["amount"]} {task["item"]}s were sent to {target_land["name"]}\'s garrison.')
+
+
+@tick.phase("upgrades")
+async def execute_upgrades(ctx):
+    user_info = ctx.user_info
+    lands = ctx.lands
+    task_queue = ctx.task_queue
+
+    # Execute all upgrade commands in the following order: Tier 4 upgrades → Tier 3 upgrades → Tier 2 upgrades → Hire upgrades
+    upgrades_by_tier = {}
+
+    for task_id, task in task_queue.of_type("upgrade"):
+        troop = await get_troop(task["item"])
+        upgrades_by_tier.setdefault(troop["tier"], []).append((task_id, task, troop))
+
+    # Execute all the upgrade commands going from top to bottom tiers
+    for tier in sorted(upgrades_by_tier, reverse=True):
+        for action_id, action, troop in upgrades_by_tier[tier]:
+            user = user_info[str(action["user_id"])]
+            land = lands.get(str(action["location_id"]), "")
+
+            # The task is done one way or another
+            task_queue.remove(action_id)
+
+            # Fail if the specified land doesn't belong to that player
+            if action["location_id"] not in user["land_ids"]:
+                await ctx.dm(action["user_id"], f'You cannot upgrade {action["item"]} at {land["name"]} because that land doesn\'t belong to you.')
+                continue
+
+            unit = await get_unit(land["garrison"], action["item"], action["user_id"])
+
+            # Fail if that troop isn't in that land or if there aren't as many as specified
+            if unit == "" or unit["amount"] < action["amount"]:
+                await ctx.dm(action["user_id"], f'You don\'t have enough {action["item"]} to upgrade {action["amount"]} of them.')
+                continue
 
-            cost = troop["cost"] * task["amount"]
+            new_troop = await get_troop(troop["upgradesTo"])
+            cost = new_troop["cost"] * action["amount"]
 
             # Fail if not enough money
             if int(user["quackerinos"]) < cost:
-                await dm(task["user_id"], f'You don\'t have enough quackerinos to upgrade {action["amount"]} {action["item"]}s.')
-                global_info["task_queue"].pop(index)  # Remove this task
+                await ctx.dm(action["user_id"], f'You don\'t have enough quackerinos to upgrade {action["amount"]} {action["item"]}s.')
                 continue
 
             # Remove the money
             user["quackerinos"] -= cost
 
-            # Remove the land quality
-            land["quality"] -= land_quality_penalty
+            # Remove the troops from the garrison
+            await remove_unit(land["garrison"], unit, action["amount"])
 
-            # Add the troops to the garrison
-            new_unit = {"troop_name": task["item"], "amount": task["amount"], "user_id": task["user_id"]}
+            # Add the upgraded troop to the garrison
+            new_unit = {"troop_name": troop["upgradesTo"], "amount": action["amount"], "user_id": action["user_id"]}
             await add_unit(land["garrison"], new_unit)
 
             # DM the results to the player
-            await dm(task["user_id"], f'You hired {task["amount"]} {task["item"]}s at {land["name"]}\'s garrison.')
+            await ctx.dm(action["user_id"], f'{action["amount"]} {action["item"]}s were upgraded to {troop["upgradesTo"]}s at {land["name"]}\'s garrison.')
 
-            global_info["task_queue"].pop(index)  # Remove this task
-        else:
-            index += 1
 
-    index = 0
+@tick.phase("hires")
+async def execute_hires(ctx):
+    user_info = ctx.user_info
+    lands = ctx.lands
+    task_queue = ctx.task_queue
 
-    # Execute all build commands
-    while index < len(global_info["task_queue"]):
-        task = global_info["task_queue"][index]
+    # Execute all hire commands
+    for task_id, task in task_queue.of_type("hire"):
+        user = user_info[str(task["user_id"])]
+        troop = await get_troop(task["item"])
+        land = lands.get(str(task["location_id"]), "")
+        species = await get_species(troop["species"])
 
-        if task["task"] == "build":
-            user = user_info[str(task["user_id"])]
-            land = lands.get(str(task["location_id"]), "")
-            building = await get_building(task["item"])
+        # The task is done one way or another
+        task_queue.remove(task_id)
 
-            # Fail if the specified land doesn't belong to that player
-            if task["location_id"] not in user["land_ids"]:
-                await dm(task["user_id"], f'You cannot build {task["item"]} because {land["name"]} doesn\'t belong to you.')
-                global_info["task_queue"].pop(index)  # Remove this task
-                continue
+        # Fail if the specified land doesn't belong to that player
+        if task["location_id"] not in user["land_ids"]:
+            await ctx.dm(task["user_id"], f'You cannot hire {task["item"]} at {land["name"]} because that land doesn\'t belong to you.')
+            continue
 
-            # Fail if the building has already been built on that land
-            if task["item"] in land["buildings"]:
-                await dm(task["user_id"], f'{task["item"]} has already been built at {land["name"]}.')
-                global_info["task_queue"].pop(index)  # Remove this task
-                continue
+        # Get the amount that the land quality decreases by. Every troop costs a point with the same probability
+        # and hiring stops at the troop that would take the land's last point.
+        land_quality_penalty = 0
+        quality_penalty_probability = species["qualityPenaltyProbabilityPerTroop"]
 
-            # Fail if the building has to be upgraded to and is missing their requirement
-            if bool(building["fromUpgradeOnly"]):
-                requirement = False
-                for building_x_name in land["buildings"]:
-                    building_x = await get_building(building_x_name)
-                    if building_x["upgradesTo"] == task["item"]:
-                        requirement = True
+        if task["amount"] > 0 and quality_penalty_probability > 0 and bool(troop["requiresSpeciesMatch"]):
+            if land["quality"] <= 0:
+                # Nothing left to lose: the first troop still rolls, but none are hired
+                if rng.random("hires") < quality_penalty_probability:
+                    land_quality_penalty += 1
+                task["amount"] = 0
+            else:
+                # Jump from one troop that costs a point straight to the next instead of rolling for each
+                troop_counter = 0
+                while True:
+                    troop_counter += rng.geometric("hires", quality_penalty_probability)
+                    if troop_counter > task["amount"]:
                         break
-                if not requirement:
-                    await dm(task["user_id"], f'{task["item"]} needs to be built at {land["name"]} by upgrading a lower tier one.')
-                    global_info["task_queue"].pop(index)  # Remove this task
-                    continue
 
-            # Fail if there is an upper tier building of this already
-            upgradesTo = deepcopy(building["upgradesTo"])
-            skip = False
-            while upgradesTo != "":
-                if upgradesTo in land["buildings"]:
-                    await dm(task["user_id"], f'There is already an upper tier equivalent of {task["item"]} at {land["name"]}.')
-                    global_info["task_queue"].pop(index)  # Remove this task
-                    skip = True
+                    land_quality_penalty += 1
+
+                    if land_quality_penalty >= land["quality"]:
+                        task["amount"] = troop_counter - 1
+                        break
+
+        cost = troop["cost"] * task["amount"]
+
+        # Fail if not enough money
+        if int(user["quackerinos"]) < cost:
+            await ctx.dm(task["user_id"], f'You don\'t have enough quackerinos to hire {task["amount"]} {task["item"]}s.')
+            continue
+
+        # Remove the money
+        user["quackerinos"] -= cost
+
+        # Remove the land quality
+        land["quality"] -= land_quality_penalty
+
+        # Add the troops to the garrison
+        new_unit = {"troop_name": task["item"], "amount": task["amount"], "user_id": task["user_id"]}
+        await add_unit(land["garrison"], new_unit)
+
+        # DM the results to the player
+        await ctx.dm(task["user_id"], f'You hired {task["amount"]} {task["item"]}s at {land["name"]}\'s garrison.')
+
+
+@tick.phase("builds")
+async def execute_builds(ctx):
+    user_info = ctx.user_info
+    global_info = ctx.global_info
+    lands = ctx.lands
+    task_queue = ctx.task_queue
+
+    # Execute all build commands
+    for task_id, task in task_queue.of_type("build"):
+        user = user_info[str(task["user_id"])]
+        land = lands.get(str(task["location_id"]), "")
+        building = await get_building(task["item"])
+
+        # Fail if the specified land doesn't belong to that player
+        if task["location_id"] not in user["land_ids"]:
+            await ctx.dm(task["user_id"], f'You cannot build {task["item"]} because {land["name"]} doesn\'t belong to you.')
+            task_queue.remove(task_id)  # Remove this task
+            continue
+
+        # Fail if the building has already been built on that land
+        if task["item"] in land["buildings"]:
+            await ctx.dm(task["user_id"], f'{task["item"]} has already been built at {land["name"]}.')
+            task_queue.remove(task_id)  # Remove this task
+            continue
+
+        # Fail if the building has to be upgraded to and is missing their requirement
+        if bool(building["fromUpgradeOnly"]):
+            requirement = False
+            for building_x_name in land["buildings"]:
+                building_x = await get_building(building_x_name)
+                if building_x["upgradesTo"] == task["item"]:
+                    requirement = True
                     break
-                else:
-                    next_building = await get_building(upgradesTo)
-                    upgradesTo = deepcopy(next_building["upgradesTo"])
-            if skip:
+            if not requirement:
+                await ctx.dm(task["user_id"], f'{task["item"]} needs to be built at {land["name"]} by upgrading a lower tier one.')
+                task_queue.remove(task_id)  # Remove this task
                 continue
 
-            # Only make the user pay at the beginning of the construction
-            if task["time"] == building["constructionTime"]:
-                cost = building["cost"]
+        # Fail if there is an upper tier building of this already
+        upgradesTo = deepcopy(building["upgradesTo"])
+        skip = False
+        while upgradesTo != "":
+            if upgradesTo in land["buildings"]:
+                await ctx.dm(task["user_id"], f'There is already an upper tier equivalent of {task["item"]} at {land["name"]}.')
+                task_queue.remove(task_id)  # Remove this task
+                skip = True
+                break
+            else:
+                next_building = await get_building(upgradesTo)
+                upgradesTo = deepcopy(next_building["upgradesTo"])
+        if skip:
+            continue
 
-                # Fail if not enough money
-                if int(user["quackerinos"]) < cost:
-                    await dm(task["user_id"], f'You don\'t have enough quackerinos to build {task["item"]} at {land["name"]}.')
-                    global_info["task_queue"].pop(index)  # Remove this task
-                    continue
+        # Only make the user pay at the beginning of the construction
+        if task["time"] == building["constructionTime"]:
+            cost = building["cost"]
 
-                # Remove the money
-                user["quackerinos"] -= cost
+            # Fail if not enough money
+            if int(user["quackerinos"]) < cost:
+                await ctx.dm(task["user_id"], f'You don\'t have enough quackerinos to build {task["item"]} at {land["name"]}.')
+                task_queue.remove(task_id)  # Remove this task
+                continue
 
-                await dm(task["user_id"], f'The labourers have started building {task["item"]} at {land["name"]}, costing {cost}')
+            # Remove the money
+            user["quackerinos"] -= cost
 
-            task["time"] -= 1
+            await ctx.dm(task["user_id"], f'The labourers have started building {task["item"]} at {land["name"]}, costing {cost}')
 
-            if task["time"] <= 0:
-                # Build the new building
-                land["buildings"].append(task["item"])
+        task["time"] -= 1
 
-                # Destroy the lower tier one if applicable
-                if bool(building["fromUpgradeOnly"]):
-                    for building_x_name in land["buildings"]:
-                        building_x = await get_building(building_x_name)
-                        if building_x["upgradesTo"] == task["item"]:
-                            land["buildings"].remove(building_x_name)
-                            break
+        if task["time"] <= 0:
+            # Build the new building
+            land["buildings"].append(task["item"])
 
-                await dm(task["user_id"], f'{task["item"]} has been built at {land["name"]}.')
-                global_info["task_queue"].pop(index)  # Remove this task
-            else:
-                index += 1
-        else:
-            index += 1
+            # Destroy the lower tier one if applicable
+            if bool(building["fromUpgradeOnly"]):
+                for building_x_name in land["buildings"]:
+                    building_x = await get_building(building_x_name)
+                    if building_x["upgradesTo"] == task["item"]:
+                        land["buildings"].remove(building_x_name)
+                        break
+
+            await ctx.dm(task["user_id"], f'{task["item"]} has been built at {land["name"]}.')
+            task_queue.remove(task_id)  # Remove this task
 
-    index = 0
-    
     # Remove all stale commands that aren't build commands
-    while index < len(global_info["task_queue"]):
-        if task["task"] != "build":
-            global_info["task_queue"].pop(index)
-        else:
-            index += 1
+    global_info["task_queue"] = [task for task_id, task in task_queue.of_type("build")]
+
 
+@tick.phase("land_quality")
+async def update_land_quality(ctx):
+    lands = ctx.lands
 
     # Update the quality of all the lands
     for land_id, land in lands.items():
@@ -820,8 +865,13 @@ async def dailyReset():
 
         land["maxQuality"] = maxQuality
 
+
+@tick.phase("calendar")
+async def advance_calendar(ctx):
+    global_info = ctx.global_info
+
     # Randomize the q-qq exchange rate
-    global_info["qqExchangeRate"] = random.randint(int(
+    global_info["qqExchangeRate"] = rng.randint("exchange", int(
         global_info["qqExchangeRateRange"][0]), int(global_info["qqExchangeRateRange"][1]))
 
     # Add to the day counter and cycle the season accordingly
@@ -830,30 +880,25 @@ async def dailyReset():
 
     global_info["first_attack"] = False
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
 
-    with open("./data/global_info.json", "w") as file:
-        json.dump(global_info, file, indent=4)
-
-    with open("./data/lands.json", "w") as file:
-        json.dump(lands, file, indent=4)
+@tick.phase("new_day", group="announcements")
+async def announce_new_day(ctx):
+    user_info = ctx.user_info
+    global_info = ctx.global_info
 
     newday_message = f'A new day has arrived and the ducks feel refreshed from their slumber. The current season is: {global_info["current_season"]}'
-    
+
     # Tell all users with daily reminder on about the update
     for user_id, user in user_info.items():
         if bool(user["daily_reminder"]):
-            await dm(user_id, newday_message)
-    
-    # Tell all specified channels about the update
-            
-    with open("./data/server_info.json", "r") as file:
-        server_info = json.load(file)
-    
-    for server_id, server in server_info.items():
-        for channel_id in server["daily_channels"]:
+            await ctx.dm(user_id, newday_message)
+
+    # Tell all specified channels about the update. The world lock is released by now, so /dailychannel
+    # can change server_info while the messages are being sent.
+    server_info = ctx.server_info
+
+    for server_id, server in list(server_info.items()):
+        for channel_id in list(server["daily_channels"]):
             try:
                 await client.get_channel(channel_id).send(newday_message)
             except:
@@ -861,6 +906,37 @@ async def dailyReset():
                 print()
 
 
+@tasks.loop(time=[datetime.time(hour=12, minute=0, tzinfo=datetime.timezone.utc)])
+#@tasks.loop(hours=1)
+async def dailyReset():
+    print('Daily reset occurring')
+    with open("./data/bot_status.txt", "r") as file:
+        randomresponses = file.readlines()
+        response = rng.choice("flavour", randomresponses)
+    await client.change_presence(activity=discord.CustomActivity(name=response, emoji='🦆'))
+    # Requires that you do the following for this to work: pip install discord.py>=2.3.2
+
+    async with state.transaction(exclusive=True, op="daily_reset"):
+        # Every tick starts the random streams over, so it can be replayed from the seed and the day
+        rng.reseed(state["global_info"]["day_counter"])
+        ctx = TickContext(state.documents)
+        with sieges.suspended():
+            await tick.run(ctx)
+
+    # Announce the new day after releasing the world lock so commands can run again.
+    # Everything is committed, so the merged DMs go out even if an announcement fails.
+    try:
+        await tick.run(ctx, group="announcements")
+    finally:
+        start = time.perf_counter()
+        queued = ctx.dms_queued
+        sent = await ctx.outbox.flush(dm)
+
+    print(tick.report(ctx))
+    print(f'  sent {queued} DMs as {sent} messages in {time.perf_counter() - start:.3f}s')
+    print(f'  random seed {rng.seed}, day {rng.day}, epoch {rng.epoch}')
+
+
 @client.event
 async def on_ready():
     await client.tree.sync()
@@ -870,191 +946,174 @@ async def on_ready():
 
 @client.tree.command(name="quack", description="Get your quack in for today.")
 async def quack(interaction: discord.Interaction):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    user_info = state["user_info"]
+    global_info = state["global_info"]
 
     user_id = interaction.user.id
     username = client.get_user(user_id)
 
-    try:
-        user = user_info[str(user_id)]
+    async with transaction(users=[user_id], op="quack"):
+        try:
+            user = user_info[str(user_id)]
 
-        if not bool(user["quackedToday"]):
-            user["quackedToday"] = True
-            user["quacks"] += 1
-            user["quackStreak"] += 1
-
-            if user["species"] == "penguin":
-                message = f'{username}: noot noot!'
-            # elif user_id == 712336169270116403:
-            #     message = f'{username} did not deserve to quack today.'
-            else:
-                message = f'{username} quacked loudly.'
+            if not bool(user["quackedToday"]):
+                user["quackedToday"] = True
+                user["quacks"] += 1
+                user["quackStreak"] += 1
 
-            if user["quackStreak"] >= global_info["maxQuackStreakLength"]:
-                user["quackStreak"] -= global_info["maxQuackStreakLength"]
-                user["quacks"] += global_info["quackStreakReward"]
-                message += f'\n{username} finished a streak and got an extra {global_info["quackStreakReward"]} quacks.'
-        else:
-            message = f'{username} tried to quack but their throat is too sore today.'
-    except:
-        new_user = deepcopy(user_info["default"])
-        user_info[user_id] = new_user
-        message = f'{username} quacked for the first time!'
+                if user["species"] == "penguin":
+                    message = f'{username}: noot noot!'
+                # elif user_id == 712336169270116403:
+                #     message = f'{username} did not deserve to quack today.'
+                else:
+                    message = f'{username} quacked loudly.'
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+                if user["quackStreak"] >= global_info["maxQuackStreakLength"]:
+                    user["quackStreak"] -= global_info["maxQuackStreakLength"]
+                    user["quacks"] += global_info["quackStreakReward"]
+                    message += f'\n{username} finished a streak and got an extra {global_info["quackStreakReward"]} quacks.'
+            else:
+                message = f'{username} tried to quack but their throat is too sore today.'
+        except:
+            new_user = deepcopy(user_info["default"])
+            user_info[str(user_id)] = new_user
+            message = f'{username} quacked for the first time!'
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="pay", description="Give a player some quackerinos.")
 async def pay(interaction: discord.Interaction, target_user_id: str, number: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-        if user == target:
-            await reply(interaction, "You can't give quackerinos to yourself.")
+    async with transaction(users=[user_id, target_user_id], op="pay") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
             return
-        elif target_user_id == "default":
-            await reply(interaction, "You can't give quackerinos to the default user.")
-            return
-
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
 
-    # Make sure the player can't give negative quackerinos
-    if number < 1:
-        await reply(interaction, "Nice try.")
-        return
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+            if user == target:
+                later(reply, interaction, "You can't give quackerinos to yourself.")
+                return
+            elif target_user_id == "default":
+                later(reply, interaction, "You can't give quackerinos to the default user.")
+                return
+
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-    # Make sure the player can't give more quackerinos than they have
-    try:
-        if int(user["quackerinos"]) < number:
-            await reply(interaction, "You don't have enough quackerinos for that.")
+        # Make sure the player can't give negative quackerinos
+        if number < 1:
+            later(reply, interaction, "Nice try.")
             return
-    except:
-        await reply(interaction, "You don't have enough quackerinos for that.")
-        return
 
-    # Give the other player quackerinos, but check if they have the quackerinos attribute yet
-    target["quackerinos"] = target.get("quackerinos", 0) + number
-    user["quackerinos"] -= number
+        # Make sure the player can't give more quackerinos than they have
+        try:
+            if int(user["quackerinos"]) < number:
+                later(reply, interaction, "You don't have enough quackerinos for that.")
+                return
+        except:
+            later(reply, interaction, "You don't have enough quackerinos for that.")
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        # Give the other player quackerinos, but check if they have the quackerinos attribute yet
+        target["quackerinos"] = target.get("quackerinos", 0) + number
+        user["quackerinos"] -= number
 
     await reply(interaction, f'You transferred {number} quackerinos to {client.get_user(int(target_user_id))}. They now have {target["quackerinos"]} qq and you now have {user["quackerinos"]} qq.')
 
 
 @client.tree.command(name="buyqq", description="Trade in some of your quacks for quackerinos.")
 async def buy_qq(interaction: discord.Interaction, quacks: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    user_info = state["user_info"]
+    global_info = state["global_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the player has enough quacks
-    if int(user["quacks"]) - int(user["spentQuacks"]) < quacks:
-        await reply(interaction, "You don't have enough quacks for that.")
-        return
+    async with transaction(users=[user_id], op="buyqq") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    user["spentQuacks"] += quacks
-    result = int(global_info["qqExchangeRate"]) * quacks
-    user["quackerinos"] = user.get("quackerinos", 0) + result
+        # Make sure the player has enough quacks
+        if int(user["quacks"]) - int(user["spentQuacks"]) < quacks:
+            later(reply, interaction, "You don't have enough quacks for that.")
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        user["spentQuacks"] += quacks
+        result = int(global_info["qqExchangeRate"]) * quacks
+        user["quackerinos"] = user.get("quackerinos", 0) + result
 
-    message = f'You bought {result} quackerinos using {quacks} quacks. You now have {user["quackerinos"]} qq and {user["quacks"]-user["spentQuacks"]} unspent quacks.'
+        message = f'You bought {result} quackerinos using {quacks} quacks. You now have {user["quackerinos"]} qq and {user["quacks"]-user["spentQuacks"]} unspent quacks.'
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="qqrate", description="Check the current quacks-quackerino exchange rate.")
 async def qq_rate(interaction: discord.Interaction):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     await reply(interaction, f'Currently 1 quack can buy {global_info["qqExchangeRate"]} quackerinos.')
 
 
-@client.tree.command(name="quackery", description="Check out who are the top quackers.")
-async def quackery(interaction: discord.Interaction, number: int = 10):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+@client.tree.command(name="quackery", description="Check out who are the top quackers (boards: quacks, quackerinos, lands, renown).")
+async def quackery(interaction: discord.Interaction, number: int = 10, board: str = "quacks", page: int = 1):
+    user_info = state["user_info"]
 
-    top_list = "__**Top Quackers (:ballot_box_with_check: = quacked today)**__"
+    board = board.lower()
+    if board not in BOARDS:
+        await reply(interaction, f'That board doesn\'t exist. Try one of: {", ".join(BOARDS)}.')
+        return
 
-    for x in range(number):
-        user_id = await get_max_quacks(user_info)
+    if number < 1 or number > 50:
+        await reply(interaction, 'You can show between 1 and 50 quackers at a time.')
+        return
 
-        if user_id == 0:
-            break
+    if page < 1:
+        await reply(interaction, 'Nice try.')
+        return
 
-        top_list += f'\n{client.get_user(int(user_id))} ({user_id}) --- {user_info[str(user_id)]["quacks"]}'
+    leaderboard = leaderboards[board]
 
-        if bool(user_info[str(user_id)]["quackedToday"]):
-            top_list += f' :ballot_box_with_check:'
-        
-        user_info.pop(str(user_id))
+    if board == "quacks":
+        top_list = "__**Top Quackers (:ballot_box_with_check: = quacked today)**__"
+    else:
+        top_list = f'__**Top Quackers by {board} (:ballot_box_with_check: = quacked today)**__'
 
-    await reply(interaction, top_list)
+    entries = leaderboard.top(number, (page - 1) * number)
+    if entries == [] and page > 1:
+        await reply(interaction, f'There are only {len(leaderboard)} quackers on this board.')
+        return
 
+    for rank, user_id, score in entries:
+        top_list += f'\n{rank}. {client.get_user(int(user_id))} ({user_id}) --- {score}'
 
-# Return user id of the user with the most quacks
-async def get_max_quacks(users):
-    quacks = 0
-    top_user_id = 0
-
-    # Find the userId with the max quacks
-    for userId, user in users.items():
-        if userId == "default":
-            continue
+        if bool(user_info[user_id]["quackedToday"]):
+            top_list += f' :ballot_box_with_check:'
 
-        if int(user["quacks"]) > quacks:
-            quacks = int(user["quacks"])
-            top_user_id = int(userId)
+    # Show the caller where they stand if they aren't on this page
+    user_rank = leaderboard.rank(interaction.user.id)
+    if user_rank is not None and not any(rank == user_rank for rank, _, _ in entries):
+        top_list += f'\n\nYou are #{user_rank} of {len(leaderboard)} with {leaderboard.scores[str(interaction.user.id)]}.'
 
-    return top_user_id
+    await reply(interaction, top_list)
 
 
 @client.tree.command(name="quackinfo", description="Check out the quack info of a user.")
 async def quack_info(interaction: discord.Interaction, user_id: str = ""):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    user_info = state["user_info"]
+    global_info = state["global_info"]
 
     if user_id == "":
         user_id = interaction.user.id
@@ -1107,12 +1166,11 @@ async def quack_info(interaction: discord.Interaction, user_id: str = ""):
         if user["taxPerVassalLand"] > 0:
             message += f'\nTax per vassal land: {user["taxPerVassalLand"]}'
 
-        for target_id, target in user_info.items():
-            if target["liege_id"] == user_id:
-                if not has_vassals:
-                    has_vassals = True
-                    message += f'\nVassals: '
-                message += f'{client.get_user(int(target_id))}, '
+        for target_id in sorted(relations.vassals.get(str(user_id), ()), key=int):
+            if not has_vassals:
+                has_vassals = True
+                message += f'\nVassals: '
+            message += f'{client.get_user(int(target_id))}, '
         message = message.rstrip()
         message = message.rstrip(",")
 
@@ -1141,19 +1199,59 @@ async def quack_info(interaction: discord.Interaction, user_id: str = ""):
                 for unit in land["siegeCamp"]:
                     message += f'\n• {unit["amount"]} {unit["troop_name"]} ({client.get_user(int(unit["user_id"]))})'
 
+        # Lands of other players where this user has troops
+        stationed = [land_id for land_id in land_index.occupied_by(user_id) if int(land_id) not in user["land_ids"]]
+        if stationed:
+            message += f'\n\nTroops stationed at: '
+            for land_id in stationed:
+                land = await get_land(land_id)
+                message += f'{land["name"]} (ID:{land_id}), '
+            message = message.rstrip()
+            message = message.rstrip(",")
+
     except:
         message = 'Error while fetching user information.'
 
     await reply(interaction, message)
 
 
+@client.tree.command(name="myarmy", description="Check out where all your troops are.")
+async def my_army(interaction: discord.Interaction):
+    user_info = state["user_info"]
+
+    user_id = interaction.user.id
+
+    # Make sure this player exists in user_info
+    if str(user_id) not in user_info:
+        await reply(interaction, "You have not quacked yet.")
+        return
+
+    units = land_index.units_of(user_id)
+    if units == []:
+        await reply(interaction, "You don't have any troops.")
+        return
+
+    message = f'__**Your Army ({land_index.total_of(user_id)} troops)**__'
+
+    last_land_id = None
+    for land_id, camp, troop_name, amount in units:
+        if land_id != last_land_id:
+            land = await get_land(land_id)
+            message += f'\n\n**{land["name"]} (ID:{land_id})** - {client.get_user(int(land["owner_id"]))}'
+            last_land_id = land_id
+
+        if camp == "garrison":
+            message += f'\n• {amount} {troop_name}'
+        else:
+            message += f'\n• {amount} {troop_name} (siege camp)'
+
+    await reply(interaction, message)
+
+
 @client.tree.command(name="rawquackinfo", description="Check out the raw quack info of a user.")
 async def raw_quack_info(interaction: discord.Interaction, user_id: str = ""):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    user_info = state["user_info"]
+    global_info = state["global_info"]
 
     if user_id == "":
         user_id = interaction.user.id
@@ -1184,13 +1282,12 @@ async def land_info(interaction: discord.Interaction, land_id: int = 0, land_nam
 
     # Fail if land id is wrong/empty and land name is wrong/empty
     if land == "":
-        land = await get_land_by_name(land_name)
+        land_id = await get_land_id_by_name(land_name)
+        land = await get_land(land_id)
         if land == "":
             await reply(interaction, "Land not found.")
             return
 
-    land_id = await get_land_id(land)
-
     # Display the land info
     message = f'**{land["name"]} (ID: {land_id}) - {land["species"]}**'
     message += f'\nOwner: {client.get_user(int(land["owner_id"]))} (ID: {land["owner_id"]})'
@@ -1210,8 +1307,7 @@ async def land_info(interaction: discord.Interaction, land_id: int = 0, land_nam
 
 @client.tree.command(name="taskqueue", description="Check out the task queue.")
 async def view_task_queue(interaction: discord.Interaction):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     message = f'__**Task Queue**__'
 
@@ -1238,8 +1334,7 @@ async def view_task_queue(interaction: discord.Interaction):
 
 @client.tree.command(name="help", description="See the guide.")
 async def help(interaction: discord.Interaction):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     message = global_info["help_message"]
 
@@ -1248,75 +1343,70 @@ async def help(interaction: discord.Interaction):
 
 @client.tree.command(name="mischief", description=">:)")
 async def mischief(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
     username = client.get_user(user_id)
     
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-    
-    # Fail if the user's species isn't mischievous
-    species = await get_species(user["species"])
+    async with transaction(users=[user_id, target_user_id], op="mischief") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    if not bool(species["mischief"]):
-        await reply(interaction, "I don't know what command you are referring to.")
-        return
-    
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-        target_username = client.get_user(int(target_user_id))
-        if user == target:
-            await reply(interaction, "You can't do that to yourself.")
+        # Fail if the user's species isn't mischievous
+        species = await get_species(user["species"])
+
+        if not bool(species["mischief"]):
+            later(reply, interaction, "I don't know what command you are referring to.")
             return
-        elif target_user_id == "default":
-            await reply(interaction, "You can't do that to the default user.")
+
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+            target_username = client.get_user(int(target_user_id))
+            if user == target:
+                later(reply, interaction, "You can't do that to yourself.")
+                return
+            elif target_user_id == "default":
+                later(reply, interaction, "You can't do that to the default user.")
+                return
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
             return
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
-    
-    # Fail if the user has already done mischief today
-    if bool(user["mischief"]):
-        await reply(interaction, "Woah there. That's enough mischief for one day.")
-        return
-    
-    #Fail if the target has no qq left
-    if target["quackerinos"] <= 0:
-        await reply(interaction, f'You couldn\'t find any quackerinos on {target_username} so you beat them up instead.')
-        await dm(target_user_id, 'You got beaten up by the raccoon :/')
-        return
-    
-    #Steal 1qq from the target
-    target["quackerinos"] -= 1
-    user["quackerinos"] += 1
-    user["mischief"] = True
 
-    #Send a random message
-    with open("./data/mischief.txt", "r") as file:
-        randomresponses = file.readlines()
-        response = random.choice(randomresponses)
-    
-    await dm(target_user_id, response)
-    
-    message = f'You helped lighten {target_username}\'s purse by 1qq.'
+        # Fail if the user has already done mischief today
+        if bool(user["mischief"]):
+            later(reply, interaction, "Woah there. That's enough mischief for one day.")
+            return
+
+        #Fail if the target has no qq left
+        if target["quackerinos"] <= 0:
+            later(reply, interaction, f'You couldn\'t find any quackerinos on {target_username} so you beat them up instead.')
+            later(dm, target_user_id, 'You got beaten up by the raccoon :/')
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        #Steal 1qq from the target
+        target["quackerinos"] -= 1
+        user["quackerinos"] += 1
+        user["mischief"] = True
+
+        #Send a random message
+        with open("./data/mischief.txt", "r") as file:
+            randomresponses = file.readlines()
+            response = rng.choice("flavour", randomresponses)
+
+        later(dm, target_user_id, response)
+
+        message = f'You helped lighten {target_username}\'s purse by 1qq.'
 
     await reply(interaction, message)
 
 
 async def get_quack_rank(quacks):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     quack_rank = ""
 
@@ -1328,8 +1418,7 @@ async def get_quack_rank(quacks):
 
 
 async def get_next_quack_rank(quack_rank):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     next_quack_rank = ""
 
@@ -1348,98 +1437,81 @@ async def get_next_quack_rank(quack_rank):
 
 @client.tree.command(name="homeland", description="Establish a new homeland for you and your people.")
 async def establish_homeland(interaction: discord.Interaction, name: str, species_name: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    user_info = state["user_info"]
+    global_info = state["global_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
+    async with transaction(users=[user_id], fields={"global_info": ["landCounter"]}, op="homeland") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Make sure the species exists and is enabled
-    species = await get_species(species_name)
-    if species != "":
-        if not bool(species["enabled"]) and user_id != 693257736867020870:
-            await reply(interaction, "This species is not enabled.")
+        # Make sure the species exists and is enabled
+        species = await get_species(species_name)
+        if species != "":
+            if not bool(species["enabled"]) and user_id != 693257736867020870:
+                later(reply, interaction, "This species is not enabled.")
+                return
+        else:
+            later(reply, interaction, "Species not found.")
             return
-    else:
-        await reply(interaction, "Species not found.")
-        return
 
-    # Make sure this player hasn't made a homeland already
-    if user.get("homeland_id", -1) >= 0:
-        await reply(interaction, "You already have a homeland.")
-        return
-    
-    #Make sure this player can't make a homeland if they have already chosen a species without a homeland
-    if user["species"] != "":
-        await reply(interaction, "You have already chosen a species without a homeland.")
-        return
-    
-    #If this player chooses a mischief species don't let them have a homeland
-    if bool(species["mischief"]):
-        #If not sprout then fail
-        if user_id != 693257736867020870:
-            await reply(interaction, "I don't know which species you are talking about.")
+        # Make sure this player hasn't made a homeland already
+        if user.get("homeland_id", -1) >= 0:
+            later(reply, interaction, "You already have a homeland.")
             return
 
-        user["species"] = species_name
-        
-        # Save to database
-        with open("./data/user_info.json", "w") as file:
-            json.dump(user_info, file, indent=4)
+        #Make sure this player can't make a homeland if they have already chosen a species without a homeland
+        if user["species"] != "":
+            later(reply, interaction, "You have already chosen a species without a homeland.")
+            return
 
-        await reply(interaction, "You try to establish a homeland, but you realize that the joys in life come from mischievous adventures in others' homelands. You have chosen the path of the raccoon.")
-        return
+        #If this player chooses a mischief species don't let them have a homeland
+        if bool(species["mischief"]):
+            #If not sprout then fail
+            if user_id != 693257736867020870:
+                later(reply, interaction, "I don't know which species you are talking about.")
+                return
 
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+            user["species"] = species_name
 
-    # Create the new land
-    try:
-        new_land = deepcopy(lands["default"])
-        new_land["name"] = name
-        new_land["owner_id"] = user_id
-        new_land["species"] = species_name
-        new_land_id = global_info["landCounter"] + 1
+            later(reply, interaction, "You try to establish a homeland, but you realize that the joys in life come from mischievous adventures in others' homelands. You have chosen the path of the raccoon.")
+            return
 
-        lands[new_land_id] = new_land
+        lands = state["lands"]
 
-        user["homeland_id"] = new_land_id
-        user["species"] = species_name
-        user["land_ids"] = [new_land_id]
+        # Create the new land
+        try:
+            new_land = deepcopy(lands["default"])
+            new_land["name"] = name
+            new_land["owner_id"] = user_id
+            new_land["species"] = species_name
+            new_land_id = global_info["landCounter"] + 1
 
-        global_info["landCounter"] += 1
-        message = 'New land created'
+            lands[str(new_land_id)] = new_land
 
-        # Save to database
-        with open("./data/user_info.json", "w") as file:
-            json.dump(user_info, file, indent=4)
+            user["homeland_id"] = new_land_id
+            user["species"] = species_name
+            user["land_ids"] = [new_land_id]
 
-        # Save to database
-        with open("./data/global_info.json", "w") as file:
-            json.dump(global_info, file, indent=4)
+            global_info["landCounter"] += 1
+            message = 'New land created'
 
-        # Save to database
-        with open("./data/lands.json", "w") as file:
-            json.dump(lands, file, indent=4)
-    except:
-        message = 'There was an error trying to add the new land.'
+            # The new land didn't exist when the transaction started, so save it explicitly
+            state.mark_dirty_keys("lands", new_land_id)
+        except:
+            message = 'There was an error trying to add the new land.'
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="species", description="View all the enabled species.")
 async def list_species(interaction: discord.Interaction):
-    with open("./data/species.json", "r") as file:
-        species_list = json.load(file)
+    species_list = registry.document("species")
 
     message = f'**List of Playable Species**'
 
@@ -1452,8 +1524,7 @@ async def list_species(interaction: discord.Interaction):
 
 @client.tree.command(name="buildings", description="View all the buildings that can be built.")
 async def list_buildings(interaction: discord.Interaction):
-    with open("./data/buildings.json", "r") as file:
-        buildings = json.load(file)
+    buildings = registry.document("buildings")
 
     message = f'__**All Buildings**__'
 
@@ -1470,8 +1541,7 @@ async def list_buildings(interaction: discord.Interaction):
 
 @client.tree.command(name="troops", description="View all the troops that can be hired.")
 async def list_troops(interaction: discord.Interaction, species_name: str):
-    with open("./data/troops.json", "r") as file:
-        troops = json.load(file)
+    troops = registry.document("troops")
 
     message = f'__**All Troops**__'
 
@@ -1487,8 +1557,7 @@ async def list_troops(interaction: discord.Interaction, species_name: str):
 
 @client.tree.command(name="listlands", description="List all the lands currently in the game.")
 async def list_lands(interaction: discord.Interaction):
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+    lands = state["lands"]
 
     message = ""
 
@@ -1498,14 +1567,7 @@ async def list_lands(interaction: discord.Interaction):
 
         species = await get_species(land["species"])
         species_emoji = species.get("emoji", land["species"])
-        total_defenders = 0
-        total_attackers = 0
-
-        for unit in land["garrison"]:
-            total_defenders += unit["amount"]
-
-        for unit in land["siegeCamp"]:
-            total_attackers += unit["amount"]
+        total_defenders, total_attackers, _, _, surrounded = sieges.pressure(land_id, land)
 
         message += f'[ID: {land_id}] [{client.get_user(land["owner_id"])}] {land["name"]} - {species_emoji} | :coin: {land["quality"]}/{land["maxQuality"]}'
 
@@ -1518,7 +1580,7 @@ async def list_lands(interaction: discord.Interaction):
         if total_attackers > 0:
             message += f' | :crossed_swords: {total_attackers}'
 
-        if await is_surrounded(land):
+        if surrounded:
             message += f' | :triangular_flag_on_post:'
         
         message += f'\n'
@@ -1526,10 +1588,109 @@ async def list_lands(interaction: discord.Interaction):
     await reply(interaction, message)
 
 
+@client.tree.command(name="simulate", description="Preview the odds of a battle, e.g. attackers: 50 Duck Militia, 20 Duck Guard.")
+async def simulate_command(interaction: discord.Interaction, attackers: str, defenders: str = "", target_land_id: int = 0, trials: int = 10000):
+    global simulations_pending
+    land = ""
+
+    attack_army = await parse_army(attackers)
+    if attack_army == "":
+        await reply(interaction, f'Write the attackers as amounts (at most {SIMULATE_MAX_AMOUNT} of each troop) and troop names, e.g. 50 Duck Militia, 20 Duck Guard.')
+        return
+
+    # Fail if the target land doesn't exist
+    if target_land_id != 0:
+        land = await get_land(target_land_id)
+        if land == "":
+            await reply(interaction, 'That land doesn\'t exist.')
+            return
+
+    # The defenders default to the garrison of the target land
+    if defenders != "":
+        defend_army = await parse_army(defenders)
+    elif land != "":
+        defend_army = [{"unit": unit, "amount": unit["amount"]} for unit in land["garrison"]]
+    else:
+        defend_army = ""
+
+    if defend_army == "":
+        await reply(interaction, f'Write the defenders as amounts (at most {SIMULATE_MAX_AMOUNT} of each troop) and troop names, or give the ID of the land to attack.')
+        return
+
+    if trials < 1 or trials > 100000:
+        await reply(interaction, 'You can run between 1 and 100000 simulations.')
+        return
+
+    total_attackers = await get_total_troops(attack_army)
+    total_defenders = await get_total_troops(defend_army)
+    if total_attackers <= 0 or total_defenders <= 0:
+        await reply(interaction, 'There need to be both attackers and defenders for a battle.')
+        return
+
+    attack_stats = army_stats(await compile_army(attack_army, attacker=True))
+    defend_stats = army_stats(await compile_army(defend_army))
+
+    # Every ATK point is a die, so the cost of a battle grows with the ATK of both sides
+    if attack_stats.total_atk() > SIMULATE_MAX_ATK or defend_stats.total_atk() > SIMULATE_MAX_ATK:
+        await reply(interaction, f'Each side can have at most {SIMULATE_MAX_ATK} ATK in a simulation.')
+        return
+
+    if trials * (total_attackers + total_defenders) > SIMULATE_MAX_WORK:
+        await reply(interaction, f'That is too many simulations for armies this big, try {max(1, SIMULATE_MAX_WORK // (total_attackers + total_defenders))} or less.')
+        return
+
+    if simulations_pending >= SIMULATE_MAX_PENDING:
+        await reply(interaction, 'Too many battles are being simulated right now, try again in a bit.')
+        return
+
+    simulations_pending += 1
+    try:
+        # Thousands of battles take longer than Discord waits for a reply
+        await interaction.response.defer(thinking=True)
+
+        try:
+            result = await simulate_battle(attack_stats, defend_stats, land, trials)
+        except Exception as e:
+            print(f'Error while simulating a battle: {e}')
+
+            # A worker died, start a new pool for the next simulation
+            pool = pools.get("simulations")
+            if isinstance(e, BrokenProcessPool) and pool is not None:
+                del pools["simulations"]
+                pool.shutdown(wait=False)
+
+            await interaction.followup.send('Something went wrong while simulating that battle. Try again in a bit.')
+            return
+    finally:
+        simulations_pending -= 1
+
+    message = f'__**Battle Odds{" @ " + land["name"] if land != "" else ""}**__ ({result["trials"]} simulations)'
+    message += f'\nConquest: {100 * result["conquests"] / result["trials"]:.1f}%'
+    message += f'\nAttacker losses: {result["attacker_losses"] / result["trials"]:.1f} of {total_attackers}'
+    message += f'\nDefender losses: {result["defender_losses"] / result["trials"]:.1f} of {total_defenders}'
+    message += f'\nRounds: {result["rounds"] / result["trials"]:.1f}'
+
+    await interaction.followup.send(message)
+
+
+@client.tree.command(name="battlereport", description="See every round of one of your battles.")
+async def battle_report(interaction: discord.Interaction, battle_id: int):
+    # Fail if the battle is too old or never happened
+    if battle_reports.get(battle_id) is None:
+        await reply(interaction, 'That battle report isn\'t available anymore.')
+        return
+
+    # Fail if you didn't fight in it
+    if interaction.user.id not in battle_reports.participants(battle_id):
+        await reply(interaction, 'You can only see the reports of battles you fought in.')
+        return
+
+    await reply(interaction, battle_reports.render(battle_id))
+
+
 @client.tree.command(name="build", description="Build a new building in one of your lands (takes one month).")
 async def build(interaction: discord.Interaction, location_id: int, building_name: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -1583,72 +1744,61 @@ async def build(interaction: discord.Interaction, location_id: int, building_nam
 
 @client.tree.command(name="demolish", description="Destroy a building in one of your lands.")
 async def demolish(interaction: discord.Interaction, location_id: int, building_name: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+    user_info = state["user_info"]
+    lands = state["lands"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    building = await get_building(building_name)
-    land = lands.get(str(location_id), "")
-
-    # Fail if building doesn't exist
-    if building == "":
-        await reply(interaction, 'Building not found.')
-        return
+    async with transaction(users=[user_id], lands=[location_id], op="demolish") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Fail if the specified land doesn't exist
-    if land == "":
-        await reply(interaction, 'Land not found.')
-        return
+        building = await get_building(building_name)
+        land = lands.get(str(location_id), "")
 
-    # Fail if the specified land doesn't belong to that player
-    if location_id not in user["land_ids"]:
-        await reply(interaction, 'That land doesn\'t belong to you.')
-        return
+        # Fail if building doesn't exist
+        if building == "":
+            later(reply, interaction, 'Building not found.')
+            return
 
-    # Fail if that building has not been built on that land yet
-    if building_name not in land["buildings"]:
-        await reply(interaction, 'That building has not been built there yet.')
-        return
+        # Fail if the specified land doesn't exist
+        if land == "":
+            later(reply, interaction, 'Land not found.')
+            return
 
-    # Remove the building from that land and give the user a percent of the money
-    land["buildings"].remove(building_name)
-    refund = building["refundPercent"] * building["cost"]
-    user["quackerinos"] += refund
+        # Fail if the specified land doesn't belong to that player
+        if location_id not in user["land_ids"]:
+            later(reply, interaction, 'That land doesn\'t belong to you.')
+            return
 
-    # Add the lower tier building if necessary
-    if building["demolishedTo"] != "":
-        land["buildings"].append(building["demolishedTo"])
-        message = f'The {building_name} was demolished into a {building["demolishedTo"]} and you were refunded {refund} qq.'
-    else:
-        message = f'The {building_name} was destroyed and you were refunded {refund} qq.'
+        # Fail if that building has not been built on that land yet
+        if building_name not in land["buildings"]:
+            later(reply, interaction, 'That building has not been built there yet.')
+            return
 
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        # Remove the building from that land and give the user a percent of the money
+        land["buildings"].remove(building_name)
+        refund = building["refundPercent"] * building["cost"]
+        user["quackerinos"] += refund
 
-    with open("./data/lands.json", "w") as file:
-        json.dump(lands, file, indent=4)
+        # Add the lower tier building if necessary
+        if building["demolishedTo"] != "":
+            land["buildings"].append(building["demolishedTo"])
+            message = f'The {building_name} was demolished into a {building["demolishedTo"]} and you were refunded {refund} qq.'
+        else:
+            message = f'The {building_name} was destroyed and you were refunded {refund} qq.'
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="hire", description="Hire some troops (takes one month).")
 async def hire(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+    user_info = state["user_info"]
+    lands = state["lands"]
 
     user_id = interaction.user.id
 
@@ -1693,34 +1843,30 @@ async def hire(interaction: discord.Interaction, location_id: int, troop_name: s
         await reply(interaction, 'You cannot hire troops from a land that has zero quality.')
         return
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     current_time = datetime.datetime.now(tz=datetime.timezone.utc).time()
     daily_reset_time = current_time.replace(hour=12,minute=0,second=0,microsecond=0)
     attack_cutoff_time = current_time.replace(hour=4,minute=0,second=0,microsecond=0)
 
-    # Fail if it is too late in the day for the first attack
-    if not bool(global_info["first_attack"]) and daily_reset_time > current_time > attack_cutoff_time:
-        await reply(interaction, f'You cannot be the first to hire troops/attack someone 8 hours before the daily reset time.')
-        return
-    else:
-        if not bool(global_info["first_attack"]):
-            global_info["first_attack"] = True
-            
-            with open("./data/global_info.json", "w") as file:
-                json.dump(global_info, file, indent=4)
+    async with transaction(fields={"global_info": ["first_attack", "task_queue"]}, op="hire") as later:
+        # Fail if it is too late in the day for the first attack
+        if not bool(global_info["first_attack"]) and daily_reset_time > current_time > attack_cutoff_time:
+            later(reply, interaction, f'You cannot be the first to hire troops/attack someone 8 hours before the daily reset time.')
+            return
+        else:
+            if not bool(global_info["first_attack"]):
+                global_info["first_attack"] = True
 
-    # Add the task to the queue
-    await add_to_queue(user_id, "hire", troop_name, location_id, amount)
+        # Add the task to the queue
+        queue_task(user_id, "hire", troop_name, location_id, amount)
 
     await reply(interaction, f'You have started to hire {amount} {troop_name}s in {land["name"]}.')
 
 
 @client.tree.command(name="upgrade", description="Upgrade some troops (takes one month).")
 async def upgrade(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -1770,88 +1916,77 @@ async def upgrade(interaction: discord.Interaction, location_id: int, troop_name
 
 @client.tree.command(name="disband", description="Disband some of your troops.")
 async def disband(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+    user_info = state["user_info"]
+    lands = state["lands"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
+    async with transaction(users=[user_id], lands=[location_id], op="disband") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    troop = await get_troop(troop_name)
-    land = lands.get(str(location_id), "")
-    species = await get_species(troop["species"])
+        troop = await get_troop(troop_name)
+        land = lands.get(str(location_id), "")
+        species = await get_species(troop["species"])
 
-    # Fail if troop doesn't exist
-    if troop == "":
-        await reply(interaction, 'Troop not found.')
-        return
+        # Fail if troop doesn't exist
+        if troop == "":
+            later(reply, interaction, 'Troop not found.')
+            return
 
-    # Fail if the specified land doesn't exist
-    if land == "":
-        await reply(interaction, 'Land not found.')
-        return
+        # Fail if the specified land doesn't exist
+        if land == "":
+            later(reply, interaction, 'Land not found.')
+            return
 
-    unit = await get_unit(land["garrison"], troop_name, user_id)
+        unit = await get_unit(land["garrison"], troop_name, user_id)
 
-    # Fail if that troop isn't in that land or if there aren't as many as specified
-    if unit == "" or unit["amount"] < amount:
-        await reply(interaction, f'You don\'t have enough of that troop to disband {amount} of them.')
-        return
-    
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+        # Fail if that troop isn't in that land or if there aren't as many as specified
+        if unit == "" or unit["amount"] < amount:
+            later(reply, interaction, f'You don\'t have enough of that troop to disband {amount} of them.')
+            return
 
-    quality_gain_probability = species["qualityReplenishProbabilityPerTroop"]
-    quality_gain = 0
+        global_info = state["global_info"]
 
-    #If disbanding troops on one of your lands, with matching species, and if that species has qualityReplenishProbabilityPerTroop then replenish that land's quality
-    if location_id in user["land_ids"] and troop["species"] == land["species"] and quality_gain_probability > 0 and land["quality"] < land["maxQuality"]:
-        for x in range(amount):
-            if random.random() < quality_gain_probability:
-                quality_gain += 1
-        
-        land["quality"] += quality_gain
-        land["quality"] = min(land["maxQuality"], land["quality"])
+        quality_gain_probability = species["qualityReplenishProbabilityPerTroop"]
+        quality_gain = 0
 
-    # Remove troops from that user's land
-    unit["amount"] -= amount
+        #If disbanding troops on one of your lands, with matching species, and if that species has qualityReplenishProbabilityPerTroop then replenish that land's quality
+        if location_id in user["land_ids"] and troop["species"] == land["species"] and quality_gain_probability > 0 and land["quality"] < land["maxQuality"]:
+            # Every disbanded troop replenishes a point with the same probability
+            quality_gain = rng.binomial("disband", amount, quality_gain_probability)
 
-    if unit["amount"] == 0:
-        land["garrison"].remove(unit)
+            land["quality"] += quality_gain
+            land["quality"] = min(land["maxQuality"], land["quality"])
 
-    # Give refund to user if necessary
-    refund = troop["refundPercentOnDisband"] * troop["cost"] * amount
-    user["quackerinos"] += refund
+        # Remove troops from that user's land
+        unit["amount"] -= amount
 
-    message = f'{amount} {troop_name}s were disbanded. '
+        if unit["amount"] == 0:
+            land["garrison"].remove(unit)
 
-    if refund > 0:
-        message += f'{refund} qq were refunded to the user. '
+        # Give refund to user if necessary
+        refund = troop["refundPercentOnDisband"] * troop["cost"] * amount
+        user["quackerinos"] += refund
 
-    if quality_gain > 0:
-        message += f'{quality_gain} land quality was replenished at {land["name"]}. '
+        message = f'{amount} {troop_name}s were disbanded. '
 
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        if refund > 0:
+            message += f'{refund} qq were refunded to the user. '
 
-    with open("./data/lands.json", "w") as file:
-        json.dump(lands, file, indent=4)
+        if quality_gain > 0:
+            message += f'{quality_gain} land quality was replenished at {land["name"]}. '
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="attack", description="Launch an assault on someone's land/castle (takes one month).")
 async def attack(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int, target_land_id: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -1914,12 +2049,11 @@ async def attack(interaction: discord.Interaction, location_id: int, troop_name:
         return
 
     # Fail if the your land is already surrounded
-    if await is_surrounded(land) and land != target_land:
+    if await is_surrounded(location_id, land) and land != target_land:
         await reply(interaction, f'You cannot move troops out of {land["name"]} because it is fully surrounded.')
         return
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     troop = await get_troop(troop_name)
     species = await get_species(troop["species"])
@@ -1933,19 +2067,19 @@ async def attack(interaction: discord.Interaction, location_id: int, troop_name:
     daily_reset_time = current_time.replace(hour=12,minute=0,second=0,microsecond=0)
     attack_cutoff_time = current_time.replace(hour=4,minute=0,second=0,microsecond=0)
 
-    # Fail if it is too late in the day for the first attack
-    if not bool(global_info["first_attack"]) and daily_reset_time > current_time > attack_cutoff_time:
-        await reply(interaction, f'You cannot be the first to hire troops/attack someone 8 hours before the daily reset time.')
-        return
-    else:
-        if not bool(global_info["first_attack"]):
-            global_info["first_attack"] = True
-            
-            with open("./data/global_info.json", "w") as file:
-                json.dump(global_info, file, indent=4)
+    async with transaction(fields={"global_info": ["first_attack", "task_queue"]}, op="attack") as later:
+        # Fail if it is too late in the day for the first attack
+        if not bool(global_info["first_attack"]) and daily_reset_time > current_time > attack_cutoff_time:
+            later(reply, interaction, f'You cannot be the first to hire troops/attack someone 8 hours before the daily reset time.')
+            return
+        else:
+            if not bool(global_info["first_attack"]):
+                global_info["first_attack"] = True
+
+        # Add the task to the queue
+        queue_task(user_id, "attack", troop_name, location_id, amount, target_land=target_land_id)
 
-    # Add the task to the queue and alert the defender
-    await add_to_queue(user_id, "attack", troop_name, location_id, amount, target_land=target_land_id)
+    # Alert the defender
     await dm(target_land["owner_id"], f'{client.get_user(int(user_id))} has sent {amount} {troop_name}s to attack {target_land["name"]}!')
 
     message = f'{amount} {troop_name}s were sent to attack {target_land["name"]}.'
@@ -1955,8 +2089,7 @@ async def attack(interaction: discord.Interaction, location_id: int, troop_name:
 
 @client.tree.command(name="defend", description="Defend someone's land/castle from an incoming assault (takes one month).")
 async def defend(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int, target_land_id: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -2000,12 +2133,11 @@ async def defend(interaction: discord.Interaction, location_id: int, troop_name:
         return
 
     # Fail if the your land is already surrounded
-    if await is_surrounded(land):
+    if await is_surrounded(location_id, land):
         await reply(interaction, f'You cannot move troops out of {land["name"]} because it is fully surrounded.')
         return
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     troop = await get_troop(troop_name)
     species = await get_species(troop["species"])
@@ -2025,8 +2157,7 @@ async def defend(interaction: discord.Interaction, location_id: int, troop_name:
 
 @client.tree.command(name="siege", description="Initiate or join a siege on someone's land (takes one month).")
 async def siege(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int, target_land_id: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -2084,12 +2215,11 @@ async def siege(interaction: discord.Interaction, location_id: int, troop_name:
         return
 
     # Fail if the your land is already surrounded
-    if await is_surrounded(land):
+    if await is_surrounded(location_id, land):
         await reply(interaction, f'You cannot move troops out of {land["name"]} because it is fully surrounded.')
         return
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     troop = await get_troop(troop_name)
     species = await get_species(troop["species"])
@@ -2109,8 +2239,7 @@ async def siege(interaction: discord.Interaction, location_id: int, troop_name:
 
 @client.tree.command(name="sallyout", description="Launch an assault on a siege camp (takes one month).")
 async def sallyout(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int, target_land_id: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -2149,12 +2278,11 @@ async def sallyout(interaction: discord.Interaction, location_id: int, troop_nam
             return
 
     # Fail if the your land is already surrounded
-    if await is_surrounded(land) and land != target_land:
+    if await is_surrounded(location_id, land) and land != target_land:
         await reply(interaction, f'You cannot move troops out of {land["name"]} because it is fully surrounded.')
         return
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     troop = await get_troop(troop_name)
     species = await get_species(troop["species"])
@@ -2174,8 +2302,7 @@ async def sallyout(interaction: discord.Interaction, location_id: int, troop_nam
 
 @client.tree.command(name="move", description="Move troops to one of your or an ally's garrisons (takes one month).")
 async def move(interaction: discord.Interaction, location_id: int, troop_name: str, amount: int, target_land_id: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
@@ -2227,17 +2354,16 @@ async def move(interaction: discord.Interaction, location_id: int, troop_name: s
         return
 
     # Fail if the your land is already surrounded
-    if await is_surrounded(land):
+    if await is_surrounded(location_id, land):
         await reply(interaction, f'You cannot move troops out of {land["name"]} because it is fully surrounded.')
         return
 
     # Fail if the target land is already surrounded
-    if await is_surrounded(target_land):
+    if await is_surrounded(target_land_id, target_land):
         await reply(interaction, f'You cannot move troops into the garrrison of {target_land["name"]} because it is fully surrounded.')
         return
 
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    global_info = state["global_info"]
 
     troop = await get_troop(troop_name)
     species = await get_species(troop["species"])
@@ -2257,445 +2383,375 @@ async def move(interaction: discord.Interaction, location_id: int, troop_name: s
 
 @client.tree.command(name="support", description="Lend your support to another player to improve one of their land's income by 10%.")
 async def support(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-        if user == target:
-            await reply(interaction, "You can't give support to yourself.")
+    async with transaction(users=[user_id, target_user_id], op="support") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
             return
-        elif target_user_id == "default":
-            await reply(interaction, "You can't give support to the default user.")
-            return
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
 
-    # Make sure this user has already had a homeland
-    if user["homeland_id"] == -1:
-        await reply(interaction, "You cannot use this command without a homeland.")
-        return
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+            if user == target:
+                later(reply, interaction, "You can't give support to yourself.")
+                return
+            elif target_user_id == "default":
+                later(reply, interaction, "You can't give support to the default user.")
+                return
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-    # Make sure this user has no lands
-    if len(user["land_ids"]) > 0:
-        await reply(interaction, "You cannot use this command if you already have lands.")
-        return
+        # Make sure this user has already had a homeland
+        if user["homeland_id"] == -1:
+            later(reply, interaction, "You cannot use this command without a homeland.")
+            return
 
-    # Make sure the user hasn't supported anyone yet
-    if user["supportee_id"] == 0:
-        await reply(interaction, "You can only use this command once per day.")
-        return
+        # Make sure this user has no lands
+        if len(user["land_ids"]) > 0:
+            later(reply, interaction, "You cannot use this command if you already have lands.")
+            return
 
-    target["support"] += 1
-    user["supportee_id"] = target_user_id
+        # Make sure the user hasn't supported anyone yet
+        if user["supportee_id"] == 0:
+            later(reply, interaction, "You can only use this command once per day.")
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        target["support"] += 1
+        user["supportee_id"] = target_user_id
 
     await reply(interaction, f'You have lent your support to {client.get_user(int(target_user_id))}.')
 
 
 @client.tree.command(name="giveland", description="Give your occupied land to another player.")
 async def give_land(interaction: discord.Interaction, location_id: int, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+    user_info = state["user_info"]
+    lands = state["lands"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-        if user == target:
-            await reply(interaction, "You can't give support to yourself.")
-            return
-        elif target_user_id == "default":
-            await reply(interaction, "You can't give support to the default user.")
+    async with transaction(users=[user_id, target_user_id], lands=[location_id], op="giveland") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
             return
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
 
-    land = lands.get(str(location_id), "")
-
-    # Fail if the specified land doesn't exist
-    if land == "":
-        await reply(interaction, 'Land not found.')
-        return
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+            if user == target:
+                later(reply, interaction, "You can't give support to yourself.")
+                return
+            elif target_user_id == "default":
+                later(reply, interaction, "You can't give support to the default user.")
+                return
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-    # Fail if the specified land doesn't belong to that player
-    if location_id not in user["land_ids"]:
-        await reply(interaction, 'That land doesn\'t belong to you.')
-        return
+        land = lands.get(str(location_id), "")
 
-    # Fail if this is the user's homeland
-    if location_id == user["homeland_id"]:
-        await reply(interaction, 'You cannot give your homeland away.')
-        return
+        # Fail if the specified land doesn't exist
+        if land == "":
+            later(reply, interaction, 'Land not found.')
+            return
 
-    # Prevent this player from giving the land to someone who is in their safety period
-    if target["safety_count"] > 0:
-        await reply(interaction, "You cannot give lands to a protected user.")
-        return
+        # Fail if the specified land doesn't belong to that player
+        if location_id not in user["land_ids"]:
+            later(reply, interaction, 'That land doesn\'t belong to you.')
+            return
 
-    # Give the land to the target user
-    user["land_ids"].remove(location_id)
-    target["land_ids"].append(location_id)
-    land["owner_id"] = int(target_user_id)
+        # Fail if this is the user's homeland
+        if location_id == user["homeland_id"]:
+            later(reply, interaction, 'You cannot give your homeland away.')
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        # Prevent this player from giving the land to someone who is in their safety period
+        if target["safety_count"] > 0:
+            later(reply, interaction, "You cannot give lands to a protected user.")
+            return
 
-    with open("./data/lands.json", "w") as file:
-        json.dump(lands, file, indent=4)
+        # Give the land to the target user
+        user["land_ids"].remove(location_id)
+        target["land_ids"].append(location_id)
+        land["owner_id"] = int(target_user_id)
 
     await reply(interaction, f'You have given control of {land["name"]} to {client.get_user(int(target_user_id))}.')
 
 
 @client.tree.command(name="addally", description="Add a user to your ally list.")
 async def add_ally(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
+    async with transaction(users=[user_id], op="addally") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-        if user == target:
-            await reply(interaction, "You can't ally yourself.")
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+            if user == target:
+                later(reply, interaction, "You can't ally yourself.")
+                return
+            elif target_user_id == "default":
+                later(reply, interaction, "You can't ally with the default user.")
+                return
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
             return
-        elif target_user_id == "default":
-            await reply(interaction, "You can't ally with the default user.")
+
+        # Fail if target user already is in your ally list
+        if target_user_id in user["ally_ids"]:
+            later(reply, interaction, f'You have already allied with that person. Your ally list is: {user["ally_ids"]}')
             return
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
-
-    # Fail if target user already is in your ally list
-    if target_user_id in user["ally_ids"]:
-        await reply(interaction, f'You have already allied with that person. Your ally list is: {user["ally_ids"]}')
-        return
-
-    user["ally_ids"].append(target_user_id)
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        user["ally_ids"].append(target_user_id)
 
     await reply(interaction, f'You have added {client.get_user(int(target_user_id))} to your allylist. Your ally list is now: {user["ally_ids"]}')
 
 
 @client.tree.command(name="removeally", description="Remove a user to your ally list.")
 async def remmove_ally(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
+    async with transaction(users=[user_id], op="removeally") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Fail if target user is not in your ally list
-    if target_user_id not in user["ally_ids"]:
-        await reply(interaction, f'You aren\'t allied with that person. Your ally list is: {user["ally_ids"]}')
-        return
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-    user["ally_ids"].remove(target_user_id)
+        # Fail if target user is not in your ally list
+        if target_user_id not in user["ally_ids"]:
+            later(reply, interaction, f'You aren\'t allied with that person. Your ally list is: {user["ally_ids"]}')
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        user["ally_ids"].remove(target_user_id)
 
     await reply(interaction, f'You have removed {client.get_user(int(target_user_id))} from your allylist. Your ally list is now: {user["ally_ids"]}')
 
 
 @client.tree.command(name="declareallegiance", description="Declare your allegiance to a user.")
 async def declare_allegiance(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-        if user == target:
-            await reply(interaction, "You can't declare allegiance to yourself.")
-            return
-        elif target_user_id == "default":
-            await reply(interaction, "You can't declare allegiance to  the default user.")
+    async with transaction(users=[user_id, target_user_id], op="declareallegiance") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
             return
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
 
-    # Fail if target user already is in your ally list
-    if target_user_id == user["liege_id"]:
-        await reply(interaction, f'This user is already your liege.')
-        return
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+            if user == target:
+                later(reply, interaction, "You can't declare allegiance to yourself.")
+                return
+            elif target_user_id == "default":
+                later(reply, interaction, "You can't declare allegiance to  the default user.")
+                return
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-    # Fail if user already has a liege
-    if user["liege_id"] != 0:
-        await reply(interaction, f'You already have a liege. You must renounce your oath before declaring your allegiance to someone else.')
-        return
+        # Fail if target user already is in your ally list
+        if target_user_id == user["liege_id"]:
+            later(reply, interaction, f'This user is already your liege.')
+            return
 
-    # Fail if user already on the target user's vassal waitlist
-    if user_id in target["vassal_waitlist_ids"]:
-        await reply(interaction, f'You already are on this person\'s vassal waitlist. You must wait until they accept your allegiance.')
-        return
+        # Fail if user already has a liege
+        if user["liege_id"] != 0:
+            later(reply, interaction, f'You already have a liege. You must renounce your oath before declaring your allegiance to someone else.')
+            return
 
-    target["vassal_waitlist_ids"].append(user_id)
+        # Fail if user already on the target user's vassal waitlist
+        if user_id in target["vassal_waitlist_ids"]:
+            later(reply, interaction, f'You already are on this person\'s vassal waitlist. You must wait until they accept your allegiance.')
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        target["vassal_waitlist_ids"].append(user_id)
 
     await reply(interaction, f'You have added yourself to {client.get_user(int(target_user_id))}\'s vassal waitlist. You must wait until they accept your allegiance.')
 
 
 @client.tree.command(name="acceptallegiance", description="Accept an oath of allegiance from a user.")
 async def accept_allegiance(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
-
-    # Fail if target user has already been accepted as a vassal
-    if user_id == target["liege_id"]:
-        user["vassal_waitlist_ids"].remove(int(target_user_id))
+    async with transaction(users=[user_id, target_user_id], op="acceptallegiance") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-        # Save to database
-        with open("./data/user_info.json", "w") as file:
-            json.dump(user_info, file, indent=4)
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-        await reply(interaction, f'This user is already your vassal.')
-        return
+        # Fail if target user has already been accepted as a vassal
+        if user_id == target["liege_id"]:
+            user["vassal_waitlist_ids"].remove(int(target_user_id))
 
-    # Fail if target user already has a liege
-    if target["liege_id"] != 0:
-        user["vassal_waitlist_ids"].remove(int(target_user_id))
+            later(reply, interaction, f'This user is already your vassal.')
+            return
 
-        # Save to database
-        with open("./data/user_info.json", "w") as file:
-            json.dump(user_info, file, indent=4)
+        # Fail if target user already has a liege
+        if target["liege_id"] != 0:
+            user["vassal_waitlist_ids"].remove(int(target_user_id))
 
-        await reply(interaction, f'This user already has a liege. They must renounce your oath before declaring their allegiance to someone else.')
-        return
-    
-    user["vassal_waitlist_ids"].remove(int(target_user_id))
-    target["liege_id"] = user_id
+            later(reply, interaction, f'This user already has a liege. They must renounce your oath before declaring their allegiance to someone else.')
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        user["vassal_waitlist_ids"].remove(int(target_user_id))
+        target["liege_id"] = user_id
 
     await reply(interaction, f'You have accepted {client.get_user(int(target_user_id))}\'s oath of allegiance.')
 
 
 @client.tree.command(name="releasevassal", description="Release one of your vassals from their oath of allegiance.")
 async def release_vassal(interaction: discord.Interaction, target_user_id: str):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target = user_info[target_user_id]
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
+    async with transaction(users=[user_id, target_user_id], op="releasevassal") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Fail if target user does not have this user as their liege
-    if user_id != target["liege_id"]:
-        await reply(interaction, "Target user is not your vassal.")
-        return
+        # Make sure the target player exists in user_info
+        try:
+            target = user_info[target_user_id]
+        except:
+            later(reply, interaction, "Target has not quacked yet.")
+            return
 
-    target["liege_id"] = 0
+        # Fail if target user does not have this user as their liege
+        if user_id != target["liege_id"]:
+            later(reply, interaction, "Target user is not your vassal.")
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        target["liege_id"] = 0
 
     await reply(interaction, f'You have released {client.get_user(int(target_user_id))} from their oath of allegiance.')
 
 
 @client.tree.command(name="renounceallegiance", description="Renounce your allegiance to your liege. THERE WILL BE CONSEQUENCES.")
 async def renounce_allegiance(interaction: discord.Interaction):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the target player exists in user_info
-    try:
-        target_user_id = user["liege_id"]
-        target = user_info[str(target_user_id)]
-    except:
-        await reply(interaction, "Target has not quacked yet.")
-        return
-
-    # Fail if this user does not have a liege
-    if user["liege_id"] == 0:
-        await reply(interaction, "You don't have a liege.")
-        return
-
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
-
-    # Fail if this user doesn't have the required money to renounce allegiance
-    if user["quackerinos"] < global_info["qq_requirement_to_renounce"]:
-        await reply(interaction, f'You don\'t have the required funds ({global_info["qq_requirement_to_renounce"]}) to renounce allegiance.')
-        return
-
-    # Disband all deserting troops
-    for land_id, land in lands.items():
-        if land_id == "default":
-            continue
-
-        # Check the garrison for deserters
-        for unit in land["garrison"]:
-            user = user_info[str(unit["user_id"])]
-            troop = await get_troop(unit["troop_name"])
-            species = await get_species(troop["species"])
+    # The deserters are reported once the transaction has committed
+    outbox = Outbox()
 
-            percent_desert = species["percentDesertsOnOathbreaker"]
-            total_amount = unit["amount"]
-            num_desert = 0
-            if percent_desert > 0:
-                for x in range(unit["amount"]):
-                    if random.random() > percent_desert:
-                        num_desert += 1
-
-                unit["amount"] -= num_desert
-
-                # DM user that units have been disbanded
-                await dm(unit["user_id"], f'{num_desert}/{total_amount} of {unit["troop_name"]} have been disbanded at {land["name"]} because of your oath breaking.')
+    # Only the tick and the player's own commands move their troops, so the index can be trusted once the player
+    # is locked. Look the lands up again in case the tick moved troops before the locks were taken.
+    land_ids = await get_army_lands(user_id)
+    while True:
+        async with transaction(users=[user_id], lands=land_ids, op="renounceallegiance") as later:
+            current_land_ids = await get_army_lands(user_id)
+            if not set(current_land_ids) <= set(land_ids):
+                land_ids = current_land_ids
+                continue
 
-        # Disband empty units from the garrison
-        index = 0
-        while index < len(land["garrison"]):
-            if land["garrison"][index]["amount"] <= 0:
-                land["garrison"].pop(index)
-            else:
-                index += 1
+            # Make sure this player exists in user_info
+            try:
+                user = user_info[str(user_id)]
+            except:
+                later(reply, interaction, "You have not quacked yet.")
+                return
 
-        # Check the siegecamp for deserters
-        for unit in land["siegeCamp"]:
-            user = user_info[str(unit["user_id"])]
-            troop = await get_troop(unit["troop_name"])
-            species = await get_species(troop["species"])
+            # Make sure the target player exists in user_info
+            try:
+                target_user_id = user["liege_id"]
+                target = user_info[str(target_user_id)]
+            except:
+                later(reply, interaction, "Target has not quacked yet.")
+                return
+
+            # Fail if this user does not have a liege
+            if user["liege_id"] == 0:
+                later(reply, interaction, "You don't have a liege.")
+                return
+
+            lands = state["lands"]
+            global_info = state["global_info"]
+
+            # Fail if this user doesn't have the required money to renounce allegiance
+            if user["quackerinos"] < global_info["qq_requirement_to_renounce"]:
+                later(reply, interaction, f'You don\'t have the required funds ({global_info["qq_requirement_to_renounce"]}) to renounce allegiance.')
+                return
+
+            # Disband the deserting troops of the oathbreaker
+            for land_id, camp, troop_name, _ in land_index.units_of(user_id):
+                land = lands[land_id]
+                unit = await get_unit(land[camp], troop_name, user_id)
+                if unit == "":
+                    continue
 
-            percent_desert = species["percentDesertsOnOathbreaker"]
-            total_amount = unit["amount"]
-            num_desert = 0
-            if percent_desert > 0:
-                for x in range(unit["amount"]):
-                    if random.random() > percent_desert:
-                        num_desert += 1
+                troop = await get_troop(unit["troop_name"])
+                species = await get_species(troop["species"])
 
-                unit["amount"] -= num_desert
+                percent_desert = species["percentDesertsOnOathbreaker"]
+                total_amount = unit["amount"]
+                if percent_desert > 0:
+                    # Every troop stays with probability percent_desert, count the rest in one draw
+                    num_desert = rng.binomial("desertion", unit["amount"], 1 - percent_desert)
 
-                # DM user that units have been disbanded
-                await dm(unit["user_id"], f'{num_desert}/{unit["amount"]} of {unit["troop_name"]} have been disbanded at {land["name"]} because of your oath breaking.')
+                    unit["amount"] -= num_desert
 
-        # Disband empty units from the siegeCamp
-        index = 0
-        while index < len(land["siegeCamp"]):
-            if land["siegeCamp"][index]["amount"] <= 0:
-                land["siegeCamp"].pop(index)
-            else:
-                index += 1
+                    # DM user that units have been disbanded
+                    outbox.add(unit["user_id"], f'{num_desert}/{total_amount} of {unit["troop_name"]} have been disbanded at {land["name"]} because of your oath breaking.')
 
-    user["liege_id"] = 0
-    user["quackerinos"] -= int(user["quackerinos"] *
-                               global_info["percentPlunderedOnOathbreaker"])
+                # Disband the unit if nobody is left
+                if unit["amount"] <= 0:
+                    land[camp].remove(unit)
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+            user["liege_id"] = 0
+            user["quackerinos"] -= int(user["quackerinos"] *
+                                       global_info["percentPlunderedOnOathbreaker"])
+        break
 
-    with open("./data/lands.json", "w") as file:
-        json.dump(lands, file, indent=4)
+    await outbox.flush(dm)
 
     await reply(interaction, f'You have renounced your oath to {client.get_user(int(target_user_id))}. Half of all your troops have deserted and looted a quarter of your wealth.')
     await dm(target_user_id, f'Your vassal {client.get_user(int(user_id))} has renounced their oath to you.')
@@ -2703,36 +2759,30 @@ async def renounce_allegiance(interaction: discord.Interaction):
 
 @client.tree.command(name="setvassaltax", description="Set a flat tax rate per land for all vassals.")
 async def set_vassal_tax(interaction: discord.Interaction, amount: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
-
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    user_info = state["user_info"]
+    global_info = state["global_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Prevent the number from being lower than 0
-    if amount < 0:
-        await reply(interaction, "You cannot set a negative tax rate.")
-        return
+    async with transaction(users=[user_id], op="setvassaltax") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Prevent the number from being too high
-    if amount > global_info["maxtaxPerVassalLand"]:
-        await reply(interaction, f'You cannot set a tax rate higher than the maximum ({global_info["maxtaxPerVassalLand"]}).')
-        return
+        # Prevent the number from being lower than 0
+        if amount < 0:
+            later(reply, interaction, "You cannot set a negative tax rate.")
+            return
 
-    user["taxPerVassalLand"] = amount
+        # Prevent the number from being too high
+        if amount > global_info["maxtaxPerVassalLand"]:
+            later(reply, interaction, f'You cannot set a tax rate higher than the maximum ({global_info["maxtaxPerVassalLand"]}).')
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        user["taxPerVassalLand"] = amount
 
     await reply(interaction, f'You have set a tax rate of {amount} per land for all your vassals.')
 
@@ -2740,224 +2790,208 @@ async def set_vassal_tax(interaction: discord.Interaction, amount: int):
 
 @client.tree.command(name="flip", description="Flip a coin to double your qq bet.")
 async def flip(interaction: discord.Interaction, number: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Make sure the player can't bet negative quackerinos
-    if number < 1:
-        await reply(interaction, "Nice try.")
-        return
+    async with transaction(users=[user_id], op="flip") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Make sure the player can't bet more quackerinos than they have
-    try:
-        if int(user["quackerinos"]) < number:
-            await reply(interaction, "You don't have enough quackerinos for that.")
+        # Make sure the player can't bet negative quackerinos
+        if number < 1:
+            later(reply, interaction, "Nice try.")
             return
-    except:
-        await reply(interaction, "You don't have enough quackerinos for that.")
-        return
 
-    # Give the player quackerinos if they win the bet
-    if random.choice([True, False]):
-        user["quackerinos"] += number
-        message = f'You won {number} qq!'
-    else:
-        user["quackerinos"] -= number
-        message = f'You lost {number} qq...'
+        # Make sure the player can't bet more quackerinos than they have
+        try:
+            if int(user["quackerinos"]) < number:
+                later(reply, interaction, "You don't have enough quackerinos for that.")
+                return
+        except:
+            later(reply, interaction, "You don't have enough quackerinos for that.")
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        # Give the player quackerinos if they win the bet
+        if rng.choice("gambling", [True, False]):
+            user["quackerinos"] += number
+            message = f'You won {number} qq!'
+        else:
+            user["quackerinos"] -= number
+            message = f'You lost {number} qq...'
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="slotmachine", description="Spin the slot machine for a chance to win the jackpot!")
 async def slotmachine(interaction: discord.Interaction):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     with open("./data/slots.json", "r") as file:
         slots = json.load(file)
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-
-    # Fail if the user has no spins left
-    if user["spins"] < 1:
-        await reply(interaction, "You have no spins left. Do /buyspins to pull the slot machine some more!")
-        return
-    
-    # Get the weights for each roller
-    total_weight = 0
+    async with transaction(users=[user_id], op="slotmachine") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    all_position_ids = []
+        # Fail if the user has no spins left
+        if user["spins"] < 1:
+            later(reply, interaction, "You have no spins left. Do /buyspins to pull the slot machine some more!")
+            return
 
-    for position_id, position in slots["positions"].items():
-        total_weight += position["weight"]
-        all_position_ids.append(position_id)
-    
-    result_code = ""
+        # Get the weights for each roller
+        total_weight = 0
 
-    # Spin the slot machine
-    for x in range(slots["num_positions"]):
-        result_number = random.randint(1, total_weight)
+        all_position_ids = []
 
         for position_id, position in slots["positions"].items():
-            if result_number <= position["weight"]:
-                result_code += position_id
-                break
-            else:
-                result_number -= position["weight"]
-    
-    player_reward = {}
-    
-    # Get the reward
-    for reward_id, reward in slots["rewards"].items():
-        # Shows which position correlates to which reward id
-        position_ids = {}
+            total_weight += position["weight"]
+            all_position_ids.append(position_id)
 
-        is_match = False
+        result_code = ""
 
-        for x in range(len(reward_id)):
-            # Shows all the possible position_ids a reward id might be referring to
-            reward_position_ids = []
+        # Spin the slot machine
+        for x in range(slots["num_positions"]):
+            result_number = rng.randint("slots", 1, total_weight)
 
-            # Check if the reward id refers to a specific position id OR multiple position ids
-            if reward_id[x] not in all_position_ids:
-                reward_position_ids = slots["identifiers"][reward_id[x]]
-            else:
-                reward_position_ids = reward_id[x]
+            for position_id, position in slots["positions"].items():
+                if result_number <= position["weight"]:
+                    result_code += position_id
+                    break
+                else:
+                    result_number -= position["weight"]
 
-            # Check if the current element in the result code is referred to by the reward_id
-            if result_code[x] in reward_position_ids:
-                position_id = position_ids.get(reward_id[x], None)
+        player_reward = {}
 
-                # If that reward_id has been used already, then make sure this current element matches it
-                if position_id is None:
-                    position_ids[reward_id[x]] = result_code[x]
-                elif result_code[x] != position_id:
-                    break
+        # Get the reward
+        for reward_id, reward in slots["rewards"].items():
+            # Shows which position correlates to which reward id
+            position_ids = {}
 
-                if x+1 == len(reward_id):
-                    is_match = True
-                    break
-            else:
-                break
+            is_match = False
 
-        if is_match:
-            player_reward = reward
-            break
+            for x in range(len(reward_id)):
+                # Shows all the possible position_ids a reward id might be referring to
+                reward_position_ids = []
 
-    # Get the result code as a list of emojis
-    formatted_result_code = ""
+                # Check if the reward id refers to a specific position id OR multiple position ids
+                if reward_id[x] not in all_position_ids:
+                    reward_position_ids = slots["identifiers"][reward_id[x]]
+                else:
+                    reward_position_ids = reward_id[x]
 
-    for position_id in result_code:
-        formatted_result_code += slots["positions"][position_id].get("emoji", position_id)
+                # Check if the current element in the result code is referred to by the reward_id
+                if result_code[x] in reward_position_ids:
+                    position_id = position_ids.get(reward_id[x], None)
 
-    message = f'You got {formatted_result_code}. '
+                    # If that reward_id has been used already, then make sure this current element matches it
+                    if position_id is None:
+                        position_ids[reward_id[x]] = result_code[x]
+                    elif result_code[x] != position_id:
+                        break
 
-    if player_reward.get("quackerinos", 0) > 0 and player_reward.get("spin", 0) > 0:
-        message += f'You received {player_reward["quackerinos"]} qq and {player_reward["spin"]} free spins as a reward!'
-    elif player_reward.get("quackerinos", 0) > 0:
-        message += f'You received {player_reward["quackerinos"]} qq as a reward!'
-    elif player_reward.get("spin", 0) > 0:
-        message += f'You received {player_reward["spin"]} free spins as a reward!'
-    else:
-        message += f'You didn\'t receive any reward.'
+                    if x+1 == len(reward_id):
+                        is_match = True
+                        break
+                else:
+                    break
 
-    # Give rewards
-    user["spins"] -= 1
-    user["spins"] += player_reward.get("spin", 0)
-    user["quackerinos"] += player_reward.get("quackerinos", 0)
+            if is_match:
+                player_reward = reward
+                break
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        # Get the result code as a list of emojis
+        formatted_result_code = ""
+
+        for position_id in result_code:
+            formatted_result_code += slots["positions"][position_id].get("emoji", position_id)
+
+        message = f'You got {formatted_result_code}. '
+
+        if player_reward.get("quackerinos", 0) > 0 and player_reward.get("spin", 0) > 0:
+            message += f'You received {player_reward["quackerinos"]} qq and {player_reward["spin"]} free spins as a reward!'
+        elif player_reward.get("quackerinos", 0) > 0:
+            message += f'You received {player_reward["quackerinos"]} qq as a reward!'
+        elif player_reward.get("spin", 0) > 0:
+            message += f'You received {player_reward["spin"]} free spins as a reward!'
+        else:
+            message += f'You didn\'t receive any reward.'
+
+        # Give rewards
+        user["spins"] -= 1
+        user["spins"] += player_reward.get("spin", 0)
+        user["quackerinos"] += player_reward.get("quackerinos", 0)
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="buyspins", description="Buy spins to use on the slot machine (5qq each).")
 async def buyspins(interaction: discord.Interaction, number: int):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     with open("./data/slots.json", "r") as file:
         slots = json.load(file)
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-    
-    cost = slots["spin_cost"] * number
+    async with transaction(users=[user_id], op="buyspins") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Make sure the player can't spend more quackerinos than they have
-    try:
-        if int(user["quackerinos"]) < cost:
-            await reply(interaction, "You don't have enough quackerinos for that.")
+        cost = slots["spin_cost"] * number
+
+        # Make sure the player can't spend more quackerinos than they have
+        try:
+            if int(user["quackerinos"]) < cost:
+                later(reply, interaction, "You don't have enough quackerinos for that.")
+                return
+        except:
+            later(reply, interaction, "You don't have enough quackerinos for that.")
             return
-    except:
-        await reply(interaction, "You don't have enough quackerinos for that.")
-        return
-    
-    #Add spins to the user
-    user["spins"] += number
-    user["quackerinos"] -= cost
-    
-    message = f'You bought {number} spins for a total of {cost} qq.'
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        #Add spins to the user
+        user["spins"] += number
+        user["quackerinos"] -= cost
+
+        message = f'You bought {number} spins for a total of {cost} qq.'
 
     await reply(interaction, message)
 
 
 @client.tree.command(name="dailyreminder", description="Toggle your daily reminder (default: off).")
 async def dailyreminder(interaction: discord.Interaction):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    user_info = state["user_info"]
 
     user_id = interaction.user.id
 
-    # Make sure this player exists in user_info
-    try:
-        user = user_info[str(user_id)]
-    except:
-        await reply(interaction, "You have not quacked yet.")
-        return
-    
-    if bool(user["daily_reminder"]):
-        user["daily_reminder"] = False
-        message = f'Daily reminders are now: off'
-    else:
-        user["daily_reminder"] = True
-        message = f'Daily reminders are now: on'
+    async with transaction(users=[user_id], op="dailyreminder") as later:
+        # Make sure this player exists in user_info
+        try:
+            user = user_info[str(user_id)]
+        except:
+            later(reply, interaction, "You have not quacked yet.")
+            return
 
-    # Save to database
-    with open("./data/user_info.json", "w") as file:
-        json.dump(user_info, file, indent=4)
+        if bool(user["daily_reminder"]):
+            user["daily_reminder"] = False
+            message = f'Daily reminders are now: off'
+        else:
+            user["daily_reminder"] = True
+            message = f'Daily reminders are now: on'
 
     await reply(interaction, message)
 
@@ -2965,66 +2999,50 @@ async def dailyreminder(interaction: discord.Interaction):
 @client.tree.command(name="dailychannel", description="Manage where the daily message is sent in your server. Modes = view/set/remove")
 @commands.has_permissions(administrator=True)
 async def dailychannel(interaction: discord.Interaction, mode: str = "view", channel_id: str = None):
-    with open("./data/server_info.json", "r") as file:
-        server_info = json.load(file)
+    server_info = state["server_info"]
 
     server_id = interaction.guild_id
 
-    # Make sure this server exists in user_info
-    server = server_info.get(str(server_id), None)
+    async with transaction(documents=["server_info"], op="dailychannel"):
+        # Make sure this server exists in user_info
+        server = server_info.get(str(server_id), None)
 
-    if server == None:
-        server = {
-            "daily_channels": []
-        }
-        server_info[server_id] = server
-    
-    if mode == "view":
-        print()
-    elif mode == "set":
-        server["daily_channels"].append(int(channel_id))
-    elif mode == "remove":
-        server["daily_channels"].remove(int(channel_id))
-    
-    message = f'__**{client.get_guild(server_id)} - Daily Channels**__'
+        if server == None:
+            server = {
+                "daily_channels": []
+            }
+            server_info[str(server_id)] = server
 
-    #Give the name and id for each channel in this server
-    for channel_id in server["daily_channels"]:
-        message += f'\n{client.get_channel(channel_id)} (id:{channel_id})'
+        if mode == "view":
+            print()
+        elif mode == "set":
+            server["daily_channels"].append(int(channel_id))
+        elif mode == "remove":
+            server["daily_channels"].remove(int(channel_id))
 
-    # Save to database
-    with open("./data/server_info.json", "w") as file:
-        json.dump(server_info, file, indent=4)
+        message = f'__**{client.get_guild(server_id)} - Daily Channels**__'
+
+        #Give the name and id for each channel in this server
+        for channel_id in server["daily_channels"]:
+            message += f'\n{client.get_channel(channel_id)} (id:{channel_id})'
 
-    await reply(interaction, message)
 
+    await reply(interaction, message)
 
-async def is_surrounded(land):
-    defender_score = 0
-    sieger_score = 0
 
-    num_defenders = 0
-    num_siegers = 0
+async def get_army_lands(user_id):
+    # Every land a player has troops in or owns
+    land_ids = set(land_index.occupied_by(user_id))
 
-    # 1 troop = +1 score
-    for unit in land["garrison"]:
-        num_defenders += unit["amount"]
-    for unit in land["siegeCamp"]:
-        num_siegers += unit["amount"]
+    user = state["user_info"].get(str(user_id))
+    if user is not None:
+        land_ids.update(str(land_id) for land_id in user["land_ids"])
 
-    defender_score += num_defenders
-    sieger_score += num_siegers
+    return sorted(land_ids, key=int)
 
-    # HP and DEF bonuses of buildings increase the defender score
-    for building_name in land["buildings"]:
-        building = await get_building(building_name)
-        defender_score += min(building["maxAPbonus"], building["APbonus"] + building["APbonusPerTroop"] * num_defenders) + min(
-            building["maxHPbonus"], building["HPbonus"] + building["HPbonusPerTroop"] * num_defenders)
 
-    if sieger_score > defender_score:
-        return True
-    else:
-        return False
+async def is_surrounded(land_id, land):
+    return sieges.is_surrounded(land_id, land)
 
 
 async def remove_unit(army, unit, amount):
@@ -3049,278 +3067,219 @@ async def add_unit(army, unit, amount=-1):
 
 
 async def get_allies(user_id):
-    with open("./data/user_info.json", "r") as file:
-        user_info = json.load(file)
+    # Everyone the user is friendly with, as a set of user id strings: allies, liege,
+    # fellow vassals, vassals and vassals of allies
+    return relations.friendly(user_id)
 
-    user = user_info.get(str(user_id), "")
-    allies = user["ally_ids"]
 
-    if user["liege_id"] != 0:
-        allies.append(user["liege_id"])
+async def get_troop(troop_name):
+    return registry.troop(troop_name)
 
-    # Check every person on the user list to see if:
-    # 1) They are the vassal of the user's liege (and the user has a liege)
-    # 2) They are the vassal of the user
-    # 3) They are the vassal of one of the user's allies
-    for target_id, target in user_info.items():
-        if (user["liege_id"] != 0 and user["liege_id"] == target["liege_id"]) or target["liege_id"] == user_id or target["liege_id"] in user["ally_ids"]:
-            allies.append(target_id)
 
-    return allies
+async def get_building(building_name):
+    return registry.building(building_name)
 
 
-async def get_troop(troop_name):
-    with open("./data/troops.json", "r") as file:
-        troops = json.load(file)
+async def get_land(land_id):
+    lands = state["lands"]
 
-    try:
-        overrides = troops[troop_name]
-    except:
-        return ""
+    land = lands.get(str(land_id), "")
 
-    troop = troops.get(f'default_tier{overrides["tier"]}', {})
+    return land
 
-    # Replace the attributes with the troop specific overrides
-    for attr, value in overrides.items():
-        troop[attr] = value
 
-    return troop
+async def get_land_id_by_name(land_name):
+    land_id = land_index.id_by_name(land_name)
+    if land_id is None:
+        return -1
 
+    return land_id
 
-async def get_building(building_name):
-    with open("./data/buildings.json", "r") as file:
-        buildings = json.load(file)
 
-    try:
-        overrides = buildings[building_name]
-    except:
-        return ""
+async def get_species(species_name):
+    return registry.species(species_name, state["global_info"]["current_season"])
+
+
+async def get_season(day):
+    global_info = state["global_info"]
 
-    building = buildings.get("default", "")
+    dayx = deepcopy(day)
 
-    # Replace the attributes with the building specific overrides
-    for attr, value in overrides.items():
-        building[attr] = value
+    while True:
+        for season_name, length in global_info["seasons"].items():
+            if dayx <= length:
+                return season_name
+            else:
+                dayx -= length
 
-    return building
 
+async def get_unit(army, troop_name, user_id):
+    for unit in army:
+        if unit["troop_name"] == troop_name and str(unit["user_id"]) == str(user_id):
+            return unit
 
-async def get_land(land_id):
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+    return ""
 
-    land = lands.get(str(land_id), "")
 
-    return land
+async def get_battle_lands(task_queue, target_land_id, task_types):
+    # Every land whose troops a battle at the target land could use or change
+    battle_lands = {str(target_land_id)}
+    for task_type in task_types:
+        for action_id, action in task_queue.targeting(task_type, target_land_id):
+            battle_lands.add(str(action["location_id"]))
+    return battle_lands
 
 
-async def get_land_by_name(land_name):
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+async def fight_battles(battles):
+    # Fights battles that share no troops, in the worker processes when there is more than one,
+    # then takes the casualties out of the armies and sets the message for each battle.
+    # Every battle gets its own seed in order, so the outcome doesn't depend on which one finishes first.
+    global_info = state["global_info"]
+    fights = []
 
-    for land in lands:
-        if land["name"] == land_name:
-            return land
+    for battle in battles:
+        total_defenders = await get_total_troops(battle["defender_army"])
+        total_attackers = await get_total_troops(battle["attacker_army"])
 
-    return ""
+        # Only resolve combat if there are defenders and attackers
+        if total_defenders <= 0 or total_attackers <= 0:
+            battle["message"] = f'There were not enough troops for a battle at {battle["target_land"]["name"]}.'
+            continue
 
+        attackers = await compile_army(battle["attacker_army"], attacker=True)
+        defenders = await compile_army(battle["defender_army"])
+        fortifications = await get_fortifications(battle["target_land"] if battle["fortified"] else "")
 
-async def get_land_id(query_land):
-    with open("./data/lands.json", "r") as file:
-        lands = json.load(file)
+        fights.append((battle, (attackers, defenders, fortifications,
+                                global_info["max_casualties_attackers"], global_info["max_casualties_defenders"])))
 
-    for land_id, land in lands.items():
-        if land == query_land:
-            return land_id
+    seeds = rng.seeds("battles", len(fights))
 
-    return -1
+    if len(fights) > 1:
+        loop = asyncio.get_running_loop()
+        pool = get_pool("battles")
+        results = await asyncio.gather(*(loop.run_in_executor(pool, resolve_seeded, seed, *arguments)
+                                         for seed, (battle, arguments) in zip(seeds, fights)))
+    else:
+        results = [resolve_seeded(seed, *arguments) for seed, (battle, arguments) in zip(seeds, fights)]
 
+    for (battle, arguments), result in zip(fights, results):
+        battle["message"] = await record_battle(battle, result)
 
-async def get_species(species_name):
-    with open("./data/species.json", "r") as file:
-        species_list = json.load(file)
-    
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
 
-    try:
-        overrides = species_list[species_name]
-    except:
-        return ""
+async def record_battle(battle, result):
+    # Takes the casualties out of the armies and their units and archives the result
+    global_info = state["global_info"]
 
-    default_species = species_list.get("default", "")
-    species = {}
-    
-    #Only add the non seasonal default attributes to the species
-    for attr, value in default_species.items():
-        if attr not in ["all-season", "spring", "summer", "fall", "winter"]:
-            species[attr] = value
-    
-    # Give the species all of the default all-season attributes
-    for attr, value in default_species["all-season"].items():
-        species[attr] = value
+    await apply_casualties(battle["attacker_army"], result.attacker_amounts())
+    await apply_casualties(battle["defender_army"], result.defender_amounts())
 
-    # Override the all-season attributes with the proper season from the default species
-    for attr, value in default_species[global_info["current_season"]].items():
-        species[attr] = value
+    names = {}
+    for company in result.attackers + result.defenders:
+        if company.user_id not in names:
+            names[company.user_id] = client.get_user(int(company.user_id))
 
-    # Replace all non seasonal default attributes with species specific overrides
-    for attr, value in overrides.items():
-        if attr not in ["all-season", "spring", "summer", "fall", "winter"]:
-            species[attr] = value
+    # Players get a summary, the rounds are only rendered if they ask for them
+    battle_id = global_info.get("battle_count", 0) + 1
+    global_info["battle_count"] = battle_id
+    battle_reports.add(battle_id, result, battle["target_land"]["name"], names)
 
-    # Give the species all of the all-season attributes
-    for attr, value in overrides["all-season"].items():
-        species[attr] = value
+    return render_summary(result, battle["target_land"]["name"], names, battle_id)
 
-    # Override the all-season attributes with the proper season
-    for attr, value in overrides[global_info["current_season"]].items():
-        species[attr] = value
 
-    return species
+def get_pool(name):
+    pool = pools.get(name)
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=POOL_WORKERS[name])
+        pools[name] = pool
+    return pool
 
 
-async def get_season(day):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+async def shutdown_pools():
+    # Wait for the running battles off the event loop. Queued simulations are dropped where Python supports it (3.9+).
+    loop = asyncio.get_running_loop()
+    options = {"cancel_futures": True} if sys.version_info >= (3, 9) else {}
 
-    dayx = deepcopy(day)
+    for name in list(pools):
+        pool = pools.pop(name)
+        await loop.run_in_executor(None, partial(pool.shutdown, wait=True, **options))
 
-    while True:
-        for season_name, length in global_info["seasons"].items():
-            if dayx <= length:
-                return season_name
-            else:
-                dayx -= length
 
+async def compile_army(army_collection, attacker=False):
+    companies = []
 
-async def get_unit(army, troop_name, user_id):
-    for unit in army:
-        if unit["troop_name"] == troop_name and str(unit["user_id"]) == str(user_id):
-            return unit
+    for company in army_collection:
+        troop = await get_troop(company["unit"]["troop_name"])
+        species = await get_species(troop["species"])
 
-    return ""
+        atk = troop["ATK"] + species["bonusATKPerTroop"]
+        if attacker:
+            atk = int(atk)
 
+        companies.append(Company(company["unit"]["user_id"], company["unit"]["troop_name"], company["amount"],
+                                 atk, troop["AP"] + species["bonusDEFPerTroop"], troop["HP"] + species["bonusHPPerTroop"]))
 
-async def resolve_battle(attack_army, defend_army, land=""):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+    return companies
 
-    percent_casualties_attackers = 0
-    percent_casualties_defenders = 0
-    total_attackers = await get_total_troops(attack_army)
-    total_defenders = await get_total_troops(defend_army)
 
-    round = 0
+async def get_fortifications(land):
+    if land == "":
+        return Fortifications()
 
-    message = f'__**Battle Report @ {land.get("name")}**__'
-    message += f'\n**Round {round}**'
-    message += f'\nAttackers:'
-    message += f'{await print_army(attack_army)}'
-    message += f'\nDefenders:'
-    message += f'{await print_army(defend_army)}'
+    buildings = []
+    for building_name in land["buildings"]:
+        buildings.append(await get_building(building_name))
 
-    attacker_HP = 0
-    defender_HP = 0
+    return Fortifications(buildings)
 
-    for unit in attack_army:
-        troop = await get_troop(unit["unit"]["troop_name"])
-        species = await get_species(troop["species"])
-        attacker_HP += (troop["HP"] + species["bonusHPPerTroop"]) * unit["amount"]
 
-    for unit in defend_army:
-        troop = await get_troop(unit["unit"]["troop_name"])
-        species = await get_species(troop["species"])
-        defender_HP += (troop["HP"] + species["bonusHPPerTroop"]) * unit["amount"]
+async def parse_army(text):
+    # "50 Duck Militia, 20 Duck Guard" -> an army of companies that don't belong to anyone
+    army_collection = []
 
-    if land != "":
-        for building_name in land["buildings"]:
-            building = await get_building(building_name)
-            hpbonus = building["HPbonus"] + \
-                building["HPbonusPerTroop"] * total_defenders
-            hpbonus = min(hpbonus, building["maxHPbonus"])
-            defender_HP += hpbonus
-
-    while percent_casualties_attackers < global_info["max_casualties_attackers"] and percent_casualties_defenders < global_info["max_casualties_defenders"]:
-        updated_total_attackers = await get_total_troops(attack_army)
-        updated_total_defenders = await get_total_troops(defend_army)
-        attacker_ATK = 0
-        defender_ATK = 0
-        attacker_DEF = 0
-        defender_DEF = 0
-
-        for unit in attack_army:
-            troop = await get_troop(unit["unit"]["troop_name"])
-            species = await get_species(troop["species"])
-            attacker_ATK += int(troop["ATK"] + species["bonusATKPerTroop"]) * unit["amount"]
-            attacker_DEF += (troop["AP"] + species["bonusDEFPerTroop"]) * unit["amount"]
+    for part in text.split(","):
+        amount, _, troop_name = part.strip().partition(" ")
+        troop_name = troop_name.strip()
 
-        for unit in defend_army:
-            troop = await get_troop(unit["unit"]["troop_name"])
-            species = await get_species(troop["species"])
-            defender_ATK += (troop["ATK"] + species["bonusATKPerTroop"]) * unit["amount"]
-            defender_DEF += (troop["AP"] + species["bonusDEFPerTroop"]) * unit["amount"]
+        if not amount.isdigit() or int(amount) > SIMULATE_MAX_AMOUNT or await get_troop(troop_name) == "":
+            return ""
 
-        if land != "":
-            for building_name in land["buildings"]:
-                building = await get_building(building_name)
-                atkbonus = building["ATKbonus"] + \
-                    building["ATKbonusPerTroop"] * updated_total_defenders
-                atkbonus = min(atkbonus, building["maxATKbonus"])
-                defender_ATK += atkbonus
-                defbonus = building["APbonus"] + \
-                    building["APbonusPerTroop"] * updated_total_defenders
-                defbonus = min(defbonus, building["maxAPbonus"])
-                defender_DEF += defbonus
-
-        attacker_score = await get_battle_score(attacker_ATK)
-        defender_score = await get_battle_score(defender_ATK)
-
-        attack_spite = deepcopy(attacker_score["spite"])
-        defend_spite = deepcopy(defender_score["spite"])
-        attacker_score["spite"] -= defender_DEF + defender_HP
-        defender_score["spite"] -= attacker_DEF + attacker_HP
-        defender_HP -= attack_spite
-        defender_HP = max(0, defender_HP)
-        attacker_HP -= defend_spite
-        attacker_HP = max(0, attacker_HP)
-
-        for x in range(attacker_score["spite"]):
-            await remove_casualty(defend_army)
-        for x in range(defender_score["spite"]):
-            await remove_casualty(attack_army)
-
-        percent_casualties_attackers = 1 - await get_total_troops(attack_army) / total_attackers
-        percent_casualties_defenders = 1 - await get_total_troops(defend_army) / total_defenders
-
-        round += 1
-        message += f'\n\n\n**Round {round}**'
-        message += f'\nAttackers:'
-        message += f'{await print_army(attack_army)}'
-        message += f'\n\nDefenders:'
-        message += f'{await print_army(defend_army)}'
-
-    return message
-
-
-async def print_army(army_collection):
-    message = ""
-    for company in army_collection:
-        message += f'\n{company["amount"]} {company["unit"]["troop_name"]} ({client.get_user(int(company["unit"]["user_id"]))})'
-    return message
+        unit = {"troop_name": troop_name, "user_id": 0, "amount": int(amount)}
+        army_collection.append({"unit": unit, "amount": int(amount)})
 
+    return army_collection
 
-async def remove_casualty(army_collection):
-    try:
-        target_index = random.randint(0, len(army_collection) - 1)
-    except:
-        return
 
-    army_collection[target_index]["amount"] -= 1
-    army_collection[target_index]["unit"]["amount"] -= 1
+async def simulate_battle(attack_stats, defend_stats, land, trials):
+    # Fight the battle `trials` times without changing any troops, spread over the worker processes.
+    # Returns the summed up conquests, losses and rounds, see battle.simulate().
+    global_info = state["global_info"]
+
+    fortifications = await get_fortifications(land)
 
-    if army_collection[target_index]["amount"] <= 0:
-        army_collection.pop(target_index)
+    pool = get_pool("simulations")
+    workers = POOL_WORKERS["simulations"]
+
+    # Every chunk gets its own seed so the workers don't fight the same battles
+    loop = asyncio.get_running_loop()
+    chunks = [trials // workers + (1 if worker < trials % workers else 0) for worker in range(workers)]
+    chunks = [chunk for chunk in chunks if chunk > 0]
+    futures = [loop.run_in_executor(pool, simulate, attack_stats, defend_stats, fortifications,
+                                    global_info["max_casualties_attackers"], global_info["max_casualties_defenders"],
+                                    chunk, seed)
+               for chunk, seed in zip(chunks, rng.seeds("simulation", len(chunks)))]
+
+    return merge_simulations(await asyncio.gather(*futures))
+
+
+async def apply_casualties(army_collection, amounts):
+    for company, amount in zip(army_collection, amounts):
+        hit = company["amount"] - amount
+        company["amount"] -= hit
+        company["unit"]["amount"] -= hit
+
+    # Drop the companies that were wiped out
+    army_collection[:] = [company for company in army_collection if company["amount"] > 0]
 
 
 async def get_total_troops(army_collection):
@@ -3332,25 +3291,16 @@ async def get_total_troops(army_collection):
     return total
 
 
-async def get_battle_score(num):
-    score = 0
-    spite = 0
-
-    for x in range(num):
-        a = random.randint(1, 6)
-        score += a
-        if a >= 5:
-            spite += 1
-
-    return {"score": score, "spite": spite}
-
-
 async def dm(user_id, message):
     try:
-        user = await client.fetch_user(int(user_id))
+        channel = await dm_channels.get(user_id)
         #user = await client.fetch_user(107886996365508608)
+        if channel is None:
+            print(f'{user_id} not found. Message: {message}')
+            return
+
         if len(message) <= 2000:
-            await user.send(message)
+            await channel.send(message)
         else:
             new_message = deepcopy(message)
             message_fragments = new_message.split("\n")
@@ -3359,15 +3309,17 @@ async def dm(user_id, message):
                 if len(message_to_send) + len(message_fragments[x-1]) < 2000:
                     message_to_send += "\n" + message_fragments[x-1]
                 else:
-                    await user.send(message_to_send)
+                    await channel.send(message_to_send)
                     message_to_send = message_fragments[x-1]
             
             if len(message_to_send) > 0:
                 if len(message_to_send) < 2000:
-                    await user.send(message_to_send)
+                    await channel.send(message_to_send)
                 else:
-                    await user.send('Last message fragment too long to send. Ask developer to include more linebreaks in output.')
+                    await channel.send('Last message fragment too long to send. Ask developer to include more linebreaks in output.')
     except:
+        # The channel might be gone, look it up again next time
+        dm_channels.forget(user_id)
         print(f'{user_id} not found. Message: {message}')
         return
 
@@ -3405,10 +3357,17 @@ async def reply(interaction, message):
         print(f'Unable to send message: {message}')
 
 
-async def add_to_queue(user_id, action, item, location_id, amount=1, time=1, target_land=0):
-    with open("./data/global_info.json", "r") as file:
-        global_info = json.load(file)
+@asynccontextmanager
+async def transaction(**kwargs):
+    # state.transaction for commands. Yields a Deferred for the replies and DMs, which are sent once it has committed.
+    later = Deferred()
+    async with state.transaction(**kwargs):
+        yield later
+    await later.flush()
+
 
+def queue_task(user_id, action, item, location_id, amount=1, time=1, target_land=0):
+    # Only call this inside a transaction that holds the task queue (fields={"global_info": ["task_queue"]})
     task = {
         "user_id": user_id,
         "task": action,
@@ -3419,10 +3378,12 @@ async def add_to_queue(user_id, action, item, location_id, amount=1, time=1, tar
         "target_land_id": target_land
     }
 
-    global_info["task_queue"].append(task)
+    state["global_info"]["task_queue"].append(task)
 
-    with open("./data/global_info.json", "w") as file:
-        json.dump(global_info, file, indent=4)
+
+async def add_to_queue(user_id, action, item, location_id, amount=1, time=1, target_land=0):
+    async with state.transaction(fields={"global_info": ["task_queue"]}, op=f'queue_{action}'):
+        queue_task(user_id, action, item, location_id, amount, time, target_land)
 
 
 async def main():
@@ -3432,7 +3393,23 @@ async def main():
         if not discord_token:
             raise ValueError(
                 "No token provided. Set the DISCORD_BOT_TOKEN environment variable.")
-        await client.start(discord_token)
+
+        state.load()
+
+        # Pick up the random streams where the day is, in an epoch that was never used before
+        async with state.transaction(fields={"global_info": ["rng_epoch"]}, op="rng_epoch"):
+            global_info = state["global_info"]
+            global_info["rng_epoch"] = global_info.get("rng_epoch", 0) + 1
+            rng.reseed(global_info["day_counter"], global_info["rng_epoch"])
+
+        state.start()
+
+        try:
+            await client.start(discord_token)
+        finally:
+            # No battle may still be running when the state is saved for the last time
+            await shutdown_pools()
+            await state.close()
 
 # async def main():
 #     async with client:
@@ -3441,4 +3418,6 @@ async def main():
 
 #         await client.start(config['token'])
 
-asyncio.run(main())
+# Worker processes may import this module again (spawn/forkserver), they must not start another bot
+if __name__ == "__main__":
+    asyncio.run(main())
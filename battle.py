@@ -0,0 +1,298 @@
+import random
+from sampling import binomial, fair_coins, uniform_multinomial
+
+
+def roll_battle_score(rng, dice):
+    # Roll `dice` six-sided dice at once. The score is the sum of the dice and the spite is the number of 5s and 6s.
+    # Each die is a 5 or 6 with probability 1/3, so the spite is binomial. A spite die is 5 plus a fair coin,
+    # any other die is 1 plus two fair coins worth 2 and 1, so the score follows from a few coin counts.
+    if dice <= 0:
+        return {"score": 0, "spite": 0}
+
+    spite = binomial(rng, dice, 1 / 3)
+    others = dice - spite
+
+    score = 5 * spite + fair_coins(rng, spite)
+    score += others + 2 * fair_coins(rng, others) + fair_coins(rng, others)
+
+    return {"score": score, "spite": spite}
+
+
+def allocate_casualties(rng, amounts, casualties):
+    # How many of `casualties` each company loses when every casualty hits a uniformly random company
+    # that still has troops left (one casualty at a time, the way the battles always worked).
+    # All casualties are spread over the companies at once; hits beyond what a company had left would
+    # have gone to another company, so they are spread again over the survivors until none are left over.
+    hits = [0] * len(amounts)
+    alive = [index for index, amount in enumerate(amounts) if amount > 0]
+
+    while casualties > 0 and alive:
+        spread = uniform_multinomial(rng, casualties, len(alive))
+        casualties = 0
+        survivors = []
+
+        for index, count in zip(alive, spread):
+            left = amounts[index] - hits[index]
+            if count >= left:
+                hits[index] = amounts[index]
+                casualties += count - left
+            else:
+                hits[index] += count
+                survivors.append(index)
+
+        alive = survivors
+
+    return hits
+
+
+class ArmyStats:
+    # One army compiled for a battle: per company ATK, AP and HP per troop plus the number of troops,
+    # in the same order as the army's companies. Rounds only change the amounts.
+    def __init__(self):
+        self.atk = []
+        self.ap = []
+        self.hp = []
+        self.amounts = []
+
+    def copy(self):
+        stats = ArmyStats()
+        stats.atk = list(self.atk)
+        stats.ap = list(self.ap)
+        stats.hp = list(self.hp)
+        stats.amounts = list(self.amounts)
+        return stats
+
+    def add(self, atk, ap, hp, amount):
+        self.atk.append(atk)
+        self.ap.append(ap)
+        self.hp.append(hp)
+        self.amounts.append(amount)
+
+    def total_troops(self):
+        return sum(self.amounts)
+
+    def total_atk(self):
+        return sum(atk * amount for atk, amount in zip(self.atk, self.amounts))
+
+    def total_ap(self):
+        return sum(ap * amount for ap, amount in zip(self.ap, self.amounts))
+
+    def total_hp(self):
+        return sum(hp * amount for hp, amount in zip(self.hp, self.amounts))
+
+    def take_casualties(self, rng, casualties):
+        # Returns how many troops each company lost, then forgets the companies that were wiped out
+        hits = allocate_casualties(rng, self.amounts, casualties)
+
+        alive = [index for index, hit in enumerate(hits) if self.amounts[index] - hit > 0]
+        self.atk = [self.atk[index] for index in alive]
+        self.ap = [self.ap[index] for index in alive]
+        self.hp = [self.hp[index] for index in alive]
+        self.amounts = [self.amounts[index] - hits[index] for index in alive]
+
+        return hits
+
+
+class Company:
+    # One company going into a battle: whose troops they are, which troop, how many and their stats per troop
+    def __init__(self, user_id, troop_name, amount, atk, ap, hp):
+        self.user_id = user_id
+        self.troop_name = troop_name
+        self.amount = amount
+        self.atk = atk
+        self.ap = ap
+        self.hp = hp
+
+
+def army_stats(companies):
+    stats = ArmyStats()
+    for company in companies:
+        stats.add(company.atk, company.ap, company.hp, company.amount)
+    return stats
+
+
+class BattleResult:
+    # What happened in a battle. The companies are kept as they went in and every round only records
+    # what it changed: (attacker losses, defender losses), each a list of (company index, troops lost).
+    def __init__(self, attackers, defenders, rounds):
+        self.attackers = attackers
+        self.defenders = defenders
+        self.rounds = rounds
+
+    def states(self):
+        # (attacker amounts, defender amounts) after every round, one amount per company
+        attack_amounts = [company.amount for company in self.attackers]
+        defend_amounts = [company.amount for company in self.defenders]
+
+        for attacker_losses, defender_losses in self.rounds:
+            attack_amounts = list(attack_amounts)
+            for index, lost in attacker_losses:
+                attack_amounts[index] -= lost
+
+            defend_amounts = list(defend_amounts)
+            for index, lost in defender_losses:
+                defend_amounts[index] -= lost
+
+            yield attack_amounts, defend_amounts
+
+    def attacker_losses(self):
+        losses = [0] * len(self.attackers)
+        for attacker_losses, defender_losses in self.rounds:
+            for index, lost in attacker_losses:
+                losses[index] += lost
+        return losses
+
+    def defender_losses(self):
+        losses = [0] * len(self.defenders)
+        for attacker_losses, defender_losses in self.rounds:
+            for index, lost in defender_losses:
+                losses[index] += lost
+        return losses
+
+    def attacker_amounts(self):
+        return [company.amount - lost for company, lost in zip(self.attackers, self.attacker_losses())]
+
+    def defender_amounts(self):
+        return [company.amount - lost for company, lost in zip(self.defenders, self.defender_losses())]
+
+    def conquered(self):
+        # The land is taken when no defenders are left and some attackers are
+        return sum(self.defender_amounts()) <= 0 and sum(self.attacker_amounts()) > 0
+
+
+class Fortifications:
+    # The battle bonuses of a land's buildings. Each bonus grows with the number of defenders up to a cap.
+    def __init__(self, buildings=()):
+        self.hp_bonuses = [(building["HPbonus"], building["HPbonusPerTroop"], building["maxHPbonus"]) for building in buildings]
+        self.atk_bonuses = [(building["ATKbonus"], building["ATKbonusPerTroop"], building["maxATKbonus"]) for building in buildings]
+        self.ap_bonuses = [(building["APbonus"], building["APbonusPerTroop"], building["maxAPbonus"]) for building in buildings]
+
+    def hp(self, defenders):
+        return sum(min(bonus + per_troop * defenders, cap) for bonus, per_troop, cap in self.hp_bonuses)
+
+    def atk(self, defenders):
+        return sum(min(bonus + per_troop * defenders, cap) for bonus, per_troop, cap in self.atk_bonuses)
+
+    def ap(self, defenders):
+        return sum(min(bonus + per_troop * defenders, cap) for bonus, per_troop, cap in self.ap_bonuses)
+
+
+# A battle where neither side can get through the other's armour would otherwise never end
+MAX_ROUNDS = 1000
+
+
+def fight(rng, attackers, defenders, fortifications, max_casualties_attackers, max_casualties_defenders):
+    # Fight rounds until either side has lost its share of troops. Changes the troop counts in attackers
+    # and defenders, and returns (attacker hits, defender hits) for every round, lined up with the
+    # companies that were still standing at the start of that round.
+    rounds = []
+
+    total_attackers = attackers.total_troops()
+    total_defenders = defenders.total_troops()
+
+    attacker_HP = attackers.total_hp()
+    defender_HP = defenders.total_hp() + fortifications.hp(total_defenders)
+
+    percent_casualties_attackers = 0
+    percent_casualties_defenders = 0
+
+    while percent_casualties_attackers < max_casualties_attackers and percent_casualties_defenders < max_casualties_defenders:
+        if len(rounds) >= MAX_ROUNDS:
+            break
+
+        remaining_defenders = defenders.total_troops()
+        attacker_ATK = attackers.total_atk()
+        attacker_DEF = attackers.total_ap()
+        defender_ATK = defenders.total_atk() + fortifications.atk(remaining_defenders)
+        defender_DEF = defenders.total_ap() + fortifications.ap(remaining_defenders)
+
+        attacker_score = roll_battle_score(rng, attacker_ATK)
+        defender_score = roll_battle_score(rng, defender_ATK)
+
+        # Spite first wears down the other side's HP, whatever gets through becomes casualties
+        attacker_casualties = defender_score["spite"] - attacker_DEF - attacker_HP
+        defender_casualties = attacker_score["spite"] - defender_DEF - defender_HP
+        defender_HP = max(0, defender_HP - attacker_score["spite"])
+        attacker_HP = max(0, attacker_HP - defender_score["spite"])
+
+        defender_hits = defenders.take_casualties(rng, defender_casualties) if defender_casualties > 0 else []
+        attacker_hits = attackers.take_casualties(rng, attacker_casualties) if attacker_casualties > 0 else []
+        rounds.append((attacker_hits, defender_hits))
+
+        percent_casualties_attackers = 1 - attackers.total_troops() / total_attackers
+        percent_casualties_defenders = 1 - defenders.total_troops() / total_defenders
+
+    return rounds
+
+
+def take_losses(amounts, alive, hits):
+    # fight() lines hits up with the companies still standing, put them back on the right companies.
+    # Changes amounts and returns the (company index, troops lost) pairs and who is still standing.
+    if not hits:
+        return [], alive
+
+    losses = []
+    for index, hit in zip(alive, hits):
+        amounts[index] -= hit
+        if hit > 0:
+            losses.append((index, hit))
+
+    return losses, [index for index in alive if amounts[index] > 0]
+
+
+def resolve(rng, attackers, defenders, fortifications, max_casualties_attackers, max_casualties_defenders):
+    # Fight a battle between two lists of companies. Nothing that is passed in is changed and the
+    # outcome only depends on rng, so battles can run anywhere, including worker processes.
+    attack_amounts = [company.amount for company in attackers]
+    defend_amounts = [company.amount for company in defenders]
+    attack_alive = list(range(len(attackers)))
+    defend_alive = list(range(len(defenders)))
+    rounds = []
+
+    for attacker_hits, defender_hits in fight(rng, army_stats(attackers), army_stats(defenders), fortifications,
+                                              max_casualties_attackers, max_casualties_defenders):
+        defender_losses, defend_alive = take_losses(defend_amounts, defend_alive, defender_hits)
+        attacker_losses, attack_alive = take_losses(attack_amounts, attack_alive, attacker_hits)
+        rounds.append((attacker_losses, defender_losses))
+
+    return BattleResult(attackers, defenders, rounds)
+
+
+def resolve_seeded(seed, attackers, defenders, fortifications, max_casualties_attackers, max_casualties_defenders):
+    # resolve() with a generator of its own, for battles fought in worker processes
+    return resolve(random.Random(seed), attackers, defenders, fortifications, max_casualties_attackers, max_casualties_defenders)
+
+
+def simulate(attackers, defenders, fortifications, max_casualties_attackers, max_casualties_defenders, trials, seed=None):
+    # Fight the same battle `trials` times. Runs in a worker process, so everything in here has to be picklable.
+    rng = random.Random(seed)
+
+    conquests = 0
+    attacker_losses = 0
+    defender_losses = 0
+    rounds = 0
+
+    for trial in range(trials):
+        attack_trial = attackers.copy()
+        defend_trial = defenders.copy()
+
+        rounds += len(fight(rng, attack_trial, defend_trial, fortifications, max_casualties_attackers, max_casualties_defenders))
+
+        attacker_losses += attackers.total_troops() - attack_trial.total_troops()
+        defender_losses += defenders.total_troops() - defend_trial.total_troops()
+
+        # The land is taken when no defenders are left and some attackers are
+        if defend_trial.total_troops() <= 0 and attack_trial.total_troops() > 0:
+            conquests += 1
+
+    return {"trials": trials, "conquests": conquests, "attacker_losses": attacker_losses,
+            "defender_losses": defender_losses, "rounds": rounds}
+
+
+def merge_simulations(results):
+    # Add up the results of simulate() calls that ran in parallel
+    merged = {"trials": 0, "conquests": 0, "attacker_losses": 0, "defender_losses": 0, "rounds": 0}
+    for result in results:
+        for key in merged:
+            merged[key] += result[key]
+    return merged
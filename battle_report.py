@@ -0,0 +1,81 @@
+from collections import OrderedDict
+
+# Turns a battle.BattleResult into the text that is sent to the players.
+# Player names are looked up by the caller, so rendering doesn't need a Discord client.
+# The players get a short summary, the full round by round log is only rendered when someone asks for it.
+
+
+def render_army(companies, amounts, names):
+    message = ""
+    for company, amount in zip(companies, amounts):
+        if amount > 0:
+            message += f'\n{amount} {company.troop_name} ({names.get(company.user_id)})'
+    return message
+
+
+def render_battle(result, location, names):
+    # names maps the user ids of the companies to the names shown in the report
+    message = f'__**Battle Report @ {location}**__'
+    message += f'\n**Round 0**'
+    message += f'\nAttackers:'
+    message += render_army(result.attackers, [company.amount for company in result.attackers], names)
+    message += f'\nDefenders:'
+    message += render_army(result.defenders, [company.amount for company in result.defenders], names)
+
+    for round, (attack_amounts, defend_amounts) in enumerate(result.states(), 1):
+        message += f'\n\n\n**Round {round}**'
+        message += f'\nAttackers:'
+        message += render_army(result.attackers, attack_amounts, names)
+        message += f'\n\nDefenders:'
+        message += render_army(result.defenders, defend_amounts, names)
+
+    return message
+
+
+def render_losses(companies, losses, names):
+    message = ""
+    for company, lost in zip(companies, losses):
+        message += f'\n{company.amount - lost}/{company.amount} {company.troop_name} ({names.get(company.user_id)})'
+    return message
+
+
+def render_summary(result, location, names, battle_id):
+    attacker_losses = result.attacker_losses()
+    defender_losses = result.defender_losses()
+
+    message = f'__**Battle Report @ {location}**__ ({len(result.rounds)} rounds)'
+    message += f'\nAttackers lost {sum(attacker_losses)} of {sum(company.amount for company in result.attackers)}:'
+    message += render_losses(result.attackers, attacker_losses, names)
+    message += f'\nDefenders lost {sum(defender_losses)} of {sum(company.amount for company in result.defenders)}:'
+    message += render_losses(result.defenders, defender_losses, names)
+    message += f'\nUse /battlereport {battle_id} to see every round.'
+
+    return message
+
+
+class BattleArchive:
+    # The results of the latest battles by id, so their full reports can be rendered later.
+    # Only kept in memory: the oldest are dropped past max_size and all of them on a restart.
+    def __init__(self, max_size=500):
+        self.max_size = max_size
+        # Battle id -> (result, location, names)
+        self.battles = OrderedDict()
+
+    def add(self, battle_id, result, location, names):
+        # Names are kept as text so the archive doesn't hold on to Discord objects
+        names = {user_id: str(name) for user_id, name in names.items()}
+        self.battles[battle_id] = (result, location, names)
+
+        while len(self.battles) > self.max_size:
+            self.battles.popitem(last=False)
+
+    def get(self, battle_id):
+        return self.battles.get(battle_id)
+
+    def participants(self, battle_id):
+        result, location, names = self.battles[battle_id]
+        return {int(company.user_id) for company in result.attackers + result.defenders}
+
+    def render(self, battle_id):
+        result, location, names = self.battles[battle_id]
+        return render_battle(result, location, names)
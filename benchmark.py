@@ -0,0 +1,216 @@
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tracemalloc
+from registry import ConfigRegistry
+from battle import Company, Fortifications, MAX_ROUNDS, resolve, roll_battle_score, allocate_casualties
+
+# Benchmarks for the battle engine on synthetic armies made from the troops, species and buildings in /default_data.
+#   python benchmark.py                              time the engine and check it against the reference engine
+#   python benchmark.py --troops 10000 --companies 50
+#   python benchmark.py --save baseline.json        keep this engine's outcome statistics
+#   python benchmark.py --compare baseline.json     check that a changed engine still gives the same outcomes
+# Outcomes are compared with z-scores, anything beyond MAX_Z counts as a different distribution.
+
+MAX_Z = 4
+OUTCOMES = ["conquered", "rounds", "attacker_losses", "defender_losses"]
+
+
+def make_army(registry, rng, troops, companies, season, attacker=False):
+    # Random troops of every species, split as evenly as possible over the companies.
+    # Armies made with equally seeded generators pick the same troops.
+    troop_names = []
+    for troop_name in registry.document("troops"):
+        troop = registry.troop(troop_name)
+        if not troop_name.startswith("default") and registry.species(troop["species"], season) != "":
+            troop_names.append(troop_name)
+
+    army = []
+    for index in range(companies):
+        troop_name = rng.choice(troop_names)
+        troop = registry.troop(troop_name)
+        species = registry.species(troop["species"], season)
+
+        # The same stats as compile_army() in app.py
+        atk = troop["ATK"] + species["bonusATKPerTroop"]
+        if attacker:
+            atk = int(atk)
+
+        amount = troops // companies + (1 if index < troops % companies else 0)
+        army.append(Company(index, troop_name, amount, atk, troop["AP"] + species["bonusDEFPerTroop"], troop["HP"] + species["bonusHPPerTroop"]))
+
+    return army
+
+
+def reference_score(rng, dice):
+    # The original dice: one roll per point of ATK, 5s and 6s are spite
+    score = 0
+    spite = 0
+    for x in range(dice):
+        roll = rng.randint(1, 6)
+        score += roll
+        if roll >= 5:
+            spite += 1
+    return {"score": score, "spite": spite}
+
+
+def reference_resolve(rng, attackers, defenders, fortifications, max_casualties_attackers, max_casualties_defenders):
+    # The original battle loop, one casualty at a time on a random company that still has troops.
+    # Returns the amounts left and the number of rounds.
+    attack_amounts = [company.amount for company in attackers]
+    defend_amounts = [company.amount for company in defenders]
+
+    def total(companies, amounts, stat):
+        return sum(getattr(company, stat) * amount for company, amount in zip(companies, amounts))
+
+    def remove(amounts, casualties):
+        for x in range(casualties):
+            alive = [index for index, amount in enumerate(amounts) if amount > 0]
+            if not alive:
+                return
+            amounts[alive[rng.randint(0, len(alive) - 1)]] -= 1
+
+    total_attackers = sum(attack_amounts)
+    total_defenders = sum(defend_amounts)
+    attacker_HP = total(attackers, attack_amounts, "hp")
+    defender_HP = total(defenders, defend_amounts, "hp") + fortifications.hp(total_defenders)
+    rounds = 0
+
+    while 1 - sum(attack_amounts) / total_attackers < max_casualties_attackers and 1 - sum(defend_amounts) / total_defenders < max_casualties_defenders:
+        if rounds >= MAX_ROUNDS:
+            break
+        rounds += 1
+
+        remaining_defenders = sum(defend_amounts)
+        attacker_score = reference_score(rng, total(attackers, attack_amounts, "atk"))
+        defender_score = reference_score(rng, total(defenders, defend_amounts, "atk") + fortifications.atk(remaining_defenders))
+
+        attacker_casualties = defender_score["spite"] - total(attackers, attack_amounts, "ap") - attacker_HP
+        defender_casualties = attacker_score["spite"] - total(defenders, defend_amounts, "ap") - fortifications.ap(remaining_defenders) - defender_HP
+        defender_HP = max(0, defender_HP - attacker_score["spite"])
+        attacker_HP = max(0, attacker_HP - defender_score["spite"])
+
+        remove(defend_amounts, defender_casualties)
+        remove(attack_amounts, attacker_casualties)
+
+    return attack_amounts, defend_amounts, rounds
+
+
+def outcome(attackers, defenders, attack_amounts, defend_amounts, rounds):
+    return {"conquered": int(sum(defend_amounts) <= 0 and sum(attack_amounts) > 0), "rounds": rounds,
+            "attacker_losses": sum(company.amount for company in attackers) - sum(attack_amounts),
+            "defender_losses": sum(company.amount for company in defenders) - sum(defend_amounts)}
+
+
+def summarize(outcomes):
+    # Mean and variance of every outcome, all that is needed to compare two runs
+    summary = {"battles": len(outcomes)}
+    for key in OUTCOMES:
+        values = [result[key] for result in outcomes]
+        mean = sum(values) / len(values)
+        summary[key] = {"mean": mean, "variance": sum((value - mean) ** 2 for value in values) / max(1, len(values) - 1)}
+    return summary
+
+
+def compare(summary, baseline):
+    # Two sample z-score of every outcome's mean. Returns the keys that differ.
+    different = []
+    for key in OUTCOMES:
+        error = math.sqrt(summary[key]["variance"] / summary["battles"] + baseline[key]["variance"] / baseline["battles"])
+        difference = summary[key]["mean"] - baseline[key]["mean"]
+        z = difference / error if error > 0 else (0 if difference == 0 else math.inf)
+
+        print(f'  {key}: {summary[key]["mean"]:.3f} vs {baseline[key]["mean"]:.3f} (z = {z:.2f})')
+        if abs(z) > MAX_Z:
+            different.append(key)
+    return different
+
+
+def measure(name, function, repeat):
+    times = []
+    for x in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times.sort()
+
+    tracemalloc.start()
+    function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{name}: mean {1000 * sum(times) / len(times):.3f}ms, median {1000 * times[len(times) // 2]:.3f}ms, '
+          f'p95 {1000 * times[int(len(times) * 0.95)]:.3f}ms, peak {peak / 1024:.1f}KiB')
+
+
+def main(args):
+    registry = ConfigRegistry(args.data)
+    rng = random.Random(args.seed)
+
+    attackers = make_army(registry, random.Random(args.seed), args.troops, args.companies, args.season, attacker=True)
+    defenders = make_army(registry, random.Random(args.seed), args.defenders or args.troops, args.companies, args.season)
+    buildings = [registry.building(name) for name in args.buildings.split(",") if name]
+    fortifications = Fortifications(buildings)
+    limits = (args.max_casualties_attackers, args.max_casualties_defenders)
+
+    print(f'{args.troops} attackers against {args.defenders or args.troops} defenders in {args.companies} companies each, '
+          f'buildings: {args.buildings or "none"}')
+
+    total_atk = sum(company.atk * company.amount for company in attackers)
+    amounts = [company.amount for company in defenders]
+    measure("roll_battle_score", lambda: roll_battle_score(rng, total_atk), args.repeat)
+    measure("allocate_casualties", lambda: allocate_casualties(rng, amounts, sum(amounts) // 10), args.repeat)
+    measure("resolve", lambda: resolve(rng, attackers, defenders, fortifications, *limits), args.repeat)
+
+    outcomes = []
+    for x in range(args.trials):
+        result = resolve(rng, attackers, defenders, fortifications, *limits)
+        outcomes.append(outcome(attackers, defenders, result.attacker_amounts(), result.defender_amounts(), len(result.rounds)))
+    summary = summarize(outcomes)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"arguments": vars(args), "summary": summary}, file, indent=4)
+        print(f'Saved the outcomes of {args.trials} battles to {args.save}.')
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)["summary"]
+        print(f'Compared with {args.compare}:')
+    else:
+        # Without a baseline, check against the original engine
+        measure("reference_resolve", lambda: reference_resolve(rng, attackers, defenders, fortifications, *limits), max(1, args.repeat // 10))
+        reference = [outcome(attackers, defenders, *reference_resolve(rng, attackers, defenders, fortifications, *limits))
+                     for x in range(args.reference_trials)]
+        baseline = summarize(reference)
+        print(f'Compared with the reference engine:')
+
+    different = compare(summary, baseline)
+    if different:
+        print(f'The outcomes changed: {", ".join(different)}')
+        return 1
+
+    print('The outcomes are statistically the same.')
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duck Bot battle engine benchmarks.")
+    parser.add_argument("--data", default="./default_data")
+    parser.add_argument("--troops", type=int, default=1000, help="Troops in the attacking army.")
+    parser.add_argument("--defenders", type=int, default=0, help="Troops in the defending army, the same as --troops by default.")
+    parser.add_argument("--companies", type=int, default=10, help="Companies in each army.")
+    parser.add_argument("--buildings", default="", help="Comma separated buildings of the defending land.")
+    parser.add_argument("--season", default="spring")
+    parser.add_argument("--max-casualties-attackers", type=float, default=0.5)
+    parser.add_argument("--max-casualties-defenders", type=float, default=1)
+    parser.add_argument("--repeat", type=int, default=100, help="Runs of every timed function.")
+    parser.add_argument("--trials", type=int, default=2000, help="Battles for the outcome statistics.")
+    parser.add_argument("--reference-trials", type=int, default=500, help="Battles fought with the reference engine.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save")
+    parser.add_argument("--compare")
+    sys.exit(main(parser.parse_args()))
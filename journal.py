@@ -0,0 +1,103 @@
+import os
+import json
+from storage import DATA_DIR, DATABASE_PATH, write_files_atomic
+
+JOURNAL_NAME = "journal.jsonl"
+
+
+def open_journal():
+    # The journal lives next to whatever the storage backend writes to. DUCKBOT_JOURNAL=0 turns it off.
+    if os.getenv("DUCKBOT_JOURNAL", "1") == "0":
+        return None
+
+    if os.getenv("DUCKBOT_STORAGE", "json") == "sqlite":
+        data_dir = os.path.dirname(os.getenv("DUCKBOT_DATABASE", DATABASE_PATH))
+    else:
+        data_dir = os.getenv("DUCKBOT_DATA_DIR", DATA_DIR)
+
+    return Journal(os.path.join(data_dir, JOURNAL_NAME))
+
+
+class Journal:
+    # Append-only log of committed changes, one JSON line per transaction:
+    #   {"seq": 12, "op": "pay", "records": {"user_info": {"123": {...}, "456": {...}}}, "documents": {}}
+    # Every line holds the full new value of each record it touched (null when the record was deleted),
+    # so replaying a line twice does no harm. Lines that made it into a snapshot are dropped by compact().
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        # (seq, line) for everything that isn't in a snapshot yet
+        self.entries = []
+        self.file = None
+
+    def replay(self, documents):
+        # Apply every journaled change on top of the snapshot that was just loaded.
+        # Returns the changes as {name: keys or None} so the caller can save them in the next snapshot.
+        changes = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The bot died halfway through this line, so the command never finished committing
+                        break
+
+                    self.apply(documents, entry, changes)
+                    self.seq = max(self.seq, entry["seq"])
+                    self.entries.append((entry["seq"], json.dumps(entry, separators=(",", ":"))))
+
+        # Rewrite the file so a torn last line can't glue itself onto the next append
+        self.rewrite()
+
+        return changes
+
+    def apply(self, documents, entry, changes):
+        for name, document in entry.get("documents", {}).items():
+            documents[name] = document
+            changes[name] = None
+
+        for name, records in entry.get("records", {}).items():
+            document = documents[name]
+            for key, record in records.items():
+                if record is None:
+                    document.pop(key, None)
+                else:
+                    document[key] = record
+
+            if changes.get(name, set()) is not None:
+                changes.setdefault(name, set()).update(records.keys())
+
+    def append(self, op, records, documents):
+        # Called on the event loop right after a transaction commits. The line is fsynced before
+        # the command gets to reply, which is a lot cheaper than rewriting the documents it changed.
+        self.seq += 1
+        line = json.dumps({"seq": self.seq, "op": op, "records": records, "documents": documents}, separators=(",", ":"))
+
+        self.file.write(line + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        self.entries.append((self.seq, line))
+        return self.seq
+
+    def compact(self, seq):
+        # Everything up to seq is safely in a snapshot now, so it doesn't need replaying anymore
+        if not self.entries or self.entries[0][0] > seq:
+            return
+
+        self.entries = [(entry_seq, line) for entry_seq, line in self.entries if entry_seq > seq]
+        self.rewrite()
+
+    def rewrite(self):
+        if self.file is not None:
+            self.file.close()
+
+        write_files_atomic({self.path: "".join(line + "\n" for entry_seq, line in self.entries)})
+        self.file = open(self.path, "a")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
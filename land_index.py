@@ -0,0 +1,83 @@
+from storage import CAMPS
+
+
+class LandIndex:
+    # Lookups over the lands that would otherwise scan the whole map: land ids by name (case-insensitive)
+    # and every unit each user has in a garrison or siege camp, so their troops can be found without a scan.
+    # Kept up to date from the lands document as transactions commit. All ids are strings.
+    def __init__(self):
+        self.by_name = {}
+        # User id -> land id -> {(camp, troop name): amount}
+        self.by_occupant = {}
+        # Land id -> (name key, {(user id, camp, troop name): amount}) as last indexed, to take the land out again
+        self.entries = {}
+
+    def update(self, documents, changes):
+        # StateStore listener: index the lands that changed again
+        if "lands" not in changes:
+            return
+
+        lands = documents["lands"]
+        keys = changes["lands"]
+
+        if keys is None:
+            self.by_name = {}
+            self.by_occupant = {}
+            self.entries = {}
+            keys = list(lands.keys())
+
+        for land_id in keys:
+            self.update_land(land_id, lands.get(land_id))
+
+    def update_land(self, land_id, land):
+        land_id = str(land_id)
+
+        entry = None
+        if land is not None and land_id != "default":
+            units = {}
+            for camp in CAMPS:
+                for unit in land[camp]:
+                    if unit["amount"] > 0:
+                        key = (str(unit["user_id"]), camp, unit["troop_name"])
+                        units[key] = units.get(key, 0) + unit["amount"]
+            entry = (land["name"].lower(), units)
+
+        old_entry = self.entries.get(land_id)
+        if entry == old_entry:
+            return
+
+        if old_entry is not None:
+            name, units = old_entry
+            self.by_name[name].discard(land_id)
+            for user_id in {user_id for user_id, camp, troop_name in units}:
+                occupied = self.by_occupant[user_id]
+                del occupied[land_id]
+                if not occupied:
+                    del self.by_occupant[user_id]
+            del self.entries[land_id]
+
+        if entry is not None:
+            name, units = entry
+            self.by_name.setdefault(name, set()).add(land_id)
+            for (user_id, camp, troop_name), amount in units.items():
+                self.by_occupant.setdefault(user_id, {}).setdefault(land_id, {})[(camp, troop_name)] = amount
+            self.entries[land_id] = entry
+
+    def id_by_name(self, name):
+        # Names aren't unique, the land with the lowest id wins
+        land_ids = self.by_name.get(name.lower())
+        if not land_ids:
+            return None
+        return min(land_ids, key=int)
+
+    def occupied_by(self, user_id):
+        return sorted(self.by_occupant.get(str(user_id), {}), key=int)
+
+    def units_of(self, user_id):
+        # [(land id, camp, troop name, amount)] for every unit of the user, sorted by land id
+        occupied = self.by_occupant.get(str(user_id), {})
+        return [(land_id, camp, troop_name, amount) for land_id in sorted(occupied, key=int)
+                for (camp, troop_name), amount in sorted(occupied[land_id].items())]
+
+    def total_of(self, user_id):
+        return sum(sum(units.values()) for units in self.by_occupant.get(str(user_id), {}).values())
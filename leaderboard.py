@@ -0,0 +1,95 @@
+from bisect import bisect_left, insort
+
+
+class Leaderboard:
+    # Users sorted by one score, highest first. Ties go to the lowest user id so the order is always the same.
+    # Entries are (-score, user id) in a sorted list, so finding a user's rank is a binary search
+    # and moving a user only touches their own entry.
+    def __init__(self):
+        self.entries = []
+        # User id -> the score they are filed under
+        self.scores = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set(self, user_id, score):
+        user_id = str(user_id)
+
+        old_score = self.scores.get(user_id)
+        if old_score == score:
+            return
+
+        if old_score is not None:
+            self.remove(user_id)
+
+        insort(self.entries, (-score, int(user_id)))
+        self.scores[user_id] = score
+
+    def remove(self, user_id):
+        user_id = str(user_id)
+
+        score = self.scores.pop(user_id, None)
+        if score is None:
+            return
+
+        index = bisect_left(self.entries, (-score, int(user_id)))
+        del self.entries[index]
+
+    def top(self, number, offset=0):
+        # [(rank, user id, score)] starting from rank offset + 1
+        return [(offset + index + 1, str(user_id), -score) for index, (score, user_id) in enumerate(self.entries[offset:offset + number])]
+
+    def rank(self, user_id):
+        # 1 for the top user, None if they aren't on the board
+        user_id = str(user_id)
+
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+
+        return bisect_left(self.entries, (-score, int(user_id))) + 1
+
+
+# Board name -> how to score a user on it
+BOARDS = {
+    "quacks": lambda user: int(user["quacks"]),
+    "quackerinos": lambda user: int(user.get("quackerinos", 0)),
+    "lands": lambda user: len(user["land_ids"]),
+    "renown": lambda user: int(user.get("renown", 0)),
+}
+
+
+class Leaderboards:
+    # One Leaderboard per entry of BOARDS, kept up to date from user_info as transactions commit
+    # instead of scanning every user for every /quackery
+    def __init__(self):
+        self.boards = {name: Leaderboard() for name in BOARDS}
+
+    def __getitem__(self, name):
+        return self.boards[name]
+
+    def update(self, documents, changes):
+        # StateStore listener: score the users that changed again
+        if "user_info" not in changes:
+            return
+
+        user_info = documents["user_info"]
+        keys = changes["user_info"]
+
+        if keys is None:
+            self.boards = {name: Leaderboard() for name in BOARDS}
+            keys = list(user_info.keys())
+
+        for user_id in keys:
+            self.update_user(user_id, user_info.get(user_id))
+
+    def update_user(self, user_id, user):
+        if user_id == "default":
+            return
+
+        for name, score in BOARDS.items():
+            if user is None:
+                self.boards[name].remove(user_id)
+            else:
+                self.boards[name].set(user_id, score(user))
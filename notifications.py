@@ -0,0 +1,72 @@
+import asyncio
+
+# Discord refuses messages longer than this
+MESSAGE_LIMIT = 2000
+
+
+class Outbox:
+    # Collects the DMs produced while the world is locked and sends them afterwards.
+    # Repeats of the same message to the same player are dropped, and everything a player
+    # gets is merged into as few messages as fit under Discord's length limit.
+    def __init__(self):
+        # Recipient id -> messages in the order they were queued
+        self.messages = {}
+
+    def __len__(self):
+        return sum(len(messages) for messages in self.messages.values())
+
+    def add(self, user_id, message):
+        messages = self.messages.setdefault(str(user_id), [])
+        if message not in messages:
+            messages.append(message)
+
+    def merge(self, messages):
+        merged = []
+        current = ""
+
+        for message in messages:
+            if current and len(current) + 2 + len(message) > MESSAGE_LIMIT:
+                merged.append(current)
+                current = ""
+
+            current = f'{current}\n\n{message}' if current else message
+
+        if current:
+            merged.append(current)
+
+        return merged
+
+    async def flush(self, send, concurrency=5):
+        # Messages to one player go out in order, at most `concurrency` players are being sent to at once.
+        # send() is dm(), which splits anything that is still too long on its own.
+        semaphore = asyncio.Semaphore(concurrency)
+        pending = self.messages
+        self.messages = {}
+
+        async def send_all(user_id, messages):
+            async with semaphore:
+                for message in messages:
+                    await send(user_id, message)
+
+        batches = {user_id: self.merge(messages) for user_id, messages in pending.items()}
+        await asyncio.gather(*(send_all(user_id, messages) for user_id, messages in batches.items()))
+
+        return sum(len(messages) for messages in batches.values())
+
+
+class Deferred:
+    # Replies and DMs made while a command's transaction holds its locks. They are run in order once it has
+    # committed, so no lock is held across a Discord request. Nothing is sent if the transaction rolls back.
+    def __init__(self):
+        # (coroutine function, args) in the order they were made
+        self.calls = []
+
+    def __call__(self, function, *args):
+        self.calls.append((function, args))
+
+    async def flush(self):
+        calls = self.calls
+        self.calls = []
+
+        for function, args in calls:
+            await function(*args)
@@ -0,0 +1,134 @@
+import os
+import time
+import json
+from types import MappingProxyType
+
+CONFIG_DIR = "./data"
+CONFIG_FILES = ["troops", "buildings", "species"]
+SEASONAL_KEYS = ["all-season", "spring", "summer", "fall", "winter"]
+
+
+class ConfigRegistry:
+    # Loads the troop, building and species definitions once and hands out pre-merged, read-only copies.
+    # The files are only re-read when their modification time changes.
+    def __init__(self, data_dir=CONFIG_DIR, check_interval=1):
+        self.data_dir = data_dir
+        self.check_interval = check_interval
+        self.last_check = None
+        self.mtimes = {}
+        self.documents = {}
+        self.troops = {}
+        self.buildings = {}
+        self.species_by_season = {}
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f'{name}.json')
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.last_check is not None and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+
+        for name in CONFIG_FILES:
+            mtime = os.stat(self.path(name)).st_mtime_ns
+            if self.mtimes.get(name) == mtime:
+                continue
+
+            with open(self.path(name), "r") as file:
+                self.documents[name] = json.load(file)
+            self.mtimes[name] = mtime
+
+            # Drop everything that was merged from the old version of the file
+            if name == "troops":
+                self.troops = {}
+            elif name == "buildings":
+                self.buildings = {}
+            elif name == "species":
+                self.species_by_season = {}
+
+    def document(self, name):
+        self.refresh()
+        return self.documents[name]
+
+    def troop(self, troop_name):
+        self.refresh()
+
+        troop = self.troops.get(troop_name)
+        if troop is None:
+            troops = self.documents["troops"]
+            try:
+                overrides = troops[troop_name]
+            except:
+                return ""
+
+            merged = dict(troops.get(f'default_tier{overrides["tier"]}', {}))
+
+            # Replace the attributes with the troop specific overrides
+            merged.update(overrides)
+
+            troop = MappingProxyType(merged)
+            self.troops[troop_name] = troop
+
+        return troop
+
+    def building(self, building_name):
+        self.refresh()
+
+        building = self.buildings.get(building_name)
+        if building is None:
+            buildings = self.documents["buildings"]
+            try:
+                overrides = buildings[building_name]
+            except:
+                return ""
+
+            merged = dict(buildings.get("default", {}))
+
+            # Replace the attributes with the building specific overrides
+            merged.update(overrides)
+
+            building = MappingProxyType(merged)
+            self.buildings[building_name] = building
+
+        return building
+
+    def species(self, species_name, season):
+        self.refresh()
+
+        # Each season gets its own set of merged species so a season change needs no invalidation
+        season_species = self.species_by_season.setdefault(season, {})
+
+        species = season_species.get(species_name)
+        if species is None:
+            species_list = self.documents["species"]
+            try:
+                overrides = species_list[species_name]
+            except:
+                return ""
+
+            default_species = species_list.get("default", {})
+            merged = {}
+
+            # Only add the non seasonal default attributes to the species
+            for attr, value in default_species.items():
+                if attr not in SEASONAL_KEYS:
+                    merged[attr] = value
+
+            # Give the species all of the default all-season attributes, then the default seasonal ones
+            merged.update(default_species["all-season"])
+            merged.update(default_species[season])
+
+            # Replace all non seasonal default attributes with species specific overrides
+            for attr, value in overrides.items():
+                if attr not in SEASONAL_KEYS:
+                    merged[attr] = value
+
+            # Give the species all of the all-season attributes, then override them with the proper season
+            merged.update(overrides["all-season"])
+            merged.update(overrides[season])
+
+            species = MappingProxyType(merged)
+            season_species[species_name] = species
+
+        return species
@@ -0,0 +1,103 @@
+class RelationGraph:
+    # Who is friendly with whom, kept up to date from user_info as transactions commit instead of
+    # scanning every user for every check. A user is friendly with their allies, their liege,
+    # their fellow vassals (and themselves if they have a liege), their own vassals and their allies' vassals.
+    # All ids are strings, like the keys of user_info.
+    def __init__(self):
+        # User id -> liege id, only for users with a liege
+        self.lieges = {}
+        # Liege id -> ids of their vassals
+        self.vassals = {}
+        # User id -> ids on their ally list
+        self.allies = {}
+        # User id -> ids of the users that have them on their ally list
+        self.allied_by = {}
+        # User id -> everyone they are friendly with, worked out when first needed
+        self.friends = {}
+
+    def update(self, documents, changes):
+        # StateStore listener: look at the users that changed again
+        if "user_info" not in changes:
+            return
+
+        user_info = documents["user_info"]
+        keys = changes["user_info"]
+
+        if keys is None:
+            self.lieges = {}
+            self.vassals = {}
+            self.allies = {}
+            self.allied_by = {}
+            self.friends = {}
+            keys = list(user_info.keys())
+
+        for user_id in keys:
+            self.update_user(user_id, user_info.get(user_id))
+
+    def update_user(self, user_id, user):
+        user_id = str(user_id)
+
+        liege_id = None
+        ally_ids = set()
+        if user is not None:
+            if user["liege_id"] != 0:
+                liege_id = str(user["liege_id"])
+            ally_ids = {str(ally_id) for ally_id in user["ally_ids"]}
+
+        old_liege_id = self.lieges.get(user_id)
+        old_ally_ids = self.allies.get(user_id, set())
+        if liege_id == old_liege_id and ally_ids == old_ally_ids:
+            return
+
+        # A changed ally list only changes what this user is friendly with
+        self.forget(user_id)
+
+        if liege_id != old_liege_id:
+            # Everyone around the old and the new liege sees this user join or leave
+            for changed_liege_id in (old_liege_id, liege_id):
+                if changed_liege_id is not None:
+                    self.forget(changed_liege_id, *self.vassals.get(changed_liege_id, ()), *self.allied_by.get(changed_liege_id, ()))
+
+            if old_liege_id is not None:
+                self.vassals[old_liege_id].discard(user_id)
+                del self.lieges[user_id]
+            if liege_id is not None:
+                self.vassals.setdefault(liege_id, set()).add(user_id)
+                self.lieges[user_id] = liege_id
+
+        for ally_id in old_ally_ids - ally_ids:
+            self.allied_by[ally_id].discard(user_id)
+        for ally_id in ally_ids - old_ally_ids:
+            self.allied_by.setdefault(ally_id, set()).add(user_id)
+
+        if ally_ids:
+            self.allies[user_id] = ally_ids
+        else:
+            self.allies.pop(user_id, None)
+
+    def forget(self, *user_ids):
+        for user_id in user_ids:
+            self.friends.pop(user_id, None)
+
+    def friendly(self, user_id):
+        user_id = str(user_id)
+
+        friends = self.friends.get(user_id)
+        if friends is None:
+            friends = set(self.allies.get(user_id, ()))
+
+            liege_id = self.lieges.get(user_id)
+            if liege_id is not None:
+                friends.add(liege_id)
+                friends.update(self.vassals.get(liege_id, ()))
+
+            friends.update(self.vassals.get(user_id, ()))
+            for ally_id in self.allies.get(user_id, ()):
+                friends.update(self.vassals.get(ally_id, ()))
+
+            self.friends[user_id] = friends
+
+        return friends
+
+    def is_friendly(self, user_id, target_id):
+        return str(target_id) in self.friendly(user_id)
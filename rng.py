@@ -0,0 +1,66 @@
+import os
+import random
+import sampling
+
+
+def open_rng():
+    # DUCKBOT_SEED replays the game's randomness, otherwise every start gets a fresh seed
+    seed = os.getenv("DUCKBOT_SEED")
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+
+    return RngService(int(seed))
+
+
+class RngService:
+    # All of the game's randomness. Every subsystem ("battles", "quality", "slots", ...) draws from a stream
+    # of its own, so drawing more in one of them doesn't change what the others get.
+    # The streams start over from the seed and the day whenever the daily tick reseeds them,
+    # so a tick can be replayed exactly by running with the same seed from the same data.
+    # Every start of the bot reseeds them with a new epoch as well, so a restart doesn't replay
+    # the streams the commands already drew from since the last tick.
+    def __init__(self, seed):
+        self.seed = seed
+        self.day = 0
+        self.epoch = 0
+        self.streams = {}
+
+    def reseed(self, day, epoch=0):
+        self.day = day
+        self.epoch = epoch
+        self.streams = {}
+
+    def stream(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            # String seeds are hashed with SHA-512, so the streams are the same in every process
+            stream = random.Random(f'{self.seed}:{self.day}:{self.epoch}:{name}')
+            self.streams[name] = stream
+        return stream
+
+    def random(self, name):
+        return self.stream(name).random()
+
+    def randint(self, name, a, b):
+        return self.stream(name).randint(a, b)
+
+    def choice(self, name, sequence):
+        return self.stream(name).choice(sequence)
+
+    def uniforms(self, name, n):
+        # n uniform numbers in [0, 1) at once
+        draw = self.stream(name).random
+        return [draw() for x in range(n)]
+
+    def binomial(self, name, n, p):
+        # How many of n tries succeed with probability p each, without drawing once per try
+        return sampling.binomial(self.stream(name), n, p)
+
+    def geometric(self, name, p):
+        # How many tries it takes until one succeeds with probability p, without drawing once per try
+        return sampling.geometric(self.stream(name), p)
+
+    def seeds(self, name, n):
+        # Seeds for generators of their own, e.g. for battles fought in worker processes
+        stream = self.stream(name)
+        return [stream.getrandbits(64) for x in range(n)]
@@ -0,0 +1,103 @@
+import math
+
+# Draw aggregate counts directly instead of flipping one coin per troop.
+# Every function takes the random number generator to use (the random module itself or a random.Random)
+# and gives exactly the same distribution as the per-item loop it replaces.
+
+
+# Above this many flips fair_coins() stops drawing one bit per flip, so time and memory stay bounded
+MAX_COIN_BITS = 1 << 16
+
+
+def fair_coins(rng, n):
+    # Number of heads in n fair coin flips: one random bit per flip, counted in bulk
+    if n <= 0:
+        return 0
+    if n > MAX_COIN_BITS:
+        return transformed_rejection(rng, n, 0.5)
+    return bin(rng.getrandbits(n)).count("1")
+
+
+def binomial(rng, n, p):
+    # Number of successes in n independent tries that each succeed with probability p.
+    # Same algorithms as random.binomialvariate() in Python 3.12, which isn't available on 3.8.
+    if n <= 0 or p <= 0.0:
+        return 0
+    if p >= 1.0:
+        return n
+
+    if n == 1:
+        return int(rng.random() < p)
+
+    if p == 0.5:
+        return fair_coins(rng, n)
+
+    # Exploit symmetry so p <= 0.5
+    if p > 0.5:
+        return n - binomial(rng, n, 1.0 - p)
+
+    if n * p < 10.0:
+        # Devroye's geometric method, O(np): jump straight from one success to the next
+        x = y = 0
+        c = math.log2(1.0 - p)
+        if not c:
+            return x
+        while True:
+            y += math.floor(math.log2(1.0 - rng.random()) / c) + 1
+            if y > n:
+                return x
+            x += 1
+
+    return transformed_rejection(rng, n, p)
+
+
+def transformed_rejection(rng, n, p):
+    # Hörmann's transformed rejection with squeeze (BTRS), O(1) expected. Needs n * p >= 10 and p <= 0.5.
+    setup_complete = False
+
+    spq = math.sqrt(n * p * (1.0 - p))
+    b = 1.15 + 2.53 * spq
+    a = -0.0873 + 0.0248 * b + 0.01 * p
+    c = n * p + 0.5
+    vr = 0.92 - 4.2 / b
+
+    while True:
+        u = rng.random() - 0.5
+        us = 0.5 - abs(u)
+        k = math.floor((2.0 * a / us + b) * u + c)
+        if k < 0 or k > n:
+            continue
+
+        # The squeeze accepts most draws without evaluating the acceptance condition
+        v = rng.random()
+        if us >= 0.07 and v <= vr:
+            return k
+
+        if not setup_complete:
+            alpha = (2.83 + 5.1 / b) * spq
+            lpq = math.log(p / (1.0 - p))
+            m = math.floor((n + 1) * p)
+            h = math.lgamma(m + 1) + math.lgamma(n - m + 1)
+            setup_complete = True
+
+        v *= alpha / (a / (us * us) + b)
+        if math.log(v) <= h - math.lgamma(k + 1) - math.lgamma(n - k + 1) + (k - m) * lpq:
+            return k
+
+
+def geometric(rng, p):
+    # Number of tries up to and including the first success, when each try succeeds with probability p
+    if p >= 1.0:
+        return 1
+    return math.floor(math.log(1.0 - rng.random()) / math.log(1.0 - p)) + 1
+
+
+def uniform_multinomial(rng, n, k):
+    # Spread n items over k equally likely slots, as if each item picked its slot with randrange(k)
+    counts = []
+    for slot in range(k - 1):
+        count = binomial(rng, n, 1 / (k - slot))
+        counts.append(count)
+        n -= count
+    counts.append(n)
+    return counts
@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+
+
+class SiegeCache:
+    # Siege pressure per land id: (defenders, siegers, defender score, sieger score, surrounded).
+    # Worked out the first time a land is asked for and kept until a transaction that changed the land commits,
+    # or the building definitions are reloaded. All ids are strings.
+    # The daily tick moves troops around long before it commits, so while it runs nothing is cached (see suspended()).
+    def __init__(self, registry):
+        self.registry = registry
+        self.entries = {}
+        # The building definitions the entries were worked out with
+        self.definitions = None
+        self.suspensions = 0
+
+    def update(self, documents, changes):
+        # StateStore listener: forget the lands that changed
+        if "lands" not in changes:
+            return
+
+        if changes["lands"] is None:
+            self.entries = {}
+            return
+
+        for land_id in changes["lands"]:
+            self.entries.pop(str(land_id), None)
+
+    @contextmanager
+    def suspended(self):
+        self.suspensions += 1
+        try:
+            yield self
+        finally:
+            self.suspensions -= 1
+
+    def pressure(self, land_id, land):
+        if self.suspensions > 0:
+            return self.compute(land)
+
+        self.registry.refresh()
+        if self.registry.buildings is not self.definitions:
+            self.entries = {}
+            self.definitions = self.registry.buildings
+
+        land_id = str(land_id)
+        pressure = self.entries.get(land_id)
+        if pressure is None:
+            pressure = self.compute(land)
+            self.entries[land_id] = pressure
+
+        return pressure
+
+    def compute(self, land):
+        num_defenders = 0
+        num_siegers = 0
+
+        # 1 troop = +1 score
+        for unit in land["garrison"]:
+            num_defenders += unit["amount"]
+        for unit in land["siegeCamp"]:
+            num_siegers += unit["amount"]
+
+        defender_score = num_defenders
+        sieger_score = num_siegers
+
+        # HP and DEF bonuses of buildings increase the defender score
+        for building_name in land["buildings"]:
+            building = self.registry.building(building_name)
+            defender_score += min(building["maxAPbonus"], building["APbonus"] + building["APbonusPerTroop"] * num_defenders) + min(
+                building["maxHPbonus"], building["HPbonus"] + building["HPbonusPerTroop"] * num_defenders)
+
+        return (num_defenders, num_siegers, defender_score, sieger_score, sieger_score > defender_score)
+
+    def is_surrounded(self, land_id, land):
+        return self.pressure(land_id, land)[4]
@@ -0,0 +1,303 @@
+import weakref
+import asyncio
+from copy import deepcopy
+from contextlib import asynccontextmanager
+from storage import JsonStorage
+
+
+def add_change(changes, name, keys):
+    # changes maps a document name to the set of changed keys, or None once the whole document changed
+    if keys is None:
+        changes[name] = None
+    elif changes.get(name, set()) is not None:
+        changes.setdefault(name, set()).update(keys)
+
+
+class WorldLock:
+    # Readers/writer lock. Command transactions share it; the daily tick takes it exclusively.
+    # A waiting writer blocks new readers so the tick can't be starved by a stream of commands.
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    async def acquire_shared(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.writer and self.writers_waiting == 0)
+            self.readers += 1
+
+    async def release_shared(self):
+        async with self.condition:
+            self.readers -= 1
+            self.condition.notify_all()
+
+    async def acquire_exclusive(self):
+        async with self.condition:
+            self.writers_waiting += 1
+            try:
+                await self.condition.wait_for(lambda: not self.writer and self.readers == 0)
+            finally:
+                self.writers_waiting -= 1
+            self.writer = True
+
+    async def release_exclusive(self):
+        async with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+
+class StateStore:
+    # Holds the whole world state in memory. Commands read and mutate the documents directly and
+    # call mark_dirty() instead of dumping the file themselves; a background writer saves the changes.
+    # The writer wakes up on the first change and waits coalesce_window seconds so a burst of commands
+    # ends up in a single write.
+    # With a journal every transaction is also appended to it as it commits, so nothing is lost between
+    # snapshots and the snapshot can be written less often.
+    def __init__(self, storage=None, journal=None, coalesce_window=None):
+        self.storage = storage or JsonStorage()
+        self.journal = journal
+        if coalesce_window is None:
+            coalesce_window = 30 if journal is not None else 2
+        self.coalesce_window = coalesce_window
+        self.documents = {}
+        # Document name -> set of changed keys, or None when the whole document changed
+        self.dirty = {}
+        # Same, for the changes that haven't been written to the journal yet
+        self.unjournaled = {}
+        self.changed = None
+        self.writer = None
+        self.world_lock = None
+        # Only one flush at a time, so two writes never race on the same files
+        self.flush_lock = None
+        # Resource name -> lock. Locks disappear on their own once no transaction holds them.
+        self.locks = weakref.WeakValueDictionary()
+        # Called with (documents, changes) after every commit and load, to keep indexes up to date
+        self.listeners = []
+
+    def __getitem__(self, name):
+        return self.documents[name]
+
+    def load(self):
+        self.documents = self.storage.load()
+
+        if self.journal is not None:
+            # Bring the snapshot up to date with whatever was committed after it was written
+            for name, keys in self.journal.replay(self.documents).items():
+                add_change(self.dirty, name, keys)
+
+        self.notify({name: None for name in self.documents})
+
+    def listen(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, changes):
+        for listener in self.listeners:
+            listener(self.documents, changes)
+
+    def mark_dirty(self, *names):
+        for name in names:
+            add_change(self.dirty, name, None)
+            add_change(self.unjournaled, name, None)
+        self.wake_writer()
+
+    def mark_dirty_keys(self, name, *keys):
+        # Only the given users/lands changed, so the storage backend can skip everything else
+        keys = {str(key) for key in keys}
+        add_change(self.dirty, name, keys)
+        add_change(self.unjournaled, name, keys)
+        self.wake_writer()
+
+    def write_journal(self, op):
+        # Append the after-image of everything marked dirty since the last journal entry
+        changes = self.unjournaled
+        self.unjournaled = {}
+        if not changes:
+            return
+
+        self.notify(changes)
+
+        if self.journal is None:
+            return
+
+        records = {}
+        documents = {}
+        for name, keys in changes.items():
+            if keys is None:
+                documents[name] = self.documents[name]
+            else:
+                records[name] = {key: self.documents[name].get(key) for key in keys}
+
+        self.journal.append(op, records, documents)
+
+    def wake_writer(self):
+        if self.changed is not None:
+            self.changed.set()
+
+    def lock_for(self, resource):
+        lock = self.locks.get(resource)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[resource] = lock
+        return lock
+
+    @asynccontextmanager
+    async def transaction(self, users=(), lands=(), documents=(), fields=None, exclusive=False, op="command"):
+        # Lock the given users, lands and whole documents for the duration of the block.
+        # fields ({document name: [keys]}) locks a document like documents does, but only snapshots and
+        # rolls back those keys, so e.g. queueing a task doesn't copy all of global_info.
+        # On success only the records that actually changed are marked dirty and journaled under op (one commit);
+        # if the block raises, the locked records are put back the way they were.
+        # exclusive=True locks the whole world instead (used by the daily tick); if it raises, every document is put back.
+        if self.world_lock is None:
+            self.world_lock = WorldLock()
+
+        if exclusive:
+            await self.world_lock.acquire_exclusive()
+            try:
+                # The tick runs once a day, so copying the whole world to put back on failure is cheap enough
+                snapshot = deepcopy(self.documents)
+                try:
+                    yield self
+                except:
+                    for name, document in snapshot.items():
+                        self.documents[name].clear()
+                        self.documents[name].update(document)
+                    raise
+
+                self.mark_dirty(*self.documents.keys())
+                self.write_journal(op)
+            finally:
+                await self.world_lock.release_exclusive()
+            return
+
+        # Always take the locks in the same order so two transactions can never deadlock
+        fields = fields or {}
+        documents = sorted(set(documents))
+        records = {"user_info": sorted({str(user_id) for user_id in users}), "lands": sorted({str(land_id) for land_id in lands})}
+        for name, keys in fields.items():
+            if name not in documents:
+                records[name] = sorted({str(key) for key in keys})
+        resources = [f'document:{name}' for name in sorted(set(documents) | set(fields))]
+        resources += [f'user:{user_id}' for user_id in records["user_info"]]
+        resources += [f'land:{land_id}' for land_id in records["lands"]]
+        held = []
+
+        await self.world_lock.acquire_shared()
+        try:
+            for resource in resources:
+                lock = self.lock_for(resource)
+                await lock.acquire()
+                held.append(lock)
+
+            document_snapshots = {name: deepcopy(self.documents[name]) for name in documents}
+            record_snapshots = {}
+            for name, keys in records.items():
+                record_snapshots[name] = {key: deepcopy(self.documents[name].get(key)) for key in keys}
+
+            try:
+                yield self
+            except:
+                # Roll back, in place so anyone holding a reference to the document sees the old values
+                for name, snapshot in document_snapshots.items():
+                    self.documents[name].clear()
+                    self.documents[name].update(snapshot)
+                for name, snapshots in record_snapshots.items():
+                    for key, record in snapshots.items():
+                        if record is None:
+                            self.documents[name].pop(key, None)
+                        else:
+                            self.documents[name][key] = record
+                raise
+
+            # Commit everything that changed in one go
+            for name, snapshot in document_snapshots.items():
+                if self.documents[name] != snapshot:
+                    self.mark_dirty(name)
+            for name, snapshots in record_snapshots.items():
+                changed = [key for key, record in snapshots.items() if self.documents[name].get(key) != record]
+                if changed:
+                    self.mark_dirty_keys(name, *changed)
+            self.write_journal(op)
+        finally:
+            for lock in reversed(held):
+                lock.release()
+            await self.world_lock.release_shared()
+
+    async def flush(self):
+        if self.world_lock is None:
+            self.world_lock = WorldLock()
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+
+        async with self.flush_lock:
+            # Share the world lock like a command, so a snapshot never catches the daily tick halfway through
+            await self.world_lock.acquire_shared()
+            try:
+                await self.write_snapshot()
+            finally:
+                await self.world_lock.release_shared()
+
+    async def write_snapshot(self):
+        if not self.dirty:
+            return
+
+        # Changes made outside of a transaction still have to be journaled before the snapshot covers them
+        self.write_journal("flush")
+        seq = self.journal.seq if self.journal is not None else 0
+
+        dirty = self.dirty
+        self.dirty = {}
+
+        # Serialize on the event loop so no command can change a document halfway through, then write off the loop
+        batch = self.storage.prepare(self.documents, dirty)
+        write = asyncio.get_running_loop().run_in_executor(None, self.storage.write, batch)
+
+        try:
+            await asyncio.shield(write)
+        except BaseException:
+            # The thread can't be stopped, so a cancelled flush waits for it before letting the next flush in
+            if not write.done():
+                await asyncio.wait([write])
+
+            # Try again on the next flush. These changes are already in the journal.
+            for name, keys in dirty.items():
+                add_change(self.dirty, name, keys)
+            self.wake_writer()
+            raise
+
+        if self.journal is not None:
+            self.journal.compact(seq)
+
+    async def run_writer(self):
+        while True:
+            await self.changed.wait()
+            await asyncio.sleep(self.coalesce_window)
+            self.changed.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'Error while saving the world state: {e}')
+
+    def start(self):
+        if self.writer is None:
+            self.changed = asyncio.Event()
+            if self.dirty:
+                self.changed.set()
+            self.writer = asyncio.get_running_loop().create_task(self.run_writer())
+
+    async def close(self):
+        if self.writer is not None:
+            # Let a flush that is already writing finish first, its changes are put back to be written below
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+            self.writer = None
+
+        await self.flush()
+        self.storage.close()
+        if self.journal is not None:
+            self.journal.close()
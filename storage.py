@@ -0,0 +1,353 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+DATA_DIR = "./data"
+DEFAULT_DATA_DIR = "./default_data"
+DATABASE_PATH = "./data/duckbot.db"
+
+# The documents that make up the world state. Config files (troops, buildings, species, slots) are not in here.
+DOCUMENTS = ["user_info", "lands", "global_info", "server_info"]
+
+# Land attributes that are stored as rows in the units table instead of inside the land
+CAMPS = ["garrison", "siegeCamp"]
+
+TASK_COLUMNS = ["user_id", "task", "item", "location_id", "amount", "time", "target_land_id"]
+
+
+def open_storage():
+    # Pick the storage backend from the environment (default: the JSON files in ./data)
+    backend = os.getenv("DUCKBOT_STORAGE", "json")
+
+    if backend == "json":
+        return JsonStorage(os.getenv("DUCKBOT_DATA_DIR", DATA_DIR), pretty=os.getenv("DUCKBOT_PRETTY_JSON", "0") == "1")
+    elif backend == "sqlite":
+        return SqliteStorage(os.getenv("DUCKBOT_DATABASE", DATABASE_PATH))
+
+    raise ValueError(f'Unknown storage backend "{backend}". Use "json" or "sqlite".')
+
+
+def dump_json(document, pretty=False):
+    if pretty:
+        return json.dumps(document, indent=4)
+    return json.dumps(document, separators=(",", ":"))
+
+
+def fsync_dir(path):
+    # Make the renames themselves durable. Not possible (or needed) on Windows.
+    if os.name != "posix":
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_files_atomic(payloads):
+    # Write every file next to its target, fsync them all, then swap them in with os.replace.
+    # A crash at any point leaves each file either fully old or fully new, never truncated.
+    # Every write gets temp files of its own, so two writes of the same file can't clobber each other's
+    temp_paths = {}
+
+    try:
+        for path, payload in payloads.items():
+            fd, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(path)}.', suffix=".tmp", dir=os.path.dirname(os.path.abspath(path)))
+            temp_paths[path] = temp_path
+            with os.fdopen(fd, "w") as file:
+                file.write(payload)
+                file.flush()
+                os.fsync(file.fileno())
+
+        for path, temp_path in temp_paths.items():
+            os.replace(temp_path, path)
+    except:
+        for temp_path in temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+
+    for directory in {os.path.dirname(os.path.abspath(path)) for path in payloads}:
+        fsync_dir(directory)
+
+
+class JsonStorage:
+    # One JSON file per document. Any change to a document rewrites its whole file.
+    # Files are written compact by default; pretty=True indents them for reading by hand.
+    def __init__(self, data_dir=DATA_DIR, pretty=False):
+        self.data_dir = data_dir
+        self.pretty = pretty
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f'{name}.json')
+
+    def load(self):
+        documents = {}
+
+        for name in DOCUMENTS:
+            with open(self.path(name), "r") as file:
+                documents[name] = json.load(file)
+
+        return documents
+
+    def prepare(self, documents, changes):
+        # Called on the event loop: serialize every changed document in full
+        batch = {}
+
+        for name in changes:
+            batch[name] = dump_json(documents[name], self.pretty)
+
+        return batch
+
+    def write(self, batch):
+        write_files_atomic({self.path(name): payload for name, payload in batch.items()})
+
+    def close(self):
+        pass
+
+
+class SqliteStorage:
+    # Users, lands, units and tasks each get their own indexed table so a change only rewrites the rows it touched.
+    # Runs in WAL mode so reads never block the background writer.
+    def __init__(self, path=DATABASE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id TEXT PRIMARY KEY,
+                    liege_id INTEGER NOT NULL DEFAULT 0,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS users_liege_id ON users (liege_id);
+
+                CREATE TABLE IF NOT EXISTS lands (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL DEFAULT '',
+                    owner_id INTEGER NOT NULL DEFAULT 0,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS lands_owner_id ON lands (owner_id);
+                CREATE INDEX IF NOT EXISTS lands_name ON lands (name COLLATE NOCASE);
+
+                CREATE TABLE IF NOT EXISTS units (
+                    land_id TEXT NOT NULL,
+                    camp TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    troop_name TEXT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    PRIMARY KEY (land_id, camp, position)
+                );
+                CREATE INDEX IF NOT EXISTS units_user_id ON units (user_id);
+
+                CREATE TABLE IF NOT EXISTS tasks (
+                    position INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    task TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    location_id INTEGER NOT NULL,
+                    amount INTEGER NOT NULL,
+                    time INTEGER NOT NULL,
+                    target_land_id INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tasks_target_land_id ON tasks (target_land_id);
+
+                CREATE TABLE IF NOT EXISTS documents (
+                    name TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+            ''')
+
+    def is_empty(self):
+        return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 0
+
+    def load(self):
+        if self.is_empty():
+            raise ValueError(f'{self.path} has no data in it. Run "python storage.py migrate" first.')
+
+        with self.lock:
+            cursor = self.connection.cursor()
+
+            user_info = {}
+            for user_id, data in cursor.execute("SELECT id, data FROM users ORDER BY rowid"):
+                user_info[user_id] = json.loads(data)
+
+            lands = {}
+            for land_id, data in cursor.execute("SELECT id, data FROM lands ORDER BY rowid"):
+                land = json.loads(data)
+                for camp in CAMPS:
+                    land[camp] = []
+                lands[land_id] = land
+
+            for land_id, camp, user_id, troop_name, amount in cursor.execute(
+                    "SELECT land_id, camp, user_id, troop_name, amount FROM units ORDER BY land_id, camp, position"):
+                lands[land_id][camp].append({"troop_name": troop_name, "amount": amount, "user_id": user_id})
+
+            documents = {"user_info": user_info, "lands": lands}
+            for name, data in cursor.execute("SELECT name, data FROM documents"):
+                documents[name] = json.loads(data)
+
+            task_queue = []
+            for row in cursor.execute(f'SELECT {", ".join(TASK_COLUMNS)} FROM tasks ORDER BY position'):
+                task_queue.append(dict(zip(TASK_COLUMNS, row)))
+            documents.setdefault("global_info", {})["task_queue"] = task_queue
+            documents.setdefault("server_info", {})
+
+        return documents
+
+    def prepare(self, documents, changes):
+        # Called on the event loop: turn the changed users/lands (or whole documents) into rows
+        batch = {"users": [], "deleted_users": [], "lands": [], "deleted_lands": [], "documents": [], "tasks": None}
+
+        if "user_info" in changes:
+            user_info = documents["user_info"]
+            keys = changes["user_info"]
+            if keys is None:
+                keys = list(user_info.keys())
+                batch["replace_users"] = True
+
+            for user_id in keys:
+                user = user_info.get(user_id)
+                if user is None:
+                    batch["deleted_users"].append(user_id)
+                else:
+                    batch["users"].append((user_id, int(user.get("liege_id", 0)), dump_json(user)))
+
+        if "lands" in changes:
+            lands = documents["lands"]
+            keys = changes["lands"]
+            if keys is None:
+                keys = list(lands.keys())
+                batch["replace_lands"] = True
+
+            for land_id in keys:
+                land = lands.get(land_id)
+                if land is None:
+                    batch["deleted_lands"].append(land_id)
+                    continue
+
+                data = {attr: value for attr, value in land.items() if attr not in CAMPS}
+                units = []
+                for camp in CAMPS:
+                    for position, unit in enumerate(land.get(camp, [])):
+                        units.append((land_id, camp, position, int(unit["user_id"]), unit["troop_name"], unit["amount"]))
+
+                batch["lands"].append((land_id, land.get("name", ""), int(land.get("owner_id", 0)), dump_json(data), units))
+
+        if "global_info" in changes:
+            global_info = documents["global_info"]
+            data = {attr: value for attr, value in global_info.items() if attr != "task_queue"}
+            batch["documents"].append(("global_info", dump_json(data)))
+            batch["tasks"] = [tuple(task.get(column) for column in TASK_COLUMNS) for task in global_info["task_queue"]]
+
+        if "server_info" in changes:
+            batch["documents"].append(("server_info", dump_json(documents["server_info"])))
+
+        return batch
+
+    def write(self, batch):
+        with self.lock, self.connection:
+            cursor = self.connection.cursor()
+
+            if batch.get("replace_users"):
+                cursor.execute("DELETE FROM users")
+            if batch.get("replace_lands"):
+                cursor.execute("DELETE FROM lands")
+                cursor.execute("DELETE FROM units")
+
+            cursor.executemany("DELETE FROM users WHERE id = ?", [(user_id,) for user_id in batch["deleted_users"]])
+            cursor.executemany('''
+                INSERT INTO users (id, liege_id, data) VALUES (?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET liege_id = excluded.liege_id, data = excluded.data
+            ''', batch["users"])
+
+            for land_id in batch["deleted_lands"]:
+                cursor.execute("DELETE FROM lands WHERE id = ?", (land_id,))
+                cursor.execute("DELETE FROM units WHERE land_id = ?", (land_id,))
+
+            for land_id, name, owner_id, data, units in batch["lands"]:
+                cursor.execute('''
+                    INSERT INTO lands (id, name, owner_id, data) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET name = excluded.name, owner_id = excluded.owner_id, data = excluded.data
+                ''', (land_id, name, owner_id, data))
+                cursor.execute("DELETE FROM units WHERE land_id = ?", (land_id,))
+                cursor.executemany("INSERT INTO units VALUES (?, ?, ?, ?, ?, ?)", units)
+
+            cursor.executemany('''
+                INSERT INTO documents (name, data) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET data = excluded.data
+            ''', batch["documents"])
+
+            if batch["tasks"] is not None:
+                cursor.execute("DELETE FROM tasks")
+                cursor.executemany(
+                    f'INSERT INTO tasks (position, {", ".join(TASK_COLUMNS)}) VALUES (?, {", ".join("?" for column in TASK_COLUMNS)})',
+                    [(position,) + task for position, task in enumerate(batch["tasks"])])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def migrate(source_dir, database_path):
+    # One-shot copy of the JSON data folder into a SQLite database
+    if not all(os.path.exists(os.path.join(source_dir, f'{name}.json')) for name in DOCUMENTS):
+        print(f'{source_dir} is missing some data files, using {DEFAULT_DATA_DIR} instead.')
+        source_dir = DEFAULT_DATA_DIR
+
+    documents = JsonStorage(source_dir).load()
+    database = SqliteStorage(database_path)
+
+    if not database.is_empty():
+        database.close()
+        raise ValueError(f'{database_path} already has data in it. Delete it first if you want to migrate again.')
+
+    changes = {name: None for name in DOCUMENTS}
+    database.write(database.prepare(documents, changes))
+    database.close()
+
+    print(f'Migrated {len(documents["user_info"])} users, {len(documents["lands"])} lands and '
+          f'{len(documents["global_info"].get("task_queue", []))} queued tasks from {source_dir} into {database_path}.')
+
+
+def export(storage, dest_dir):
+    # Write an indented copy of the world state, e.g. to look through it or diff two days
+    documents = storage.load()
+    storage.close()
+
+    os.makedirs(dest_dir, exist_ok=True)
+    write_files_atomic({os.path.join(dest_dir, f'{name}.json'): dump_json(documents[name], pretty=True) for name in DOCUMENTS})
+
+    print(f'Exported {", ".join(DOCUMENTS)} to {dest_dir}.')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duck Bot storage tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Copy the JSON data files into a SQLite database.")
+    migrate_parser.add_argument("--source", default=DATA_DIR)
+    migrate_parser.add_argument("--database", default=DATABASE_PATH)
+    export_parser = subparsers.add_parser("export", help="Write a pretty printed copy of the current storage backend's data.")
+    export_parser.add_argument("--dest", default="./export")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "migrate":
+            migrate(args.source, args.database)
+        elif args.command == "export":
+            export(open_storage(), args.dest)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
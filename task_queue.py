@@ -0,0 +1,49 @@
+import itertools
+
+
+class TaskQueue:
+    # The queued commands, indexed by task type and by (task type, target land) so each part of the daily
+    # tick only looks at its own tasks and a battle finds everyone taking part in it with one lookup.
+    # Tasks keep their queue order inside every index and can be removed in O(1).
+    def __init__(self, tasks=()):
+        self.ids = itertools.count()
+        self.tasks = {}
+        self.by_type = {}
+        self.by_target = {}
+        # How many tasks have been taken off the queue so far
+        self.removed = 0
+
+        for task in tasks:
+            self.add(task)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def add(self, task):
+        task_id = next(self.ids)
+
+        self.tasks[task_id] = task
+        self.by_type.setdefault(task["task"], {})[task_id] = task
+        self.by_target.setdefault((task["task"], task["target_land_id"]), {})[task_id] = task
+
+        return task_id
+
+    def remove(self, task_id):
+        task = self.tasks.pop(task_id)
+
+        del self.by_type[task["task"]][task_id]
+        del self.by_target[(task["task"], task["target_land_id"])][task_id]
+        self.removed += 1
+
+    def of_type(self, task_type):
+        # A copy, so tasks can be removed while looping over it
+        return list(self.by_type.get(task_type, {}).items())
+
+    def targeting(self, task_type, target_land_id):
+        return list(self.by_target.get((task_type, target_land_id), {}).items())
+
+    def to_list(self):
+        return list(self.tasks.values())
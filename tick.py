@@ -0,0 +1,60 @@
+import time
+from task_queue import TaskQueue
+from notifications import Outbox
+
+
+class TickContext:
+    # Everything the phases of one daily tick share: the world documents, the indexed task queue,
+    # the outbox for the DMs and the counters that end up in the timing report.
+    def __init__(self, documents):
+        self.user_info = documents["user_info"]
+        self.global_info = documents["global_info"]
+        self.lands = documents["lands"]
+        self.server_info = documents["server_info"]
+        self.task_queue = TaskQueue(self.global_info["task_queue"])
+        # DMs are only queued during the tick and sent once the world lock is released
+        self.outbox = Outbox()
+        self.dms_queued = 0
+        # (phase name, seconds, tasks processed, DMs queued) for every phase that ran
+        self.reports = []
+
+    async def dm(self, user_id, message):
+        self.dms_queued += 1
+        self.outbox.add(user_id, message)
+
+
+class TickEngine:
+    # Runs the registered phases of the daily tick in order, timing each one.
+    # Phases are grouped so the caller can run the world simulation under the world lock
+    # and the announcements after it has been released.
+    def __init__(self):
+        self.phases = []
+
+    def phase(self, name, group="simulation"):
+        def register(function):
+            self.phases.append((name, group, function))
+            return function
+        return register
+
+    async def run(self, context, group="simulation"):
+        for name, phase_group, function in self.phases:
+            if phase_group != group:
+                continue
+
+            start = time.perf_counter()
+            tasks_before = context.task_queue.removed
+            dms_before = context.dms_queued
+
+            await function(context)
+
+            context.reports.append((name, time.perf_counter() - start,
+                                    context.task_queue.removed - tasks_before, context.dms_queued - dms_before))
+
+    def report(self, context):
+        total = sum(duration for name, duration, tasks, dms in context.reports)
+        lines = [f'Daily reset took {total:.3f}s']
+
+        for name, duration, tasks, dms in context.reports:
+            lines.append(f'  {name}: {duration:.3f}s, {tasks} tasks, {dms} DMs')
+
+        return "\n".join(lines)
@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+import discord
+
+
+class DmChannelCache:
+    # DM channels by user id, so dm() doesn't need a REST call for every message.
+    # Users come from the gateway cache (client.get_user) when possible and are only fetched when missing.
+    # Least recently used channels are dropped past max_size, and every entry expires after ttl seconds.
+    # Ids that Discord doesn't know are remembered for negative_ttl seconds so they aren't fetched again.
+    def __init__(self, client, max_size=1024, ttl=3600, negative_ttl=600):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # User id -> (expiry time, channel or None)
+        self.entries = OrderedDict()
+
+    async def get(self, user_id):
+        user_id = int(user_id)
+        now = time.monotonic()
+
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            self.entries.move_to_end(user_id)
+            return entry[1]
+
+        user = self.client.get_user(user_id)
+        if user is None:
+            try:
+                user = await self.client.fetch_user(user_id)
+            except discord.NotFound:
+                self.store(user_id, None, now + self.negative_ttl)
+                return None
+
+        channel = user.dm_channel
+        if channel is None:
+            channel = await user.create_dm()
+
+        self.store(user_id, channel, now + self.ttl)
+        return channel
+
+    def store(self, user_id, channel, expires):
+        self.entries[user_id] = (expires, channel)
+        self.entries.move_to_end(user_id)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def forget(self, user_id):
+        self.entries.pop(int(user_id), None)